@@ -17,20 +17,26 @@ import fiona
 import fiona.transform
 import numpy as np
 import rasterio
+import rasterio.enums
 import rasterio.warp
 
 LOGGER = logging.getLogger("server")
 
-from web_tool.DataLoader import warp_data_to_3857, crop_data_by_extent, crop_data_by_geometry, get_area_from_geometry
-from web_tool.Datasets import load_datasets
+from web_tool.DataLoader import InMemoryRaster, warp_data_to_3857, crop_data_by_extent, crop_data_by_geometry, get_area_from_geometry
+from web_tool.Datasets import load_datasets, get_dataset_resolutions
 DATALOADERS = load_datasets()
 
-from web_tool.Utils import setup_logging, get_random_string, class_prediction_to_img
+from web_tool.Utils import setup_logging, get_random_string, class_prediction_to_img, get_class_idxs, get_palette, encode_paletted_png, encode_binary_response, BINARY_RESPONSE_CONTENT_TYPE, LRUCache, clear_shared_arrays
 from web_tool import ROOT_DIR
 from web_tool.Session import manage_session_folders, SESSION_FOLDER
 from web_tool.SessionHandler import SessionHandler
 from web_tool.Checkpoints import Checkpoints
 SESSION_HANDLER = None
+INPUT_CACHE = None
+INPUT_CACHE_GRID_SIZE = None # None means the resolution of each dataset, see `get_input_raster()`
+DATASET_RESOLUTIONS = get_dataset_resolutions()
+PNG_COMPRESS_LEVEL = 1
+PRED_TILE_PREVIEW_MAX_PIXELS = 4096 * 4096 # the PNG preview of a `/predTile` result is downsampled to at most this many pixels (before warping it to EPSG:3857)
 
 import bottle 
 bottle.TEMPLATE_PATH.insert(0, "./" + ROOT_DIR + "/views") # let bottle know where we are storing the template files
@@ -85,6 +91,48 @@ def do_options():
     return
 
 
+def wants_binary_response():
+    '''Returns True if the client said (through the "Accept" header) that it can parse the binary response format from `encode_binary_response()`.
+    Clients that don't ask for it get the plain JSON responses.
+    '''
+    return BINARY_RESPONSE_CONTENT_TYPE in bottle.request.headers.get("Accept", "")
+
+
+def snap_extent(extent, grid_size):
+    '''Moves the edges of an extent to the nearest points of a grid with spacing `grid_size` (in the units of the extent's CRS).
+    '''
+    return {
+        "xmin": round(extent["xmin"] / grid_size) * grid_size,
+        "ymin": round(extent["ymin"] / grid_size) * grid_size,
+        "xmax": round(extent["xmax"] / grid_size) * grid_size,
+        "ymax": round(extent["ymax"] / grid_size) * grid_size,
+        "crs": extent["crs"]
+    }
+
+
+def get_input_raster(dataset, extent):
+    '''Returns `DATALOADERS[dataset].get_data_from_extent(extent)` through `INPUT_CACHE`.
+
+    Entries are keyed by the exact window that is requested, so hits come from the /predPatch and /getInput requests that the front-end sends
+    for the same click, and from clicks on the same spot (e.g. re-running a patch after retraining, or from another session). Windows that only
+    overlap don't share an entry. The front-end snaps the centers of its windows to the dataset's resolution, so we snap the extent to the same
+    grid (or to `--input_cache_grid_size`) to absorb the floating point noise from its round trip through lat/lon. The padding that the data
+    loader adds covers the (tiny) difference between the snapped and the requested extent.
+
+    Cached rasters are shared between requests and sessions, so the cached data is read-only and each call gets its own (writable) copy.
+    '''
+    grid_size = INPUT_CACHE_GRID_SIZE or DATASET_RESOLUTIONS.get(dataset, None)
+    snapped_extent = snap_extent(extent, grid_size) if grid_size else extent
+    key = (dataset, snapped_extent["crs"], snapped_extent["xmin"], snapped_extent["ymin"], snapped_extent["xmax"], snapped_extent["ymax"])
+
+    input_raster = INPUT_CACHE.get(key)
+    if input_raster is None:
+        input_raster = DATALOADERS[dataset].get_data_from_extent(snapped_extent)
+        input_raster.data.flags.writeable = False # protects the cached copy
+        INPUT_CACHE.put(key, input_raster)
+    return InMemoryRaster(input_raster.data.copy(), input_raster.crs, input_raster.transform, input_raster.bounds)
+
+
 #---------------------------------------------------------------------------------------
 # Session handling endpoints
 #---------------------------------------------------------------------------------------
@@ -93,9 +141,10 @@ def create_session():
     bottle.response.content_type = 'application/json'
     data = bottle.request.json
 
-    SESSION_HANDLER.create_session(bottle.request.session.id, data["dataset"], data["model"], data["checkpoint"])
-    
-    bottle.response.status = 200
+    result = SESSION_HANDLER.create_session(bottle.request.session.id, data["dataset"], data["model"], data["checkpoint"])
+    data.update(result)
+
+    bottle.response.status = 503 if result["status"] == "rejected" else 200
     return json.dumps(data)
 
 
@@ -119,6 +168,8 @@ def get_session_status():
     
     data["sessionID"] = str(bottle.request.session.id)
     data["isActive"] = SESSION_HANDLER.is_active(bottle.request.session.id)
+    data["queuePosition"] = SESSION_HANDLER.get_queue_position(bottle.request.session.id) # None unless the session is waiting to be started
+    data["isQueued"] = data["queuePosition"] is not None
 
     bottle.response.status = 200
     return json.dumps(data)
@@ -132,13 +183,26 @@ def whoami():
     <ul>
     """
 
-    for session_id, session in SESSION_HANDLER._SESSION_MAP.items():
+    for session_id, session in SESSION_HANDLER.get_sessions():
         page += f"<li>{str(session_id)}</li>"
     page += "</ul>"
 
     active_session = SESSION_HANDLER.is_active(bottle.request.session.id)
     page += f"<br/><br/>Your session is active: {active_session}"
 
+    cache_stats = INPUT_CACHE.stats()
+    page += f"<br/><br/>Input cache: {cache_stats['entries']} entries, {cache_stats['bytes'] / 2**20:0.1f}/{cache_stats['maxBytes'] / 2**20:0.1f} MB, {cache_stats['hits']} hits, {cache_stats['misses']} misses"
+
+    batch_stats = SESSION_HANDLER.get_batch_stats()
+    if len(batch_stats) > 0:
+        page += "<br/><br/>Shared workers:<ul>"
+        for model_key, stats in batch_stats.items():
+            if stats is None:
+                page += f"<li>{model_key}: not batching requests</li>"
+            else:
+                page += f"<li>{model_key}: {stats['numRequests']} requests in {stats['numBatches']} batches of {stats['meanBatchSize']:0.1f} windows on average ({stats['meanBatchFill'] * 100:0.1f}% full), {stats['queueDepth']} windows waiting (at most {stats['maxQueueDepth']})</li>"
+        page += "</ul>"
+
     return page
 
 
@@ -160,7 +224,7 @@ def retrain_model():
     bottle.response.content_type = 'application/json'
     data = bottle.request.json
     
-    result = SESSION_HANDLER.get_session(bottle.request.session.id).model.retrain(**data["retrainArgs"])
+    result = SESSION_HANDLER.get_session(bottle.request.session.id).retrain(**data["retrainArgs"])
     
     bottle.response.status = 200 if result["success"] else 500
     return json.dumps(result)
@@ -170,7 +234,7 @@ def do_undo():
     bottle.response.content_type = 'application/json'
     data = bottle.request.json
 
-    result = SESSION_HANDLER.get_session(bottle.request.session.id).model.undo()
+    result = SESSION_HANDLER.get_session(bottle.request.session.id).undo()
     
     bottle.response.status = 200 if result["success"] else 500
     return json.dumps(result)
@@ -201,7 +265,7 @@ def record_correction():
     dst_row = int(np.floor(dst_row))
     dst_col = int(np.floor(dst_col))
 
-    result = current_session.model.add_sample_point(dst_row, dst_col, class_idx)
+    result = current_session.add_sample_point(dst_row, dst_col, class_idx)
 
     bottle.response.status = 200 if result["success"] else 500
     return json.dumps(result)
@@ -223,103 +287,161 @@ def pred_patch():
 
     if dataset not in DATALOADERS:
         raise ValueError("Dataset doesn't seem to be valid, do the datasets in js/tile_layers.js correspond to those in TileLayers.py")
-    else:
-        current_data_loader = DATALOADERS[dataset]
-
-    input_raster = current_data_loader.get_data_from_extent(extent)
-    current_session.latest_input_raster = input_raster
-
-    output_raster = current_session.pred_patch(input_raster) # run inference
-    warped_output_raster = warp_data_to_3857(output_raster) # warp output to 3857
-    cropped_warped_output_raster = crop_data_by_extent(warped_output_raster, extent) # crop to the desired result
 
-    if cropped_warped_output_raster.shape[2] > len(color_list):
-       LOGGER.warning("The number of output channels is larger than the given color list, cropping output to number of colors (you probably don't want this to happen")
-       cropped_warped_output_raster.data = cropped_warped_output_raster.data[:,:,:len(color_list)]
+    input_raster = get_input_raster(dataset, extent)
 
-
-    # Create color versions of predictions
-    img_soft = class_prediction_to_img(cropped_warped_output_raster.data, False, color_list)
-    img_soft = cv2.imencode(".png", cv2.cvtColor(img_soft, cv2.COLOR_RGB2BGR))[1].tostring()
-    img_soft = base64.b64encode(img_soft).decode("utf-8")
-    data["output_soft"] = img_soft
-
-    img_hard = class_prediction_to_img(cropped_warped_output_raster.data, True, color_list)
-    img_hard = cv2.imencode(".png", cv2.cvtColor(img_hard, cv2.COLOR_RGB2BGR))[1].tostring()
-    img_hard = base64.b64encode(img_hard).decode("utf-8")
-    data["output_hard"] = img_hard
+    # Serve the result from the session's cache if the model hasn't changed since we last rendered this extent
+    result_key = (dataset, extent["crs"], extent["xmin"], extent["ymin"], extent["xmax"], extent["ymax"], tuple(color_list))
+    result = current_session.get_cached_result(result_key)
+    if result is not None:
+        current_session.set_latest_input_from_cache(input_raster)
+    else:
+        output_raster, model_version = current_session.pred_patch(input_raster) # run inference
+
+        if output_raster.shape[2] > len(color_list):
+           LOGGER.warning("The number of output channels is larger than the given color list, cropping output to number of colors (you probably don't want this to happen")
+           output_raster.data = output_raster.data[:,:,:len(color_list)]
+
+        # Render the predictions in the source CRS and then warp the rendered uint8 images, instead of warping every float32 class
+        # probability band. Channel 0 holds the class indices (for the hard image) and channels 1-3 the soft RGB image. We warp with
+        # nearest neighbor resampling, so this gives the same result as warping the probabilities and rendering afterwards.
+        height, width, _ = output_raster.shape
+        rendered = np.empty((height, width, 4), dtype=np.uint8)
+        get_class_idxs(output_raster.data, out=rendered[:,:,0])
+        img_soft = class_prediction_to_img(output_raster.data, False, color_list)
+        np.multiply(img_soft, 255, out=img_soft)
+        np.add(img_soft, 0.5, out=img_soft)
+        np.minimum(img_soft, 255, out=img_soft)
+        rendered[:,:,1:] = img_soft
+        del img_soft
+
+        rendered_raster = InMemoryRaster(rendered, output_raster.crs, output_raster.transform, output_raster.bounds)
+        warped_rendered_raster = warp_data_to_3857(rendered_raster) # warp the rendered images to 3857
+        cropped_warped_rendered_raster = crop_data_by_extent(warped_rendered_raster, extent) # crop to the desired result
+
+        img_soft = np.ascontiguousarray(cropped_warped_rendered_raster.data[:,:,1:])
+        img_soft = cv2.imencode(".png", cv2.cvtColor(img_soft, cv2.COLOR_RGB2BGR))[1].tostring()
+
+        # The hard predictions are encoded directly from the class indices as a paletted PNG
+        img_hard = np.ascontiguousarray(cropped_warped_rendered_raster.data[:,:,0])
+        img_hard = encode_paletted_png(img_hard, get_palette(color_list), PNG_COMPRESS_LEVEL)
+
+        result = {
+            "soft": img_soft,
+            "hard": img_hard
+        }
+        current_session.set_cached_result(result_key, model_version, result)
 
     bottle.response.status = 200
-    return json.dumps(data)
+    if wants_binary_response(): # the images are sent as raw bytes next to the JSON
+        bottle.response.content_type = BINARY_RESPONSE_CONTENT_TYPE
+        return encode_binary_response(data, [
+            ("output_soft", "image/png", result["soft"]),
+            ("output_hard", "image/png", result["hard"])
+        ])
+    else:
+        data["output_soft"] = base64.b64encode(result["soft"]).decode("utf-8")
+        data["output_hard"] = base64.b64encode(result["hard"]).decode("utf-8")
+        return json.dumps(data)
 
 
 def pred_tile():
+    '''Starts running the model over the polygon in the request as a background job on the session's `JobRunner`. This returns the id of
+    the job straight away, the client polls `/jobStatus` and then gets the output (the same response this endpoint used to block for) from
+    `/jobResult`.
+    '''
     bottle.response.content_type = 'application/json'
     data = bottle.request.json
     current_session = SESSION_HANDLER.get_session(bottle.request.session.id)
 
     current_session.add_entry(data) # record this interaction
 
+    dataset = data["dataset"]
+    if dataset not in DATALOADERS:
+        raise ValueError("Dataset doesn't seem to be valid, do the datasets in js/tile_layers.js correspond to those in TileLayers.py")    
+
+    job = current_session.job_runner.submit(run_pred_tile_job, current_session, DATALOADERS[dataset], data)
+
+    bottle.response.status = 200
+    return json.dumps(job.to_dict())
+
+
+def run_pred_tile_job(job, current_session, current_data_loader, data):
+    '''The body of a `/predTile` job, see `pred_tile()`. This runs on the session's `JobRunner` thread.
+    '''
     # Inputs
     geom = data["polygon"]
     class_list = data["classes"]
     name_list = [item["name"] for item in class_list]
     color_list = [item["color"] for item in class_list]
-    dataset = data["dataset"]
     zone_layer_name = data["zoneLayerName"]
     model_idx = data["modelIdx"]
 
-    if dataset not in DATALOADERS:
-        raise ValueError("Dataset doesn't seem to be valid, do the datasets in js/tile_layers.js correspond to those in TileLayers.py")    
-    else:
-        current_data_loader = DATALOADERS[dataset]
-
     try:
-        input_raster = current_data_loader.get_data_from_geometry(geom["geometry"])
+        input_raster = current_data_loader.get_windowed_data_from_geometry(geom["geometry"])
         shape_area = get_area_from_geometry(geom["geometry"])
     except NotImplementedError as e: # Example of how to handle errors from the rest of the server
-        bottle.response.status = 400
-        return json.dumps({"error": "Cannot currently download imagery with 'Basemap' based datasets"})
-    
-    output_raster = current_session.pred_tile(input_raster)
-    if output_raster.shape[2] > len(color_list):
-       LOGGER.warning("The number of output channels is larger than the given color list, cropping output to number of colors (you probably don't want this to happen")
-       output_raster.data = output_raster.data[:,:,:len(color_list)]
+        raise ValueError("Cannot currently download imagery with this dataset")
     
-    output_hard = output_raster.data.argmax(axis=2)
-    nodata_mask = np.sum(input_raster.data == 0, axis=2) == input_raster.shape[2]
-    output_hard[nodata_mask] = 255
-    class_vals, class_counts = np.unique(output_hard[~nodata_mask], return_counts=True)
-
-    img_hard = class_prediction_to_img(output_raster.data, True, color_list)
-    img_hard = cv2.cvtColor(img_hard, cv2.COLOR_RGB2BGRA)
-    img_hard[nodata_mask] = [0,0,0,0]
-
-    # replace the output predictions with our image data because we are too lazy to make a new InMemoryRaster
-    output_raster.data = img_hard
-    output_raster.shape = img_hard.shape
-
-    warped_output_raster = warp_data_to_3857(output_raster) # warp output to 3857
-    cropped_warped_output_raster = crop_data_by_geometry(warped_output_raster, geom["geometry"], "epsg:4326") # crop to the desired shape
-    img_hard = cropped_warped_output_raster.data
-
+    # Read and run the model one chunk at a time. Each chunk is immediately reduced to uint8 class indices, written to a tiled GeoTIFF and
+    # counted, so we never hold the full input or the (height, width, number of classes) model output in memory.
+    height, width = input_raster.height, input_raster.width
     tmp_id = get_random_string(8)
-    cv2.imwrite("tmp/downloads/%s.png" % (tmp_id), img_hard)
-    data["downloadPNG"] = "tmp/downloads/%s.png" % (tmp_id)
 
     new_profile = {}
     new_profile['driver'] = 'GTiff'
     new_profile['dtype'] = 'uint8'
     new_profile['compress'] = "lzw"
+    new_profile['tiled'] = True
+    new_profile['blockxsize'] = 256
+    new_profile['blockysize'] = 256
     new_profile['count'] = 1
-    new_profile['transform'] = output_raster.transform
-    new_profile['height'] = output_hard.shape[0] 
-    new_profile['width'] = output_hard.shape[1]
+    new_profile['crs'] = input_raster.crs
+    new_profile['transform'] = input_raster.transform
+    new_profile['height'] = height
+    new_profile['width'] = width
     new_profile['nodata'] = 255
+
+    all_class_counts = np.zeros((256,), dtype=np.int64)
     with rasterio.open("tmp/downloads/%s.tif" % (tmp_id), 'w', **new_profile) as f:
-        f.write(output_hard.astype(np.uint8), 1)
+        for window, chunk_output, chunk_input in current_session.pred_tile_chunks(input_raster, progress_callback=job.set_progress, cancel_event=job.cancel_event):
+            if chunk_output.shape[2] > len(color_list):
+               if window.row_off == 0 and window.col_off == 0: # only warn for the first chunk
+                   LOGGER.warning("The number of output channels is larger than the given color list, cropping output to number of colors (you probably don't want this to happen")
+               chunk_output = chunk_output[:,:,:len(color_list)]
+
+            chunk_hard = get_class_idxs(chunk_output)
+            chunk_hard[np.sum(chunk_input == 0, axis=2) == chunk_input.shape[2]] = 255 # nodata
+            all_class_counts += np.bincount(chunk_hard.ravel(), minlength=256)
+
+            f.write(chunk_hard, 1, window=window)
     data["downloadTIFF"] = "tmp/downloads/%s.tif" % (tmp_id)
 
+    class_vals = np.flatnonzero(all_class_counts[:255])
+    class_counts = all_class_counts[class_vals]
+
+    # The PNG preview is rendered from the GeoTIFF that we just wrote, downsampled (nearest neighbor) so that it has at most
+    # `PRED_TILE_PREVIEW_MAX_PIXELS` pixels, so its memory use is bounded too.
+    scale = max(np.sqrt(height * width / PRED_TILE_PREVIEW_MAX_PIXELS), 1)
+    preview_height, preview_width = max(int(round(height / scale)), 1), max(int(round(width / scale)), 1)
+    with rasterio.open("tmp/downloads/%s.tif" % (tmp_id), 'r') as f:
+        preview_hard = f.read(1, out_shape=(preview_height, preview_width), resampling=rasterio.enums.Resampling.nearest)
+    preview_transform = input_raster.transform * rasterio.Affine.scale(width / preview_width, height / preview_height)
+
+    # Warp the class indices, shifted up by one so that nodata (255) becomes 0, which is what warping and cropping fill with. We then render
+    # with a single lookup into a BGRA palette where 0 is transparent.
+    preview_hard += 1
+    output_raster = InMemoryRaster(preview_hard[:,:,np.newaxis], input_raster.crs, preview_transform, input_raster.bounds)
+    warped_output_raster = warp_data_to_3857(output_raster) # warp output to 3857
+    cropped_warped_output_raster = crop_data_by_geometry(warped_output_raster, geom["geometry"], "epsg:4326") # crop to the desired shape
+
+    palette = np.zeros((256, 4), dtype=np.uint8)
+    palette[1:len(color_list)+1, :3] = get_palette(color_list)[:, ::-1]
+    palette[1:len(color_list)+1, 3] = 255
+    img_hard = np.take(palette, cropped_warped_output_raster.data[:,:,0], axis=0)
+
+    cv2.imwrite("tmp/downloads/%s.png" % (tmp_id), img_hard)
+    data["downloadPNG"] = "tmp/downloads/%s.png" % (tmp_id)
 
     data["classStatistics"] = []
 
@@ -341,8 +463,45 @@ def pred_tile():
     f.close()
     data["downloadStatistics"] = "tmp/downloads/%s.txt" % (tmp_id)
 
+    return data
+
+
+def get_job(current_session, job_id):
+    job = current_session.job_runner.get_job(job_id)
+    if job is None:
+        raise ValueError("Job %s doesn't exist, or finished too long ago" % (job_id))
+    return job
+
+
+def job_status():
+    bottle.response.content_type = 'application/json'
+    data = bottle.request.json
+    current_session = SESSION_HANDLER.get_session(bottle.request.session.id)
+
+    job = get_job(current_session, data["jobId"])
+    result = job.to_dict()
+    result["queuePosition"] = current_session.job_runner.queue_position(job)
+
     bottle.response.status = 200
-    return json.dumps(data)
+    return json.dumps(result)
+
+
+def job_result():
+    bottle.response.content_type = 'application/json'
+    data = bottle.request.json
+    current_session = SESSION_HANDLER.get_session(bottle.request.session.id)
+
+    job = get_job(current_session, data["jobId"])
+    if job.status == job.FINISHED:
+        bottle.response.status = 200
+        return json.dumps(job.result)
+    elif job.status in [job.FAILED, job.CANCELLED]:
+        bottle.response.status = 400
+        return json.dumps({"error": job.error, "message": job.error})
+    else:
+        bottle.response.status = 202 # not done yet
+        return json.dumps(job.to_dict())
+
 
 def download_all():
     bottle.response.content_type = 'application/json'
@@ -365,20 +524,21 @@ def get_input():
 
     if dataset not in DATALOADERS:
         raise ValueError("Dataset doesn't seem to be valid, please check Datasets.py")
-    else:
-        current_data_loader = DATALOADERS[dataset]
 
-    input_raster = current_data_loader.get_data_from_extent(extent)
+    input_raster = get_input_raster(dataset, extent)
     warped_output_raster = warp_data_to_3857(input_raster) # warp image to 3857
     cropped_warped_output_raster = crop_data_by_extent(warped_output_raster, extent) # crop to the desired extent
     
     img = cropped_warped_output_raster.data[:,:,:3].copy().astype(np.uint8) # keep the RGB channels to save as a color image
     img = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))[1].tostring()
-    img = base64.b64encode(img).decode("utf-8")
-    data["input_img"] = img
 
     bottle.response.status = 200
-    return json.dumps(data)
+    if wants_binary_response():
+        bottle.response.content_type = BINARY_RESPONSE_CONTENT_TYPE
+        return encode_binary_response(data, [("input_img", "image/png", img)])
+    else:
+        data["input_img"] = base64.b64encode(img).decode("utf-8")
+        return json.dumps(data)
 
 
 #---------------------------------------------------------------------------------------
@@ -433,7 +593,7 @@ def get_everything_else(filepath):
 #---------------------------------------------------------------------------------------
 
 def main():
-    global SESSION_HANDLER
+    global SESSION_HANDLER, INPUT_CACHE, INPUT_CACHE_GRID_SIZE, PNG_COMPRESS_LEVEL
     parser = argparse.ArgumentParser(description="AI for Earth Land Cover")
 
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose debugging", default=False)
@@ -441,13 +601,38 @@ def main():
     parser.add_argument("--port", action="store", dest="port", type=int, help="Port to listen on", default=8080)
 
     parser.add_argument("--disable_checkpoints", action="store_true", help="Disables the ability to save checkpoints on the server")
+    parser.add_argument("--input_cache_mb", action="store", type=int, help="Size of the in-memory cache of input imagery (in MB)", default=1024)
+    parser.add_argument("--http_threads", action="store", type=int, help="Number of threads the web server uses to handle requests", default=10)
+    parser.add_argument("--png_compress_level", action="store", type=int, help="zlib compression level (0-9) used for the hard prediction PNGs", default=1)
+    parser.add_argument("--worker_startup_timeout", action="store", type=int, help="Seconds to wait for a worker to load its model before giving up on it", default=120)
+    parser.add_argument("--shared_workers", action="store_true", help="Serve all CPU sessions for a model from one worker process that holds the model once, with a fine-tuning head per session. Models that don't support this (see supportsSharedWorker in models.json) still get a worker per session", default=False)
+    parser.add_argument("--max_batch_size", action="store", type=int, help="With --shared_workers, run the windows of concurrent requests from different sessions through the model together, in batches of up to this many windows (0 disables this)", default=0)
+    parser.add_argument("--max_batch_wait_ms", action="store", type=int, help="How long a batch waits for windows from other sessions before it is run", default=10)
+    parser.add_argument("--worker_inventory", action="store", type=str, help="Path to a JSON file that lists the GPUs and CPU core sets that sessions can have to themselves, see `load_worker_inventory()` in web_tool/SessionHandler.py", default=None)
+    parser.add_argument("--worker_num_threads", action="store", type=int, help="Thread limit for CPU workers that aren't started for a slot from the worker inventory (0 for no limit)", default=0)
+    parser.add_argument("--max_cpu_workers", action="store", type=int, help="Most CPU workers of sessions (and pre-warmed workers, see --num_warm_workers) that can run at once (0 for no limit)", default=0)
+    parser.add_argument("--max_worker_memory_mb", action="store", type=int, help="Most memory (in MB) that the CPU workers of sessions and the pre-warmed workers can use in total, according to their estimates (0 for no limit)", default=0)
+    parser.add_argument("--worker_memory_mb", action="store", type=int, help="Estimated memory (in MB) of a CPU worker, for models that don't set 'workerMemoryMB' in models.json", default=2048)
+    parser.add_argument("--admission_policy", action="store", type=str, choices=["queue", "reject", "preempt"], help="What to do with new sessions when the CPU worker limits are reached: wait in a queue, reject them, or kill the sessions that have been idle for the longest", default="queue")
+    parser.add_argument("--num_warm_workers", action="store", type=int, help="Number of pre-started CPU workers to keep waiting for new sessions, per model. They count against --max_cpu_workers and --max_worker_memory_mb, but are killed to make room for sessions", default=0)
+    parser.add_argument("--warm_worker_model_keys", action="store", nargs="*", type=str, help="Model keys (from models.json) to keep pre-started workers for, defaults to all models")
+    parser.add_argument("--input_cache_grid_size", action="store", type=float, help="Extents are snapped to a grid of this size (in units of the extent's CRS) before being looked up in the input cache, defaults to the dataset's resolution from datasets.json", default=None)
 
 
     args = parser.parse_args(sys.argv[1:])
 
+    # Delete the arrays that crashed servers and workers left in shared memory, before we start any workers of our own
+    clear_shared_arrays()
+
+    # Create the cache of input imagery that is shared by /predPatch and /getInput
+    INPUT_CACHE = LRUCache(args.input_cache_mb * 2**20, lambda raster: raster.data.nbytes)
+    INPUT_CACHE_GRID_SIZE = args.input_cache_grid_size
+    PNG_COMPRESS_LEVEL = args.png_compress_level
+
     # Create session factory to handle incoming requests
     SESSION_HANDLER = SessionHandler(args)
     SESSION_HANDLER.start_monitor(SESSION_TIMEOUT_SECONDS)
+    SESSION_HANDLER.start_worker_pool()
 
     # Setup logging
     log_path = os.path.join(os.getcwd(), "tmp/logs/")
@@ -475,6 +660,12 @@ def main():
     app.route("/predTile", method="OPTIONS", callback=do_options)
     app.route('/predTile', method="POST", callback=pred_tile)
 
+    app.route("/jobStatus", method="OPTIONS", callback=do_options)
+    app.route('/jobStatus', method="POST", callback=job_status)
+
+    app.route("/jobResult", method="OPTIONS", callback=do_options)
+    app.route('/jobResult', method="POST", callback=job_result)
+
     app.route("/downloadAll", method="OPTIONS", callback=do_options)
     app.route('/downloadAll', method="POST", callback=download_all)
     
@@ -530,7 +721,8 @@ def main():
 
     server = cheroot.wsgi.Server(
         (args.host, args.port),
-        app
+        app,
+        numthreads=args.http_threads
     )
     server.max_request_header_size = 2**13
     server.max_request_body_size = 2**27
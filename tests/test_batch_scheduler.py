@@ -0,0 +1,61 @@
+import sys
+sys.path.append("..")
+
+import threading
+
+import numpy as np
+
+from web_tool.BatchScheduler import BatchScheduler
+
+
+def test_batch_scheduler():
+    batch_sizes = []
+    def predict_fn(batch):
+        batch_sizes.append(batch.shape[0])
+        return [batch * 2, batch.sum(axis=(1,2))]
+
+    scheduler = BatchScheduler(predict_fn, max_batch_size=16, max_wait_ms=50, stats_interval_seconds=0)
+
+    inputs = [np.random.rand(n, 4, 4).astype(np.float32) for n in [3, 7, 20, 1, 5]]
+    results = [None] * len(inputs)
+    def run(i):
+        results[i] = scheduler.predict(inputs[i])
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for x, (doubled, sums) in zip(inputs, results):
+        assert np.array_equal(doubled, x * 2)
+        assert np.array_equal(sums, x.sum(axis=(1,2)))
+
+    assert max(batch_sizes) <= 16
+    assert sum(batch_sizes) == 36
+    assert len(batch_sizes) < len(inputs) # requests from different threads were run together
+
+    stats = scheduler.get_stats()
+    assert stats["queueDepth"] == 0
+    assert stats["numWindows"] == 36
+    assert stats["numBatches"] == len(batch_sizes)
+    assert scheduler.get_stats() == stats # reading the stats doesn't reset them
+
+    scheduler._log_stats()
+    assert scheduler.get_stats() == stats # neither does logging them
+
+
+def test_batch_scheduler_error():
+    def predict_fn(batch):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(predict_fn, max_batch_size=4, max_wait_ms=1, stats_interval_seconds=0)
+    try:
+        scheduler.predict(np.zeros((10, 2)))
+        assert False
+    except RuntimeError as e:
+        assert str(e) == "out of memory"
+
+
+if __name__ == "__main__":
+    test_batch_scheduler()
+    test_batch_scheduler_error()
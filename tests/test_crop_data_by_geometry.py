@@ -0,0 +1,69 @@
+import sys
+sys.path.append("..")
+
+import numpy as np
+import rasterio.io
+import rasterio.mask
+import rasterio.transform
+import shapely.affinity
+import shapely.geometry
+
+from web_tool.DataLoader import InMemoryRaster, crop_data_by_geometry
+
+
+def crop_data_by_geometry_reference(input_raster, geometry):
+    """The `rasterio.mask.mask()` based implementation that `crop_data_by_geometry()` replaced.
+    """
+    height, width, num_channels = input_raster.shape
+    profile = {
+        "driver": "GTiff", "dtype": str(input_raster.data.dtype),
+        "width": width, "height": height, "count": num_channels,
+        "crs": input_raster.crs,
+        "transform": input_raster.transform
+    }
+    with rasterio.io.MemoryFile() as memory_file:
+        with memory_file.open(**profile) as f:
+            f.write(np.rollaxis(input_raster.data, 2, 0))
+        with memory_file.open() as f:
+            dst_img, dst_transform = rasterio.mask.mask(f, [geometry], crop=True, all_touched=True, pad=False)
+    return np.rollaxis(dst_img, 0, 3), dst_transform
+
+
+def random_geometry(rng, left, bottom, right, top):
+    # the crops need to be at least a few pixels wide, as `InMemoryRaster` expects more rows and columns than channels
+    size_x, size_y = rng.uniform(8, (right - left) / 2), rng.uniform(8, (top - bottom) / 2)
+    x, y = rng.uniform(left, right - size_x), rng.uniform(bottom, top - size_y)
+    shape_type = rng.randint(4)
+    if shape_type == 0: # a box with edges anywhere
+        geom = shapely.geometry.box(x, y, x + size_x, y + size_y)
+    elif shape_type == 1: # a box with edges on the pixel grid
+        geom = shapely.geometry.box(np.floor(x), np.floor(y), np.floor(x + size_x), np.floor(y + size_y))
+    elif shape_type == 2: # a rotated box
+        geom = shapely.affinity.rotate(shapely.geometry.box(x, y, x + size_x, y + size_y), rng.uniform(0, 90))
+    else: # a random (possibly concave) polygon
+        num_points = rng.randint(4, 10)
+        angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False) + rng.uniform(0, np.pi / num_points, size=num_points)
+        radii = rng.uniform(0.5, 1.0, size=num_points) / 2
+        center_x, center_y = x + size_x / 2, y + size_y / 2
+        geom = shapely.geometry.Polygon(zip(center_x + size_x * radii * np.cos(angles), center_y + size_y * radii * np.sin(angles)))
+    return shapely.geometry.mapping(geom)
+
+
+def test_crop_data_by_geometry_matches_rasterio_mask():
+    rng = np.random.RandomState(0)
+    left, top = 440000, 4318000
+    transform = rasterio.transform.from_origin(left, top, 1, 1)
+    data = rng.randint(1, 255, size=(64, 80, 3)).astype(np.uint8)
+    raster = InMemoryRaster(data, "epsg:26918", transform, (left, top - 64, left + 80, top))
+
+    for i in range(200):
+        geometry = random_geometry(rng, left, top - 64, left + 80, top)
+        output = crop_data_by_geometry(raster, geometry, "epsg:26918")
+        expected_data, expected_transform = crop_data_by_geometry_reference(raster, geometry)
+
+        assert output.transform == expected_transform, (i, geometry)
+        assert np.array_equal(output.data, expected_data), (i, geometry)
+
+
+if __name__ == "__main__":
+    test_crop_data_by_geometry_matches_rasterio_mask()
@@ -0,0 +1,47 @@
+import sys
+sys.path.append("..")
+
+import os
+import time
+import tempfile
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from web_tool.DatasetPool import DatasetHandlePool
+
+
+def write_raster(fn):
+    with rasterio.open(fn, "w", driver="GTiff", width=8, height=8, count=1, dtype="uint8", crs="EPSG:3857", transform=from_origin(0, 8, 1, 1)) as f:
+        f.write(np.ones((1, 8, 8), dtype=np.uint8))
+
+
+def test_sweep_closes_handles_of_exited_and_idle_threads():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fn = os.path.join(tmp_dir, "test.tif")
+        write_raster(fn)
+
+        pool = DatasetHandlePool(max_idle_seconds=0.05, sweep_interval_seconds=3600)
+
+        handles = []
+        thread = threading.Thread(target=lambda: handles.append(pool.get(fn)))
+        thread.start()
+        thread.join()
+
+        with pool.open(fn) as f: # in use, so the sweep must leave it open even though it is idle
+            time.sleep(0.1)
+            pool.sweep()
+            assert handles[0].closed # the thread that opened it has exited
+            assert not f.closed
+            assert f.read().sum() == 64
+
+        time.sleep(0.1)
+        pool.sweep()
+        assert f.closed
+        assert len(pool._all_handles) == 1
+
+
+if __name__ == "__main__":
+    test_sweep_closes_handles_of_exited_and_idle_threads()
@@ -0,0 +1,59 @@
+import sys
+sys.path.append("..")
+
+import threading
+
+from web_tool.Jobs import Job, JobRunner
+
+
+def test_stop_cancels_queued_and_running_jobs():
+    started = threading.Event()
+    num_chunks_run = []
+
+    def run_chunks(job):
+        started.set()
+        for i in range(1000):
+            if job.cancel_event.is_set():
+                raise ValueError("Cancelled after %d chunks" % (i))
+            num_chunks_run.append(i)
+            job.cancel_event.wait(0.01)
+        return "done"
+
+    runner = JobRunner("test")
+    running_job = runner.submit(run_chunks)
+    queued_jobs = [runner.submit(run_chunks) for i in range(3)]
+    assert started.wait(5)
+
+    runner.stop()
+    for job in queued_jobs: # these never start
+        assert job.status == Job.CANCELLED
+        assert job.done_event.is_set()
+
+    assert running_job.done_event.wait(5)
+    assert running_job.status == Job.CANCELLED
+    assert running_job.result is None
+    assert len(num_chunks_run) < 1000
+
+    runner._thread.join(5)
+    assert not runner._thread.is_alive()
+    assert all([job.start_time is None for job in queued_jobs])
+
+    late_job = runner.submit(run_chunks)
+    assert late_job.status == Job.CANCELLED
+
+
+def test_failed_job_is_not_cancelled():
+    def fail(job):
+        raise ValueError("Something went wrong")
+
+    runner = JobRunner("test")
+    job = runner.submit(fail)
+    assert job.done_event.wait(5)
+    assert job.status == Job.FAILED
+    assert job.error == "Something went wrong"
+    runner.stop()
+
+
+if __name__ == "__main__":
+    test_stop_cancels_queued_and_running_jobs()
+    test_failed_job_is_not_cancelled()
@@ -0,0 +1,45 @@
+import sys
+sys.path.append("..")
+
+import zlib
+import struct
+
+import numpy as np
+
+from web_tool.Utils import get_palette, encode_paletted_png
+
+
+def read_chunks(png):
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = {}
+    offset = 8
+    while offset < len(png):
+        length, = struct.unpack(">I", png[offset:offset+4])
+        chunk_type = png[offset+4:offset+8]
+        data = png[offset+8:offset+8+length]
+        crc, = struct.unpack(">I", png[offset+8+length:offset+12+length])
+        assert crc == zlib.crc32(chunk_type + data) & 0xffffffff
+        chunks[chunk_type] = data
+        offset += 12 + length
+    return chunks
+
+
+def test_encode_paletted_png():
+    color_list = ["#0000FF", "#008000", "#80FF80", "#806060"]
+    palette = get_palette(color_list)
+    assert palette.tolist() == [[0, 0, 255], [0, 128, 0], [128, 255, 128], [128, 96, 96]]
+
+    class_idxs = np.random.randint(0, len(color_list), size=(37, 53)).astype(np.uint8)
+    chunks = read_chunks(encode_paletted_png(class_idxs, palette))
+
+    width, height, bit_depth, color_type, _, _, _ = struct.unpack(">IIBBBBB", chunks[b"IHDR"])
+    assert (width, height, bit_depth, color_type) == (53, 37, 8, 3)
+    assert chunks[b"PLTE"] == palette.tobytes()
+
+    raw = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(37, 54)
+    assert np.all(raw[:, 0] == 0)
+    assert np.array_equal(raw[:, 1:], class_idxs)
+
+
+if __name__ == "__main__":
+    test_encode_paletted_png()
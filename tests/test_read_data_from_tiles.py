@@ -0,0 +1,78 @@
+import sys
+sys.path.append("..")
+
+import os
+import tempfile
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import rasterio.windows
+
+from web_tool.DataLoader import read_data_from_tiles, read_windowed_data_from_tiles
+from web_tool.DatasetPool import DatasetHandlePool
+
+
+def write_tile(fn, data, transform, nodata=None):
+    with rasterio.open(fn, "w", driver="GTiff", width=data.shape[2], height=data.shape[1], count=data.shape[0], dtype=data.dtype,
+        crs="EPSG:32618", transform=transform, nodata=nodata) as f:
+        f.write(data)
+
+
+def test_mosaic_uses_masks_and_warps_off_grid_tiles():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The first tile covers the left half of the query with valid zeros (it doesn't have a nodata value)
+        left = np.zeros((1, 10, 5), dtype=np.uint8)
+        write_tile(os.path.join(tmp_dir, "left.tif"), left, from_origin(500000, 4000010, 1, 1))
+
+        # The second tile covers everything and is a fraction of a pixel off of the first tile's grid, so it is warped
+        right = np.full((1, 12, 12), 9, dtype=np.uint8)
+        write_tile(os.path.join(tmp_dir, "right.tif"), right, from_origin(499999.3, 4000010.7, 1, 1), nodata=255)
+
+        geometry = {
+            "type": "Polygon",
+            "coordinates": [[(500000.5, 4000000.5), (500009.5, 4000000.5), (500009.5, 4000009.5), (500000.5, 4000009.5), (500000.5, 4000000.5)]]
+        }
+        tile_fns = [os.path.join(tmp_dir, "left.tif"), os.path.join(tmp_dir, "right.tif")]
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            output = read_data_from_tiles(DatasetHandlePool(), executor, tile_fns, geometry, "epsg:32618")
+
+        assert output.data.shape == (10, 10, 1)
+        assert np.all(output.data[:, :5, 0] == 0) # valid zeros from the first tile are kept
+        assert np.all(output.data[:, 5:, 0] == 9) # everything outside of the first tile comes from the second
+
+
+def test_windowed_read_matches_full_read():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data = np.random.randint(1, 255, size=(3, 40, 30)).astype(np.uint8)
+        write_tile(os.path.join(tmp_dir, "a.tif"), data[:, :, :20], from_origin(500000, 4000040, 1, 1))
+        write_tile(os.path.join(tmp_dir, "b.tif"), data[:, :, 15:], from_origin(500015, 4000040, 1, 1))
+
+        geometry = { # a triangle, so that pixels outside of it are masked
+            "type": "Polygon",
+            "coordinates": [[(500002.3, 4000001.2), (500028.7, 4000003.5), (500010.1, 4000038.9), (500002.3, 4000001.2)]]
+        }
+        tile_fns = [os.path.join(tmp_dir, "a.tif"), os.path.join(tmp_dir, "b.tif")]
+        handle_pool = DatasetHandlePool()
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            expected = read_data_from_tiles(handle_pool, executor, tile_fns, geometry, "epsg:32618")
+            windowed_raster = read_windowed_data_from_tiles(handle_pool, executor, tile_fns, geometry, "epsg:32618")
+
+            assert windowed_raster.transform == expected.transform
+            assert (windowed_raster.height, windowed_raster.width) == expected.data.shape[:2]
+            output = np.zeros_like(expected.data)
+            for row_start in range(0, windowed_raster.height, 8):
+                for col_start in range(0, windowed_raster.width, 8):
+                    window = rasterio.windows.Window(
+                        col_start, row_start, min(8, windowed_raster.width - col_start), min(8, windowed_raster.height - row_start)
+                    )
+                    output[window.toslices()] = windowed_raster.read(window)
+
+        assert np.array_equal(output, expected.data)
+
+
+if __name__ == "__main__":
+    test_mosaic_uses_masks_and_warps_off_grid_tiles()
+    test_windowed_read_matches_full_read()
@@ -0,0 +1,52 @@
+import sys
+sys.path.append("..")
+
+import numpy as np
+import rasterio.transform
+import rasterio.warp
+
+from web_tool.DataLoader import InMemoryRaster, ReprojectionPlan, get_3857_grid, get_reprojection_plan, warp_data_to_3857
+
+
+def test_reprojection_plan_matches_gdal():
+    transform = rasterio.transform.from_origin(440000, 4318000, 1, 1)
+    data = np.random.randint(1, 255, size=(300, 280, 4)).astype(np.uint8)
+    raster = InMemoryRaster(data, "epsg:26918", transform, (440000, 4317700, 440280, 4318000))
+
+    dst_transform, width, height, _ = get_3857_grid(raster)
+    expected = np.zeros((4, height, width), dtype=np.uint8)
+    rasterio.warp.reproject(
+        source=np.rollaxis(data.copy(), 2, 0),
+        destination=expected,
+        src_transform=transform,
+        src_crs=raster.crs,
+        dst_transform=dst_transform,
+        dst_crs="epsg:3857",
+        resampling=rasterio.warp.Resampling.nearest
+    )
+
+    plan = ReprojectionPlan(raster.crs, transform, 280, 300, "epsg:3857", dst_transform, width, height)
+    output = plan.apply(data)
+    assert output.shape == (height, width, 4)
+    assert np.array_equal(output, np.rollaxis(expected, 0, 3))
+
+
+def test_reprojection_plan_built_on_second_request():
+    transform = rasterio.transform.from_origin(441000, 4318000, 1, 1)
+    data = np.random.randint(1, 255, size=(120, 100, 3)).astype(np.uint8)
+    raster = InMemoryRaster(data, "epsg:26918", transform, (441000, 4317880, 441100, 4318000))
+
+    first_output = warp_data_to_3857(raster)
+    assert get_reprojection_plan(raster) is not None
+    second_output = warp_data_to_3857(raster)
+    assert np.array_equal(first_output.data, second_output.data)
+    assert first_output.transform == second_output.transform
+
+    # same transform and shape but different bounds is a different grid
+    shifted_raster = InMemoryRaster(data, "epsg:26918", transform, (441000, 4317880, 441101, 4318000))
+    assert get_reprojection_plan(shifted_raster) is None
+
+
+if __name__ == "__main__":
+    test_reprojection_plan_matches_gdal()
+    test_reprojection_plan_built_on_second_request()
@@ -0,0 +1,221 @@
+import sys
+sys.path.append("..")
+
+import time
+import types
+import threading
+
+import pytest
+
+import web_tool.SessionHandler as SessionHandlerModule
+from web_tool.Session import Session
+
+
+MODEL_CONFIGS = {
+    "keras": {"type": "keras_example"},
+    "torch": {"type": "pytorch_example"},
+    "torch_with_heads": {"type": "pytorch_example", "supportsSharedWorker": True}
+}
+
+
+class FakeProcess():
+
+    def __init__(self):
+        self.killed = False
+        self.waited = False
+
+    def kill(self):
+        self.killed = True
+
+    def poll(self):
+        return -9 if self.killed else None
+
+    def wait(self):
+        self.waited = True
+
+
+def make_session_handler(monkeypatch, **kwargs):
+    '''Returns a `SessionHandler` whose `_create_session()` registers a `Session` without starting a worker.
+    '''
+    monkeypatch.setattr(SessionHandlerModule, "load_models", lambda: MODEL_CONFIGS)
+    monkeypatch.setattr(SessionHandlerModule, "is_valid_dataset", lambda dataset_key: True)
+    session_handler = SessionHandlerModule.SessionHandler(types.SimpleNamespace(**kwargs))
+
+    def create_session(session_id, worker, model_key, checkpoint_idx):
+        with session_handler._lock:
+            session_handler._SESSION_MAP[session_id] = Session(session_id, None)
+            session_handler._SESSION_INFO[session_id] = {"worker": worker, "process": FakeProcess(), "shared": False}
+    session_handler._create_session = create_session
+    return session_handler
+
+
+def test_shared_workers_only_for_models_that_support_them(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, shared_workers=True, max_cpu_workers=1, admission_policy="reject")
+    assert session_handler._uses_shared_worker("keras")
+    assert session_handler._uses_shared_worker("torch_with_heads")
+    assert not session_handler._uses_shared_worker("torch")
+    assert session_handler.warm_worker_model_keys == ["torch"]
+
+    # Sessions of models with heads don't need a worker of their own, so they aren't limited by `max_cpu_workers`
+    assert session_handler.create_session("a", "dataset", "keras", -1)["status"] == "active"
+    assert session_handler.create_session("b", "dataset", "keras", -1)["status"] == "active"
+    assert len(session_handler._cpu_worker_memory) == 0
+
+    # The other models fall back to a worker per session, which is subject to admission control
+    assert session_handler.create_session("c", "dataset", "torch", -1)["status"] == "active"
+    assert session_handler.create_session("d", "dataset", "torch", -1)["status"] == "rejected"
+    assert list(session_handler._cpu_worker_memory.keys()) == ["c"]
+
+
+def test_queue_policy(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=2, admission_policy="queue")
+    results = [session_handler.create_session(session_id, "dataset", "torch", -1) for session_id in ["a", "b", "c", "d"]]
+    assert [result["status"] for result in results] == ["active", "active", "queued", "queued"]
+    assert results[3]["queuePosition"] == 1
+    assert session_handler.get_queue_position("a") is None
+    assert session_handler.get_queue_position("c") == 0
+    assert session_handler.get_queue_position("d") == 1
+
+    # Killing a session makes room for the first session in the queue
+    session_handler.kill_session("a")
+    session_handler._admit_queued_sessions()
+    assert session_handler.is_active("c")
+    assert not session_handler.is_active("d")
+    assert session_handler.get_queue_position("d") == 0
+    assert sorted(session_handler._cpu_worker_memory.keys()) == ["b", "c"]
+
+    # New sessions don't jump the queue even if there is room for them
+    session_handler.kill_session("b")
+    assert session_handler.create_session("e", "dataset", "torch", -1) == {"status": "queued", "queuePosition": 1}
+
+
+def test_queued_sessions_are_dropped_when_clients_stop_polling(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=1, admission_policy="queue")
+    session_handler.create_session("a", "dataset", "torch", -1)
+    session_handler.create_session("b", "dataset", "torch", -1)
+    session_handler.create_session("c", "dataset", "torch", -1)
+
+    session_handler._admission_queue["b"]["last_poll_time"] = time.time() - SessionHandlerModule.QUEUED_SESSION_TIMEOUT_SECONDS - 1
+    session_handler.get_queue_position("c") # polling keeps "c" in the queue
+    session_handler._admit_queued_sessions()
+    assert session_handler.get_queue_position("b") is None
+    assert session_handler.get_queue_position("c") == 0
+
+    session_handler.kill_session("a")
+    session_handler._admit_queued_sessions()
+    assert session_handler.is_active("c")
+    assert not session_handler.is_active("b")
+
+
+def test_reject_policy(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=2, admission_policy="reject")
+    results = [session_handler.create_session(session_id, "dataset", "torch", -1) for session_id in ["a", "b", "c"]]
+    assert [result["status"] for result in results] == ["active", "active", "rejected"]
+    assert not session_handler.is_active("c")
+    assert session_handler.get_queue_position("c") is None
+
+    session_handler.kill_session("a")
+    assert session_handler.create_session("c", "dataset", "torch", -1)["status"] == "active"
+
+
+def test_preempt_policy_kills_idlest_sessions_without_holding_the_lock(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=2, admission_policy="preempt")
+    session_handler.create_session("a", "dataset", "torch", -1)
+    session_handler.create_session("b", "dataset", "torch", -1)
+    session_handler.get_session("a").last_interaction_time = time.time() - 10 # "a" is the idlest
+
+    killed_session_ids = []
+    kill_session = session_handler.kill_session
+    def checked_kill_session(session_id):
+        lock_is_free = []
+        def check_lock():
+            lock_is_free.append(session_handler._lock.acquire(blocking=False))
+            if lock_is_free[0]:
+                session_handler._lock.release()
+        checker = threading.Thread(target=check_lock)
+        checker.start()
+        checker.join()
+        assert lock_is_free == [True]
+        killed_session_ids.append(session_id)
+        kill_session(session_id)
+    session_handler.kill_session = checked_kill_session
+
+    assert session_handler.create_session("c", "dataset", "torch", -1)["status"] == "active"
+    assert killed_session_ids == ["a"]
+    assert session_handler.is_expired("a")
+    assert session_handler.is_active("b") and session_handler.is_active("c")
+
+
+def test_kill_session_cancels_running_jobs_before_killing_the_worker(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=1, admission_policy="reject")
+    session_handler.create_session("a", "dataset", "torch", -1)
+    process = session_handler._SESSION_INFO["a"]["process"]
+    started = threading.Event()
+    kill_times = []
+    process.kill = lambda: kill_times.append(time.time())
+
+    def run_chunks(job):
+        started.set()
+        while not job.cancel_event.wait(0.01):
+            pass
+        time.sleep(0.1) # finishing the current chunk
+        raise ValueError("Cancelled")
+
+    job = session_handler.get_session("a").job_runner.submit(run_chunks)
+    assert started.wait(5)
+    session_handler.kill_session("a")
+    assert job.done_event.is_set()
+    assert len(kill_times) == 1 and kill_times[0] >= job.finish_time
+
+
+def test_warm_workers_count_against_the_limits_and_make_way_for_sessions(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_cpu_workers=2, admission_policy="reject", num_warm_workers=1, warm_worker_model_keys=["torch", "keras"])
+    session_handler._start_warm_worker = lambda model_key: {"process": FakeProcess(), "model": None}
+    session_handler._top_up_warm_workers()
+    keras_worker = session_handler._warm_workers["keras"][0]
+    assert len(session_handler._cpu_worker_memory) == 2
+
+    # "a" takes over the capacity of the warm "torch" worker, which can't be replaced while we are at the limit
+    assert session_handler.create_session("a", "dataset", "torch", -1)["status"] == "active"
+    assert "a" in session_handler._reserved_warm_workers
+    session_handler._top_up_warm_workers()
+    assert session_handler._warm_workers["torch"] == []
+    assert sorted(session_handler._cpu_worker_memory.keys(), key=str) == [("warm", 2), "a"]
+
+    # The warm "keras" worker is killed to make room for "b", but sessions aren't
+    assert session_handler.create_session("b", "dataset", "torch", -1)["status"] == "active"
+    assert keras_worker["process"].killed
+    assert session_handler._warm_workers["keras"] == []
+    assert session_handler.create_session("c", "dataset", "torch", -1)["status"] == "rejected"
+    assert sorted(session_handler._cpu_worker_memory.keys()) == ["a", "b"]
+
+
+def test_workers_are_killed_if_we_cannot_connect_to_them(monkeypatch):
+    session_handler = make_session_handler(monkeypatch)
+    processes = []
+    def spawn_local_worker(gpu_id, model_key, **kwargs):
+        processes.append(FakeProcess())
+        return processes[-1], 1
+    def connect(gpu_id, **kwargs):
+        raise ConnectionRefusedError()
+    session_handler._spawn_local_worker = spawn_local_worker
+    monkeypatch.setattr(SessionHandlerModule, "ModelSessionRPC", connect)
+
+    assert session_handler._start_warm_worker("torch") is None
+    with pytest.raises(ConnectionRefusedError):
+        SessionHandlerModule.SessionHandler._create_session(session_handler, "a", {"type": "local", "gpu_id": -1}, "torch", -1)
+    assert len(processes) == 2
+    assert all([process.killed and process.waited for process in processes])
+
+
+def test_preempt_policy_queues_if_preempting_would_not_make_room(monkeypatch):
+    session_handler = make_session_handler(monkeypatch, max_worker_memory_mb=3000, worker_memory_mb=2000, admission_policy="preempt")
+    assert session_handler.create_session("a", "dataset", "torch", -1)["status"] == "active"
+
+    monkeypatch.setitem(MODEL_CONFIGS["torch"], "workerMemoryMB", 4000) # more than the limit, so killing "a" wouldn't help
+    assert session_handler.create_session("b", "dataset", "torch", -1)["status"] == "queued"
+    assert session_handler.is_active("a")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
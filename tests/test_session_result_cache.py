@@ -0,0 +1,19 @@
+import sys
+sys.path.append("..")
+
+from web_tool.Session import Session
+
+
+def test_results_of_an_older_model_version_are_not_cached():
+    session = Session("a", None)
+    version = session.model_version.value
+    session._increment_model_version() # e.g. the model was retrained while the result was being rendered
+    session.set_cached_result("key", version, {"output": "stale"})
+    assert session.get_cached_result("key") is None
+
+    session.set_cached_result("key", session.model_version.value, {"output": "fresh"})
+    assert session.get_cached_result("key") == {"output": "fresh"}
+
+
+if __name__ == "__main__":
+    test_results_of_an_older_model_version_are_not_cached()
@@ -0,0 +1,48 @@
+import sys
+sys.path.append("..")
+
+import os
+import types
+import tempfile
+
+import numpy as np
+
+import web_tool.Utils as Utils
+
+
+def test_falls_back_to_disk_when_shared_memory_is_short(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        monkeypatch.setattr(Utils, "SHARED_ARRAY_RAM_DIR", os.path.join(tmp_dir, "ram"))
+        monkeypatch.setattr(Utils, "SHARED_ARRAY_DISK_DIR", os.path.join(tmp_dir, "disk"))
+        array = np.arange(1000, dtype=np.float32).reshape(10, 100)
+
+        monkeypatch.setattr(Utils.os, "statvfs", lambda path: types.SimpleNamespace(f_bavail=2**30, f_frsize=1))
+        handle = Utils.write_shared_array(array)
+        assert os.path.dirname(handle[0]) == Utils.SHARED_ARRAY_RAM_DIR
+        assert np.array_equal(Utils.read_shared_array(handle), array)
+        assert not os.path.exists(handle[0])
+
+        monkeypatch.setattr(Utils.os, "statvfs", lambda path: types.SimpleNamespace(f_bavail=Utils.SHARED_ARRAY_RAM_HEADROOM_BYTES, f_frsize=1))
+        handle = Utils.write_shared_array(array)
+        assert os.path.dirname(handle[0]) == Utils.SHARED_ARRAY_DISK_DIR
+        assert np.array_equal(Utils.read_shared_array(handle), array)
+        assert not os.path.exists(handle[0])
+
+
+def test_clear_shared_arrays_only_deletes_files_of_dead_processes(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        monkeypatch.setattr(Utils, "SHARED_ARRAY_RAM_DIR", os.path.join(tmp_dir, "ram"))
+        monkeypatch.setattr(Utils, "SHARED_ARRAY_DISK_DIR", os.path.join(tmp_dir, "disk"))
+        handle = Utils.write_shared_array(np.ones((4, 4)), directory=Utils.SHARED_ARRAY_DISK_DIR)
+        dead_path = os.path.join(Utils.SHARED_ARRAY_DISK_DIR, "%d_dead.dat" % (2**22 + 1)) # above the largest PID Linux hands out
+        open(dead_path, "wb").close()
+
+        Utils.clear_shared_arrays()
+        assert os.path.exists(handle[0])
+        assert not os.path.exists(dead_path)
+        Utils.delete_shared_array(handle)
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
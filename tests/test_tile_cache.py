@@ -0,0 +1,27 @@
+import sys
+sys.path.append("..")
+
+import tempfile
+
+import numpy as np
+
+from web_tool.TileFetcher import TileCache
+
+
+def test_overwriting_a_tile_counts_its_size_once():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = TileCache(tmp_dir, 2**20)
+        img = np.zeros((256, 256, 3), dtype=np.uint8)
+
+        cache.put("http://example.com/1/0/0.png", img)
+        size = cache._current_bytes
+        cache.put("http://example.com/1/0/0.png", img) # e.g. two threads fetched the same tile
+        assert cache._current_bytes == size
+
+        cache.put("http://example.com/1/0/1.png", img)
+        assert cache._current_bytes == 2 * size
+        assert np.array_equal(cache.get("http://example.com/1/0/0.png"), img)
+
+
+if __name__ == "__main__":
+    test_overwriting_a_tile_counts_its_size_once()
@@ -0,0 +1,39 @@
+import sys
+sys.path.append("..")
+
+import tempfile
+
+import numpy as np
+import shapely.geometry
+
+from web_tool.TileCatalog import TileCatalog
+
+
+def test_tile_catalog_round_trip():
+    tiles = [
+        ("m_3807537_ne_18_1_20170611.tif", shapely.geometry.box(-75.6875, 38.9375, -75.625, 39.0)),
+        ("m_3807537_nw_18_1_20170611.tif", shapely.geometry.box(-75.75, 38.9375, -75.6875, 39.0)),
+        ("v2/m_3807538_sw_18_1_20170611.tif", shapely.geometry.Polygon([(-75.625, 38.875), (-75.5625, 38.875), (-75.6, 38.9375)])),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        assert not TileCatalog.exists(directory)
+        assert TileCatalog.write(directory, tiles) == 3
+        assert TileCatalog.exists(directory)
+
+        catalog = TileCatalog(directory)
+        assert len(catalog) == 3
+        for i, (fn, geom) in enumerate(tiles):
+            assert catalog[i][0] == fn
+            assert catalog[i][1].equals(geom)
+            assert np.allclose(catalog.bounds[i], geom.bounds)
+
+        try:
+            catalog[3]
+            assert False, "Expected a KeyError for an out of range tile"
+        except KeyError:
+            pass
+
+
+if __name__ == "__main__":
+    test_tile_catalog_round_trip()
@@ -4,37 +4,51 @@
 #
 # Copyright © 2018 Caleb Robinson <calebrob6@gmail.com>
 #
-'''Script for creating the rtree spatial index used in `DataLoader.py`
+'''Script for creating the rtree spatial index and tile catalog used by the `TileIndex` classes in `DataLoader.py`
+
+The input is a shapefile (or anything else fiona can read) of tile footprints with a "fn" property. The output directory will contain
+"tile_index.dat" / "tile_index.idx" (the rtree index) and the "catalog_*" files of a `TileCatalog` (see `web_tool/TileCatalog.py`).
 '''
 import sys
 import os
 import time
+import argparse
 
 import fiona
 import shapely.geometry
 import rtree
 
-import pickle
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from web_tool.TileCatalog import TileCatalog
+
+parser = argparse.ArgumentParser(description="Tile index creation script")
+parser.add_argument("input_fn", action="store", type=str, help="Path to the file containing the tile footprints")
+parser.add_argument("--output_dir", action="store", type=str, help="Directory to write the spatial index and tile catalog to", default="data/tile_index/naip/")
+args = parser.parse_args(sys.argv[1:])
 
 tic = float(time.time())
-print("Creating spatial index and pickling tile name dictionary")
-tile_index = rtree.index.Index("data/tile_index")
-tiles = {}
-f = fiona.open(sys.argv[1], "r")
-count = 0
+print("Loading tile footprints")
+tiles = []
+f = fiona.open(args.input_fn, "r")
 for feature in f:
-    if count % 10000 == 0:
-        print("Loaded %d shapes..." % (count))
+    if len(tiles) % 10000 == 0:
+        print("Loaded %d shapes..." % (len(tiles)))
 
     fid = feature["properties"]["fn"]
     geom = shapely.geometry.shape(feature["geometry"])
-    tile_index.insert(count, geom.bounds)
-    tiles[count] = (fid, geom)
-
-    count += 1
+    tiles.append((fid, geom))
 f.close()
-tile_index.close()
 
-pickle.dump(tiles, open("data/tiles.p", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+print("Writing tile catalog")
+os.makedirs(args.output_dir, exist_ok=True)
+TileCatalog.write(args.output_dir, tiles)
+
+print("Creating spatial index")
+catalog = TileCatalog(args.output_dir)
+tile_index = rtree.index.Index(
+    os.path.join(args.output_dir, "tile_index"),
+    ((i, tuple(catalog.bounds[i]), None) for i in range(len(catalog))) # bulk loading is much faster than inserting one tile at a time
+)
+tile_index.close()
 
-print("Finished creating spatial index in %0.4f seconds" % (time.time() - tic))
\ No newline at end of file
+print("Finished creating spatial index in %0.4f seconds" % (time.time() - tic))
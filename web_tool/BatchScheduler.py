@@ -0,0 +1,173 @@
+import time
+import threading
+import collections
+
+import numpy as np
+
+import logging
+LOGGER = logging.getLogger("server")
+
+
+class _BatchRequest():
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.offset = 0 # how many of `inputs` have been put into a batch so far
+        self.outputs = [] # one list of output chunks per model output
+        self.num_done = 0
+        self.error = None
+        self.done_event = threading.Event()
+
+
+class BatchScheduler():
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=10, stats_interval_seconds=60):
+        """Collects the windows that concurrent `predict()` calls want to run through a model into shared batches, so that a worker that
+        serves many sessions (see `worker.py --shared`) runs one forward pass for all of them instead of one per session.
+
+        The first window that arrives starts a batch, the batch is run as soon as it holds `max_batch_size` windows or `max_wait_ms` have
+        passed, whichever happens first. Requests that are larger than `max_batch_size` are split over several batches. All calls to
+        `predict_fn` happen on the scheduler's thread.
+
+        Args:
+            predict_fn (function): Called with a `(N, ...)` array of windows, returns a list of `(N, ...)` arrays (one per model output)
+            max_batch_size (int, optional): The most windows to run through `predict_fn` at once. Defaults to 64.
+            max_wait_ms (int, optional): How long to wait for other requests to fill a batch. Defaults to 10.
+            stats_interval_seconds (int, optional): How often to log the stats for the last interval, 0 disables this. Defaults to 60.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.stats_interval_seconds = stats_interval_seconds
+
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+
+        self._num_batches = 0
+        self._num_windows = 0
+        self._num_requests = 0
+        self._max_queue_depth = 0
+        self._last_stats_time = time.time() # when `_log_stats()` last ran, only used by the scheduler's thread
+        self._last_logged_stats = {"numBatches": 0, "numWindows": 0}
+
+        self._thread = threading.Thread(target=self._run, name="BatchScheduler", daemon=True)
+        self._thread.start()
+
+    def predict(self, inputs):
+        """Runs `inputs`, a `(N, ...)` array of windows, through `predict_fn` as part of one or more shared batches and blocks until the
+        results are ready.
+
+        Returns:
+            A list with one `(N, ...)` array per model output, in the same order as `inputs`.
+        """
+        if inputs.shape[0] == 0:
+            raise ValueError("Need at least one window to predict on")
+        request = _BatchRequest(inputs)
+
+        with self._condition:
+            self._pending.append(request)
+            self._num_requests += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue_depth())
+            self._condition.notify()
+
+        request.done_event.wait()
+        if request.error is not None:
+            raise request.error
+        return [np.concatenate(chunks, axis=0) for chunks in request.outputs]
+
+    def get_stats(self):
+        """Returns a dict with the number of windows that are waiting to be run (`queueDepth`), the most that have ever been waiting
+        (`maxQueueDepth`), the number of requests, batches and windows that have been run, and how full the batches were on average
+        (`meanBatchFill`, a fraction of `max_batch_size`). The counts are totals since the scheduler was created, so that callers (e.g. the
+        periodic log and `/whoami`) don't interfere with each other, diff two calls to get the stats for an interval.
+        """
+        with self._condition:
+            return {
+                "queueDepth": self._queue_depth(),
+                "maxQueueDepth": self._max_queue_depth,
+                "numRequests": self._num_requests,
+                "numBatches": self._num_batches,
+                "numWindows": self._num_windows,
+                "meanBatchSize": self._num_windows / self._num_batches if self._num_batches > 0 else 0,
+                "meanBatchFill": self._num_windows / (self._num_batches * self.max_batch_size) if self._num_batches > 0 else 0
+            }
+
+    def _log_stats(self):
+        stats = self.get_stats()
+        num_batches = stats["numBatches"] - self._last_logged_stats["numBatches"]
+        num_windows = stats["numWindows"] - self._last_logged_stats["numWindows"]
+        LOGGER.info("BatchScheduler - %d batches with %d windows (mean fill %0.2f) in the last %d seconds, totals %s" % (
+            num_batches, num_windows, num_windows / (num_batches * self.max_batch_size) if num_batches > 0 else 0,
+            time.time() - self._last_stats_time, stats
+        ))
+        self._last_logged_stats = stats
+        self._last_stats_time = time.time()
+
+    def _queue_depth(self):
+        return sum([request.inputs.shape[0] - request.offset for request in self._pending])
+
+    def _take_batch(self):
+        """Waits until there is a batch to run, then removes up to `max_batch_size` windows from the front of the queue. Returns the batch and
+        a list of `(request, num_windows)` that says who the windows belong to.
+        """
+        with self._condition:
+            while len(self._pending) == 0:
+                self._condition.wait()
+
+            deadline = time.time() + self.max_wait_ms / 1000.0
+            while self._queue_depth() < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            parts = []
+            owners = []
+            num_windows = 0
+            while len(self._pending) > 0 and num_windows < self.max_batch_size:
+                request = self._pending[0]
+                count = min(request.inputs.shape[0] - request.offset, self.max_batch_size - num_windows)
+                parts.append(request.inputs[request.offset:request.offset+count])
+                owners.append((request, count))
+                request.offset += count
+                num_windows += count
+                if request.offset == request.inputs.shape[0]:
+                    self._pending.popleft()
+
+        if len(parts) == 1:
+            return parts[0], owners
+        return np.concatenate(parts, axis=0), owners
+
+    def _run(self):
+        while True:
+            batch, owners = self._take_batch()
+
+            error = None
+            try:
+                outputs = self.predict_fn(batch)
+            except Exception as e:
+                LOGGER.error("BatchScheduler - predict_fn failed on a batch of %d windows: %s" % (batch.shape[0], e))
+                error = e
+
+            offset = 0
+            for request, count in owners:
+                if error is not None:
+                    request.error = error
+                elif request.error is None:
+                    if len(request.outputs) == 0:
+                        request.outputs = [[] for _ in outputs]
+                    for i, output in enumerate(outputs):
+                        request.outputs[i].append(output[offset:offset+count])
+                offset += count
+                request.num_done += count
+                if request.num_done == request.inputs.shape[0]:
+                    request.done_event.set()
+
+            with self._condition:
+                self._num_batches += 1
+                self._num_windows += batch.shape[0]
+                log_stats = self.stats_interval_seconds > 0 and time.time() - self._last_stats_time > self.stats_interval_seconds
+            if log_stats:
+                self._log_stats()
@@ -1,16 +1,19 @@
 import os
+import math
+import functools
+import threading
+import concurrent.futures
 
 import numpy as np
 from enum import Enum
 
-from urllib.request import urlopen
-
 import fiona
 import fiona.transform
 import fiona.crs
 
 import shapely
 import shapely.geometry
+import shapely.prepared
 
 import rasterio
 import rasterio.warp
@@ -18,18 +21,27 @@ import rasterio.crs
 import rasterio.io
 import rasterio.mask
 import rasterio.transform
-import rasterio.merge
+import rasterio.windows
+import rasterio.features
+import rasterio.vrt
+import rasterio.enums
 
 import rtree
 
 import mercantile
 import utm
 
-import cv2
 import pickle
 
+import logging
+LOGGER = logging.getLogger("server")
+
 from . import ROOT_DIR
 from .DataLoaderAbstract import DataLoader
+from .DatasetPool import DatasetHandlePool
+from .TileCatalog import TileCatalog
+from .TileFetcher import TileFetcher, TILE_SIZE
+from .Utils import LRUCache
 
 NAIP_BLOB_ROOT = 'https://naipblobs.blob.core.windows.net/naip'
 LC_BLOB_ROOT =  'https://modeloutput.blob.core.windows.net/full-usa-output'
@@ -61,6 +73,39 @@ class InMemoryRaster(object):
         #right, bottom = dst_transform * (width, height)
 
 
+class WindowedRaster(object):
+
+    def __init__(self, crs, transform, bounds, width, height, read_fn):
+        """A raster whose data is read one window at a time, for rasters that can be too large to hold in memory (e.g. the input of `/predTile`).
+
+        Args:
+            crs (str): The EPSG code describing the coordinate system of this raster (e.g. "epsg:4326")
+            transform (affine.Affine): An affine transformation for converting to/from pixel and global coordinates
+            bounds (tuple): A tuple in the format (left, bottom, right, top) / (xmin, ymin, xmax, ymax) describing the boundary of the raster data in the units of `crs`
+            width, height (int): The size of the raster in pixels
+            read_fn (function): Called with a `rasterio.windows.Window` inside of the raster, returns the data of the window formatted as "channels last"
+        """
+        self.crs = crs
+        self.transform = transform
+        self.bounds = bounds
+        self.width = width
+        self.height = height
+        self.read_fn = read_fn
+
+    def read(self, window):
+        """Returns the data in `window`, with shape (window.height, window.width, number of channels).
+        """
+        return self.read_fn(window)
+
+    @staticmethod
+    def from_in_memory_raster(input_raster):
+        height, width, _ = input_raster.shape
+        return WindowedRaster(
+            input_raster.crs, input_raster.transform, input_raster.bounds, width, height,
+            lambda window: input_raster.data[window.toslices()]
+        )
+
+
 # ------------------------------------------------------
 # Miscellaneous methods
 # ------------------------------------------------------
@@ -91,47 +136,154 @@ def extent_to_transformed_geom(extent, dst_crs):
         return fiona.transform.transform_geom(src_crs, dst_crs, geom)
 
 
-def warp_data_to_3857(input_raster):
-    """Warps an input raster to EPSG:3857
-
-    Args:
-        input_raster (InMemoryRaster): An (in memory) raster datasource to warp
-
-    Returns:
-        output_raster (InMemoryRaster): The warped version of `input_raster`
-    """
-    src_height, src_width, num_channels = input_raster.shape
-    src_img_tmp = np.rollaxis(input_raster.data.copy(), 2, 0) # convert image to "channels first" format
-
-    x_res, y_res = input_raster.transform[0], -input_raster.transform[4] # the pixel resolution of the raster is given by the affine transformation
+@functools.lru_cache(maxsize=1024)
+def _get_3857_grid(src_crs, src_transform, src_bounds, src_width, src_height):
+    x_res, y_res = src_transform[0], -src_transform[4] # the pixel resolution of the raster is given by the affine transformation
     if x_res < 1 and y_res < 1:
         x_res = 1
         y_res = 1
 
     dst_crs = "epsg:3857"
-    dst_bounds = rasterio.warp.transform_bounds(input_raster.crs, dst_crs, *input_raster.bounds)
+    dst_bounds = rasterio.warp.transform_bounds(src_crs, dst_crs, *src_bounds)
     dst_transform, width, height = rasterio.warp.calculate_default_transform(
-        input_raster.crs,
+        src_crs,
         dst_crs,
         width=src_width, height=src_height,
-        left=input_raster.bounds[0],
-        bottom=input_raster.bounds[1],
-        right=input_raster.bounds[2],
-        top=input_raster.bounds[3],
+        left=src_bounds[0],
+        bottom=src_bounds[1],
+        right=src_bounds[2],
+        top=src_bounds[3],
         resolution=(x_res, y_res) # TODO: we use the resolution of the src_input, while this parameter needs the resolution of the destination. This will break if src_crs units are degrees instead of meters.
     )
+    return dst_transform, width, height, dst_bounds
 
-    dst_image = np.zeros((num_channels, height, width), np.float32)
-    dst_image, dst_transform = rasterio.warp.reproject(
-        source=src_img_tmp,
-        destination=dst_image,
-        src_transform=input_raster.transform,
-        src_crs=input_raster.crs,
-        dst_transform=dst_transform,
-        dst_crs=dst_crs,
-        resampling=rasterio.warp.Resampling.nearest
-    )
-    dst_image = np.rollaxis(dst_image, 0, 3) # convert image to "channels last" format
+
+def get_3857_grid(input_raster):
+    """Returns the grid that `warp_data_to_3857()` will warp `input_raster` onto. This only depends on the CRS, transform and shape of the
+    raster (not on its data) so it is cached; rasters of the same extent, e.g. the input and output of a model, share the cache entry.
+
+    Args:
+        input_raster (InMemoryRaster): An (in memory) raster datasource
+
+    Returns:
+        dst_transform (affine.Affine): The transform of the warped raster
+        width, height (int): The size of the warped raster
+        dst_bounds (tuple): The bounds of `input_raster` in EPSG:3857
+    """
+    src_height, src_width, _ = input_raster.shape
+    return _get_3857_grid(str(input_raster.crs), input_raster.transform, tuple(input_raster.bounds), src_width, src_height)
+
+
+class ReprojectionPlan(object):
+
+    def __init__(self, src_crs, src_transform, src_width, src_height, dst_crs, dst_transform, dst_width, dst_height):
+        """A precomputed nearest neighbor reprojection from one pixel grid to another. For every destination pixel we store the (flat) index
+        of the source pixel that GDAL's nearest neighbor resampling would copy into it, so applying the plan is a single `np.take()`.
+
+        The index map is computed by letting GDAL warp an image whose values are the pixel indices, so applying a plan gives exactly the same
+        output as `rasterio.warp.reproject(..., resampling=Resampling.nearest)` with a destination that is initialized to 0.
+
+        Args:
+            src_crs, src_transform, src_width, src_height: The source grid
+            dst_crs, dst_transform, dst_width, dst_height: The destination grid
+        """
+        self.dst_transform = dst_transform
+        self.dst_width = dst_width
+        self.dst_height = dst_height
+
+        assert src_width * src_height < 2**31, "The source raster is too large to index with int32"
+        src_idxs = np.arange(src_width * src_height, dtype=np.int32).reshape(1, src_height, src_width)
+        dst_idxs = np.full((1, dst_height, dst_width), -1, dtype=np.int32)
+        rasterio.warp.reproject(
+            source=src_idxs,
+            destination=dst_idxs,
+            src_transform=src_transform,
+            src_crs=src_crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            dst_nodata=-1,
+            resampling=rasterio.warp.Resampling.nearest
+        )
+        dst_idxs = dst_idxs.reshape(-1)
+
+        self.outside_idxs = np.flatnonzero(dst_idxs < 0) # destination pixels that aren't covered by the source
+        dst_idxs[self.outside_idxs] = 0
+        self.idxs = dst_idxs
+
+        self.nbytes = self.idxs.nbytes + self.outside_idxs.nbytes
+
+    def apply(self, data):
+        """Reprojects `data`, a "channels last" array on the source grid, onto the destination grid.
+        """
+        num_channels = data.shape[2]
+        dst_image = np.take(data.reshape(-1, num_channels), self.idxs, axis=0)
+        dst_image[self.outside_idxs] = 0
+        return dst_image.reshape(self.dst_height, self.dst_width, num_channels)
+
+
+REPROJECTION_PLAN_CACHE = LRUCache(512 * 2**20, lambda plan: plan.nbytes)
+REPROJECTION_PLAN_SEEN_GRIDS = LRUCache(4096, lambda _: 1) # grids that have been warped once, a plan is only built the second time
+REPROJECTION_PLAN_MAX_PIXELS = 8192 * 8192 # warps with larger outputs than this go straight to GDAL instead of building a plan
+
+
+def get_reprojection_plan(input_raster):
+    """Returns the (cached) `ReprojectionPlan` from the grid of `input_raster` to its EPSG:3857 grid (see `get_3857_grid()`), or None if
+    the output would be larger than `REPROJECTION_PLAN_MAX_PIXELS` or if this is the first time that we see this grid. Building a plan costs
+    more than a single GDAL warp, so we only build one for grids that are requested repeatedly.
+
+    Plans are keyed by the same CRS, transform, bounds and shape that `get_3857_grid()` is keyed by, so a cached plan always warps onto the
+    grid that `get_3857_grid()` returns for `input_raster`.
+    """
+    dst_transform, width, height, _ = get_3857_grid(input_raster)
+    if width * height > REPROJECTION_PLAN_MAX_PIXELS:
+        return None
+
+    src_height, src_width, _ = input_raster.shape
+    key = (str(input_raster.crs), input_raster.transform, tuple(input_raster.bounds), src_width, src_height)
+    plan = REPROJECTION_PLAN_CACHE.get(key)
+    if plan is None:
+        if REPROJECTION_PLAN_SEEN_GRIDS.get(key) is None:
+            REPROJECTION_PLAN_SEEN_GRIDS.put(key, True)
+            return None
+        plan = ReprojectionPlan(input_raster.crs, input_raster.transform, src_width, src_height, "epsg:3857", dst_transform, width, height)
+        REPROJECTION_PLAN_CACHE.put(key, plan)
+    return plan
+
+
+def warp_data_to_3857(input_raster):
+    """Warps an input raster to EPSG:3857 with nearest neighbor resampling. The output has the same dtype as the input, so it is worth
+    reducing the data to as few / as small channels as possible before warping (e.g. rendering class probabilities to uint8 images first).
+
+    Rasters on a grid that we have warped before (same CRS, transform, bounds and shape) are warped with a cached `ReprojectionPlan` instead
+    of calling GDAL.
+
+    Args:
+        input_raster (InMemoryRaster): An (in memory) raster datasource to warp
+
+    Returns:
+        output_raster (InMemoryRaster): The warped version of `input_raster`
+    """
+    dst_crs = "epsg:3857"
+    dst_transform, width, height, dst_bounds = get_3857_grid(input_raster)
+
+    plan = get_reprojection_plan(input_raster)
+    if plan is not None:
+        dst_image = plan.apply(input_raster.data)
+    else:
+        num_channels = input_raster.shape[2]
+        src_img_tmp = np.rollaxis(input_raster.data.copy(), 2, 0) # convert image to "channels first" format
+
+        dst_image = np.zeros((num_channels, height, width), input_raster.data.dtype)
+        dst_image, dst_transform = rasterio.warp.reproject(
+            source=src_img_tmp,
+            destination=dst_image,
+            src_transform=input_raster.transform,
+            src_crs=input_raster.crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            resampling=rasterio.warp.Resampling.nearest
+        )
+        dst_image = np.rollaxis(dst_image, 0, 3) # convert image to "channels last" format
     
     return InMemoryRaster(dst_image, dst_crs, dst_transform, dst_bounds)
 
@@ -151,7 +303,12 @@ def crop_data_by_extent(input_raster, extent):
 
 
 def crop_data_by_geometry(input_raster, geometry, geometry_crs):
-    """Crops the input raster by the input geometry (described by `geometry` and `geometry_crs`).
+    """Crops the input raster by the input geometry (described by `geometry` and `geometry_crs`). The output covers the pixels of `input_raster`
+    that are touched by the bounding box of the geometry, with the pixels that aren't touched by the geometry itself set to 0 (the same as
+    `rasterio.mask.mask(..., crop=True, all_touched=True)`).
+
+    If no mask is needed (see `needs_mask()`), e.g. for most axis-aligned boxes, then the data of the output raster is a view into the data of
+    `input_raster`, i.e. no data is copied.
 
     Args:
         input_raster (InMemoryRaster): An (in memory) raster datasource to crop
@@ -161,29 +318,28 @@ def crop_data_by_geometry(input_raster, geometry, geometry_crs):
     Returns:
         output_raster (InMemoryRaster): The cropped version of the input raster
     """
-    src_img_tmp = np.rollaxis(input_raster.data.copy(), 2, 0)
-    
     if geometry_crs != input_raster.crs:
         geometry = fiona.transform.transform_geom(geometry_crs, input_raster.crs, geometry)
+    geom = shapely.geometry.shape(geometry)
+
+    height, width, _ = input_raster.shape
+    window = bounds_to_window(geom.bounds, input_raster.transform)
+    col_start, row_start = max(window.col_off, 0), max(window.row_off, 0)
+    col_stop, row_stop = min(window.col_off + window.width, width), min(window.row_off + window.height, height)
+    if col_start >= col_stop or row_start >= row_stop:
+        raise ValueError("Input shapes do not overlap raster.")
+
+    window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    dst_transform = rasterio.windows.transform(window, input_raster.transform)
+    dst_img = input_raster.data[row_start:row_stop, col_start:col_stop]
+
+    if needs_mask(geom, dst_transform):
+        outside_mask = rasterio.features.geometry_mask(
+            [geometry], out_shape=(window.height, window.width), transform=dst_transform, all_touched=True
+        )
+        dst_img = dst_img.copy()
+        dst_img[outside_mask] = 0
 
-    height, width, num_channels = input_raster.shape
-    dummy_src_profile = {
-        'driver': 'GTiff', 'dtype': str(input_raster.data.dtype),
-        'width': width, 'height': height, 'count': num_channels,
-        'crs': input_raster.crs,
-        'transform': input_raster.transform
-    }
-    
-    test_f = rasterio.io.MemoryFile()
-    with test_f.open(**dummy_src_profile) as test_d:
-        test_d.write(src_img_tmp)
-    test_f.seek(0)
-    with test_f.open() as test_d:
-        dst_img, dst_transform = rasterio.mask.mask(test_d, [geometry], crop=True, all_touched=True, pad=False)
-    test_f.close()
-    
-    dst_img = np.rollaxis(dst_img, 0, 3)
-    
     height, width, _ = dst_img.shape
     left, top = dst_transform * (0, 0)
     right, bottom = dst_transform * (width, height)
@@ -191,6 +347,262 @@ def crop_data_by_geometry(input_raster, geometry, geometry_crs):
     return InMemoryRaster(dst_img, input_raster.crs, dst_transform, (left, bottom, right, top))
 
 
+def is_axis_aligned_box(geom):
+    """Checks whether a shapely geometry is a rectangle with sides parallel to the coordinate axes (i.e. whether it is identical to its own bounding box).
+
+    Args:
+        geom (shapely.geometry.base.BaseGeometry): The geometry to check
+
+    Returns:
+        is_box (bool): True if `geom` covers exactly its bounding box
+    """
+    if geom.geom_type != "Polygon" or len(geom.interiors) > 0:
+        return False
+    bounding_box = shapely.geometry.box(*geom.bounds)
+    return geom.equals(bounding_box)
+
+
+SLIVER_TOLERANCE = 0.01 # box edges that are less than this fraction of a pixel past a pixel boundary are treated as slivers by `needs_mask()`
+
+
+def needs_mask(geom, transform, precision=6):
+    """Checks whether cropping a raster with the given affine transform to the bounding window of `geom` (see `bounds_to_window()`) also needs
+    the pixels outside of `geom` to be masked, i.e. whether the window differs from `rasterio.features.geometry_mask(..., all_touched=True)`.
+
+    This is the case for every geometry that isn't an axis-aligned box, and for boxes with an edge that only just crosses a pixel boundary: the
+    window includes the sliver of pixels past the boundary, but GDAL's `all_touched` rasterization only burns some (or none) of them.
+
+    Args:
+        geom (shapely.geometry.base.BaseGeometry): The geometry to crop to, in the CRS of the raster
+        transform (affine.Affine): The affine transformation of the raster
+        precision (int, optional): The same rounding as in `bounds_to_window()`, edges this close to a pixel boundary are on it. Defaults to 6.
+
+    Returns:
+        needs_mask (bool): False if every pixel in the bounding window of `geom` is touched by `geom`
+    """
+    if not is_axis_aligned_box(geom):
+        return True
+    window = rasterio.windows.from_bounds(*geom.bounds, transform=transform)
+    for offset in [window.col_off, window.row_off, window.col_off + window.width, window.row_off + window.height]:
+        distance = abs(round(offset, precision) - round(offset))
+        if 0 < distance < SLIVER_TOLERANCE:
+            return True
+    return False
+
+
+def bounds_to_window(bounds, transform, precision=6):
+    """Converts a (left, bottom, right, top) tuple into an integer pixel window of a raster with the given affine transform. The window is rounded
+    outwards so that every pixel touched by `bounds` is included (this matches the `all_touched=True` behavior of `rasterio.mask.mask`).
+
+    Args:
+        bounds (tuple): A tuple in the format (left, bottom, right, top) in the units of the raster's CRS
+        transform (affine.Affine): The affine transformation of the raster
+        precision (int, optional): Number of decimal places to round fractional pixel offsets to before flooring/ceiling, this avoids picking up an
+            extra row/column due to floating point error. Defaults to 6.
+
+    Returns:
+        window (rasterio.windows.Window): An integer valued window, note that this can extend past the edges of the raster
+    """
+    window = rasterio.windows.from_bounds(*bounds, transform=transform)
+    col_start = math.floor(round(window.col_off, precision))
+    row_start = math.floor(round(window.row_off, precision))
+    col_stop = math.ceil(round(window.col_off + window.width, precision))
+    row_stop = math.ceil(round(window.row_off + window.height, precision))
+    return rasterio.windows.Window(col_start, row_start, max(col_stop - col_start, 1), max(row_stop - row_start, 1))
+
+
+def read_data_from_window(f, window, geom):
+    """Reads `window` from an open rasterio dataset. Areas of the window that fall outside of the dataset are filled with the dataset's nodata value
+    (or 0). Pixels outside of `geom` are also set to nodata, unless `needs_mask()` says that there are none (e.g. for most axis-aligned boxes).
+
+    Args:
+        f (rasterio.io.DatasetReader): An open raster dataset
+        window (rasterio.windows.Window): An integer valued window of `f`
+        geom (shapely.geometry.base.BaseGeometry): A geometry in the CRS of `f`
+
+    Returns:
+        src_image (np.ndarray): The data formatted as "channels first", i.e. with shape (number of channels, height, width)
+    """
+    nodata = f.nodata if f.nodata is not None else 0
+
+    is_inside = (
+        window.col_off >= 0 and window.row_off >= 0
+        and window.col_off + window.width <= f.width
+        and window.row_off + window.height <= f.height
+    )
+    if is_inside: # boundless reads go through an intermediate VRT in rasterio, so we only use them when we have to
+        src_image = f.read(window=window)
+    else:
+        src_image = f.read(window=window, boundless=True, fill_value=nodata)
+
+    if needs_mask(geom, f.transform):
+        outside_mask = rasterio.features.geometry_mask(
+            [shapely.geometry.mapping(geom)],
+            out_shape=(src_image.shape[1], src_image.shape[2]),
+            transform=rasterio.windows.transform(window, f.transform),
+            all_touched=True
+        )
+        src_image[:, outside_mask] = nodata
+
+    return src_image
+
+
+def read_data_from_geometry(f, geom):
+    """Reads the data under `geom` from an open rasterio dataset with a single windowed read (see `read_data_from_window()`). Only the internal
+    blocks that intersect the bounding window of `geom` are touched.
+
+    Args:
+        f (rasterio.io.DatasetReader): An open raster dataset
+        geom (shapely.geometry.base.BaseGeometry): A geometry in the CRS of `f`
+
+    Returns:
+        src_image (np.ndarray): The data formatted as "channels first", i.e. with shape (number of channels, height, width)
+        src_transform (affine.Affine): The affine transformation of `src_image`
+        src_bounds (tuple): A tuple in the format (left, bottom, right, top) describing the boundary of `src_image`
+    """
+    window = bounds_to_window(geom.bounds, f.transform)
+    src_image = read_data_from_window(f, window, geom)
+    src_transform = rasterio.windows.transform(window, f.transform)
+    src_bounds = rasterio.windows.bounds(window, f.transform)
+    return src_image, src_transform, src_bounds
+
+
+GRID_ALIGNMENT_TOLERANCE = 0.01 # tiles whose origin is within this fraction of a pixel of the output grid are read without warping
+
+
+def _read_tile_on_grid(handle_pool, fn, dst_crs, dst_transform, dst_width, dst_height, nodata):
+    """Reads the data from the raster at `fn` that falls on the pixel grid described by `dst_crs`, `dst_transform`, `dst_width` and `dst_height`.
+    If the raster is already on the grid (same CRS and resolution, and an origin that is a whole number of pixels away from the grid's) then this
+    is a windowed read, otherwise the raster is warped on the fly.
+
+    Returns:
+        data (np.ndarray): The data with shape (bands, dst_height, dst_width), `nodata` where the raster doesn't have valid data
+        valid_mask (np.ndarray): A (dst_height, dst_width) boolean mask of the pixels where the raster has valid data (according to its
+            nodata value / mask band, and not counting the pixels that are outside of it)
+    """
+    with handle_pool.open(fn) as f:
+        if f.crs.to_string() == dst_crs and f.transform.a == dst_transform.a and f.transform.e == dst_transform.e:
+            col_off, row_off = ~f.transform * (dst_transform.c, dst_transform.f)
+            if abs(col_off - round(col_off)) < GRID_ALIGNMENT_TOLERANCE and abs(row_off - round(row_off)) < GRID_ALIGNMENT_TOLERANCE:
+                window = rasterio.windows.Window(int(round(col_off)), int(round(row_off)), dst_width, dst_height)
+                data = f.read(window=window, boundless=True, fill_value=nodata)
+                valid_mask = f.dataset_mask(window=window, boundless=True) > 0
+                return data, valid_mask
+
+        with rasterio.vrt.WarpedVRT(f, crs=dst_crs, transform=dst_transform, width=dst_width, height=dst_height, resampling=rasterio.enums.Resampling.nearest, nodata=nodata) as vrt:
+            data = vrt.read()
+
+        # The VRT can't tell valid pixels that happen to equal `nodata` apart from pixels outside of the raster, so we warp the raster's own
+        # mask for the area that we read
+        dst_bounds = rasterio.transform.array_bounds(dst_height, dst_width, dst_transform)
+        src_bounds = rasterio.warp.transform_bounds(dst_crs, f.crs, *dst_bounds, densify_pts=21)
+        src_window = bounds_to_window(src_bounds, f.transform)
+        src_mask = f.dataset_mask(window=src_window, boundless=True)
+        valid_mask = np.zeros((dst_height, dst_width), dtype=np.uint8)
+        rasterio.warp.reproject(
+            src_mask, valid_mask,
+            src_transform=rasterio.windows.transform(src_window, f.transform), src_crs=f.crs,
+            dst_transform=dst_transform, dst_crs=dst_crs,
+            resampling=rasterio.enums.Resampling.nearest
+        )
+        return data, valid_mask > 0
+
+
+def _get_tiles_grid(handle_pool, tile_fns, geometry, geometry_crs, padding=None):
+    """Returns the pixel grid that `read_data_from_tiles()` reads `geometry` onto, see there for the arguments.
+
+    Returns:
+        dst_crs (str): The CRS of the first tile
+        dst_geom (shapely.geometry.base.BaseGeometry): `geometry` in `dst_crs` (buffered if `padding` is given)
+        dst_transform (affine.Affine): The affine transformation of the grid
+        dst_bounds (tuple): The boundary of the grid
+        dst_width, dst_height (int): The size of the grid
+        nodata (int): The nodata value of the first tile (or 0)
+    """
+    with handle_pool.open(tile_fns[0]) as f:
+        dst_crs = f.crs.to_string()
+        base_transform = f.transform
+        nodata = f.nodata if f.nodata is not None else 0
+
+    dst_geom = shapely.geometry.shape(fiona.transform.transform_geom(geometry_crs, dst_crs, geometry))
+    if padding is not None:
+        dst_geom = shapely.geometry.box(*dst_geom.buffer(padding).bounds)
+
+    window = bounds_to_window(dst_geom.bounds, base_transform)
+    dst_transform = rasterio.windows.transform(window, base_transform)
+    dst_bounds = rasterio.windows.bounds(window, base_transform)
+    return dst_crs, dst_geom, dst_transform, dst_bounds, int(window.width), int(window.height), nodata
+
+
+def _read_tiles_on_grid(handle_pool, executor, tile_fns, dst_crs, dst_geom, dst_transform, dst_width, dst_height, nodata):
+    """Reads and mosaics the data from `tile_fns` that falls on the given pixel grid, with the pixels outside of `dst_geom` set to `nodata`.
+
+    Returns:
+        dst_image (np.ndarray): The data formatted as "channels last", i.e. with shape (dst_height, dst_width, number of channels)
+    """
+    read_args = (dst_crs, dst_transform, dst_width, dst_height, nodata)
+    if len(tile_fns) == 1:
+        tile_images = [_read_tile_on_grid(handle_pool, tile_fns[0], *read_args)]
+    else:
+        futures = [executor.submit(_read_tile_on_grid, handle_pool, fn, *read_args) for fn in tile_fns]
+        tile_images = [future.result() for future in futures]
+
+    dst_image, dst_valid_mask = tile_images[0]
+    for tile_image, tile_valid_mask in tile_images[1:]:
+        if dst_valid_mask.all():
+            break
+        missing_mask = ~dst_valid_mask & tile_valid_mask
+        dst_image[:, missing_mask] = tile_image[:, missing_mask]
+        dst_valid_mask |= tile_valid_mask
+    dst_image[:, ~dst_valid_mask] = nodata
+
+    if needs_mask(dst_geom, dst_transform):
+        outside_mask = rasterio.features.geometry_mask(
+            [shapely.geometry.mapping(dst_geom)],
+            out_shape=(dst_height, dst_width),
+            transform=dst_transform,
+            all_touched=True
+        )
+        dst_image[:, outside_mask] = nodata
+
+    return np.rollaxis(dst_image, 0, 3)
+
+
+def read_data_from_tiles(handle_pool, executor, tile_fns, geometry, geometry_crs, padding=None):
+    """Reads and mosaics the data under `geometry` from a list of (potentially overlapping) raster tiles. The output is on the pixel grid of the
+    first tile in `tile_fns`, tiles in a different CRS (e.g. a different UTM zone) or with a different resolution are warped to this grid. Where
+    tiles overlap, the data from the tile that comes first in `tile_fns` is used.
+
+    Args:
+        handle_pool (DatasetHandlePool): Pool to open the tiles through
+        executor (concurrent.futures.Executor): Executor to read the tiles with, tiles are read concurrently if there are more than one
+        tile_fns (list): Paths to the tiles that intersect `geometry`
+        geometry (dict): A polygon in GeoJSON format
+        geometry_crs (str): The coordinate system of `geometry`
+        padding (float, optional): If given then we read the bounding box of `geometry` buffered by `padding` units of the first tile's CRS
+            (this is the behavior of `get_data_from_extent`). If None then pixels outside of `geometry` are masked out. Defaults to None.
+
+    Returns:
+        output_raster (InMemoryRaster): The mosaicked data
+    """
+    dst_crs, dst_geom, dst_transform, dst_bounds, dst_width, dst_height, nodata = _get_tiles_grid(handle_pool, tile_fns, geometry, geometry_crs, padding)
+    dst_image = _read_tiles_on_grid(handle_pool, executor, tile_fns, dst_crs, dst_geom, dst_transform, dst_width, dst_height, nodata)
+    return InMemoryRaster(dst_image, dst_crs, dst_transform, dst_bounds)
+
+
+def read_windowed_data_from_tiles(handle_pool, executor, tile_fns, geometry, geometry_crs):
+    """Same as `read_data_from_tiles()` (without padding), but returns a `WindowedRaster` that only reads and mosaics the tiles for the window
+    that is asked for.
+    """
+    dst_crs, dst_geom, dst_transform, dst_bounds, dst_width, dst_height, nodata = _get_tiles_grid(handle_pool, tile_fns, geometry, geometry_crs)
+
+    def read_window(window):
+        window_transform = rasterio.windows.transform(window, dst_transform)
+        return _read_tiles_on_grid(handle_pool, executor, tile_fns, dst_crs, dst_geom, window_transform, int(window.width), int(window.height), nodata)
+
+    return WindowedRaster(dst_crs, dst_transform, dst_bounds, dst_width, dst_height, read_window)
+
+
 def get_area_from_geometry(geom, src_crs="epsg:4326"):
     """Semi-accurately calculates the area for an input GeoJSON shape in km^2 by reprojecting it into a local UTM coordinate system.
 
@@ -229,16 +641,18 @@ def get_area_from_geometry(geom, src_crs="epsg:4326"):
 # ------------------------------------------------------
 class DataLoaderCustom(DataLoader):
 
-    def __init__(self, padding, **kwargs):
+    def __init__(self, padding, handle_pool=None, **kwargs):
         """A `DataLoader` object made for single raster datasources (single .tif files, .vrt files, etc.). This provides functionality for extracting data
         from different shapes and calculating the area of shapes.
 
         Args:
             padding (float): Amount of padding in terms of units of the CRS of the raster source pointed to by `data_fn`.
+            handle_pool (DatasetHandlePool, optional): Pool of open dataset handles to read through. If None, then a new pool is created.
             **kwargs: Should contain a "path" key that points to the location of the datasource (e.g. the .tif or .vrt file to use) 
         """
         self._padding = padding
         self.data_fn = kwargs["path"]
+        self.handle_pool = handle_pool if handle_pool is not None else DatasetHandlePool()
 
     @property
     def padding(self):
@@ -249,80 +663,155 @@ class DataLoaderCustom(DataLoader):
         self._padding = value
 
     def get_data_from_extent(self, extent):
-        with rasterio.open(self.data_fn, "r") as f:
+        with self.handle_pool.open(self.data_fn) as f:
             src_crs = f.crs.to_string()
             transformed_geom = extent_to_transformed_geom(extent, src_crs)
             transformed_geom = shapely.geometry.shape(transformed_geom)
 
+            # We read the bounding box of the buffered extent, this is a rectangle so `read_data_from_geometry` won't need to compute a mask
             buffed_geom = transformed_geom.buffer(self.padding)
-            buffed_geojson = shapely.geometry.mapping(buffed_geom)
+            buffed_geom = shapely.geometry.box(*buffed_geom.bounds)
 
-            #buffed = shapely.geometry.mapping(shapely.geometry.box(*buffed_geom.bounds))
-            src_image, src_transform = rasterio.mask.mask(f, [buffed_geojson], crop=True, all_touched=True, pad=False) # NOTE: Used to buffer by geom, haven't tested this.
+            src_image, src_transform, src_bounds = read_data_from_geometry(f, buffed_geom)
 
         src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, buffed_geom.bounds)
+        return InMemoryRaster(src_image, src_crs, src_transform, src_bounds)
 
     def get_data_from_geometry(self, geometry):
         #TODO: Figure out what happens if we call this with a geometry that doesn't intersect the data source.
-        f = rasterio.open(self.data_fn, "r")
-        src_profile = f.profile
-        src_crs = f.crs.to_string()
-        transformed_mask_geom = fiona.transform.transform_geom("epsg:4326", src_crs, geometry)
-        src_image, src_transform = rasterio.mask.mask(f, [transformed_mask_geom], crop=True, all_touched=True, pad=False)
-        f.close()
+        with self.handle_pool.open(self.data_fn) as f:
+            src_crs = f.crs.to_string()
+            transformed_mask_geom = fiona.transform.transform_geom("epsg:4326", src_crs, geometry)
+            transformed_mask_geom = shapely.geometry.shape(transformed_mask_geom)
+
+            src_image, src_transform, src_bounds = read_data_from_geometry(f, transformed_mask_geom)
 
         src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, shapely.geometry.shape(transformed_mask_geom).bounds)
+        return InMemoryRaster(src_image, src_crs, src_transform, src_bounds)
+
+    def get_windowed_data_from_geometry(self, geometry):
+        with self.handle_pool.open(self.data_fn) as f:
+            src_crs = f.crs.to_string()
+            base_transform = f.transform
+        transformed_mask_geom = fiona.transform.transform_geom("epsg:4326", src_crs, geometry)
+        transformed_mask_geom = shapely.geometry.shape(transformed_mask_geom)
+
+        window = bounds_to_window(transformed_mask_geom.bounds, base_transform)
+        src_transform = rasterio.windows.transform(window, base_transform)
+        src_bounds = rasterio.windows.bounds(window, base_transform)
+
+        def read_window(chunk_window):
+            chunk_window = rasterio.windows.Window(window.col_off + chunk_window.col_off, window.row_off + chunk_window.row_off, chunk_window.width, chunk_window.height)
+            with self.handle_pool.open(self.data_fn) as f:
+                src_image = read_data_from_window(f, chunk_window, transformed_mask_geom)
+            return np.rollaxis(src_image, 0, 3)
+
+        return WindowedRaster(src_crs, src_transform, src_bounds, int(window.width), int(window.height), read_window)
 
 
 # ------------------------------------------------------
 # DataLoader for US NAIP data and other aligned layers
 # ------------------------------------------------------
-class NAIPTileIndex(object):
+class TileIndex(object):
+    """Base class for looking up which tiles of a tiled raster layer intersect a query geometry. Each subclass points at a directory (`INDEX_DIR`)
+    holding an on-disk rtree index ("tile_index.dat" / "tile_index.idx") over the tile footprints and a `TileCatalog` that maps rtree ids
+    to `(filename, shapely geometry)` tuples. Both of these are created by "utils/create_spatial_index.py". For older setups we fall back to
+    the pickled dictionary of tiles ("tiles.p") if there isn't a catalog in `INDEX_DIR`.
+
+    Everything is loaded once per process, the first time it is needed, and then shared between request threads. rtree indices and prepared
+    shapely geometries are not thread safe, so lookups are serialized with `LOCK`.
+    """
+    INDEX_DIR = None
     TILES = None
-    
-    @staticmethod
-    def lookup(geom):
-        if NAIPTileIndex.TILES is None:
-            assert all([os.path.exists(fn) for fn in [
-                "data/tile_index/naip/tile_index.dat",
-                "data/tile_index/naip/tile_index.idx",
-                "data/tile_index/naip/tiles.p"
-            ]]), "You do not have the correct files, did you setup the project correctly"
-            NAIPTileIndex.TILES = pickle.load(open("data/tile_index/naip/tiles.p", "rb"))
-        return NAIPTileIndex.lookup_naip_tile_by_geom(geom)
+    SPATIAL_INDEX = None
+    PREPARED_TILES = None
+    MAX_PREPARED_TILES = 4096
+    LOCK = None
+
+    @classmethod
+    def load(cls):
+        with cls.LOCK:
+            if cls.TILES is None:
+                assert all([os.path.exists(os.path.join(cls.INDEX_DIR, fn)) for fn in [
+                    "tile_index.dat",
+                    "tile_index.idx"
+                ]]), "You do not have the correct files, did you setup the project correctly"
+
+                if TileCatalog.exists(cls.INDEX_DIR):
+                    tiles = TileCatalog(cls.INDEX_DIR)
+                else:
+                    assert os.path.exists(os.path.join(cls.INDEX_DIR, "tiles.p")), "You do not have the correct files, did you setup the project correctly"
+                    LOGGER.warning("Loading the pickled tile dictionary from %s, re-run 'utils/create_spatial_index.py' to create a (much faster) tile catalog" % (cls.INDEX_DIR))
+                    with open(os.path.join(cls.INDEX_DIR, "tiles.p"), "rb") as f:
+                        tiles = pickle.load(f)
+                spatial_index = rtree.index.Index(os.path.join(cls.INDEX_DIR, "tile_index"))
+
+                # `TILES` is what `lookup_all()` checks, so it is set last, once everything else has loaded. If anything above raises, then the
+                # next lookup tries to load again instead of using a half-loaded index
+                cls.SPATIAL_INDEX = spatial_index
+                cls.PREPARED_TILES = dict()
+                cls.TILES = tiles
+
+    @classmethod
+    def _get_query_bounds(cls, geom):
+        """Returns the (minx, miny, maxx, maxy) bounds of `geom` in the axis order used by the tile index.
+        """
+        return shapely.geometry.shape(geom).bounds
 
-    @staticmethod
-    def lookup_naip_tile_by_geom(geom):
-        minx, miny, maxx, maxy = shapely.geometry.shape(geom).bounds
-        geom = shapely.geometry.mapping(shapely.geometry.box(minx, miny, maxx, maxy, ccw=True))
-        geom = shapely.geometry.shape(geom)
-
-        tile_index = rtree.index.Index("data/tile_index/naip/tile_index")
-        intersected_indices = list(tile_index.intersection(geom.bounds))
-        for idx in intersected_indices:
-            intersected_fn = NAIPTileIndex.TILES[idx][0]
-            intersected_geom = NAIPTileIndex.TILES[idx][1]
-            if intersected_geom.contains(geom):
-                print("Found %d intersections, returning at %s" % (len(intersected_indices), intersected_fn))
-                tile_index.close()
-                return intersected_fn
-        tile_index.close()
-        if len(intersected_indices) > 0:
-            raise ValueError("Error, there are overlaps with tile index, but no tile completely contains selection")
-        else:
+    @classmethod
+    def _get_prepared_tile(cls, idx):
+        """Returns a prepared version of the footprint of tile `idx`, prepared geometries make repeated `contains` tests against the same tile
+        much cheaper. Must be called while holding `LOCK`.
+        """
+        if idx not in cls.PREPARED_TILES:
+            if len(cls.PREPARED_TILES) >= cls.MAX_PREPARED_TILES:
+                cls.PREPARED_TILES.clear()
+            cls.PREPARED_TILES[idx] = shapely.prepared.prep(cls.TILES[idx][1])
+        return cls.PREPARED_TILES[idx]
+
+    @classmethod
+    def lookup_all(cls, geom):
+        """Returns the filenames of all tiles that intersect the bounding box of `geom`. Tiles that completely contain the bounding box come
+        first, followed by the remaining tiles in decreasing order of overlap.
+        """
+        if cls.TILES is None:
+            cls.load()
+
+        minx, miny, maxx, maxy = cls._get_query_bounds(geom)
+        geom = shapely.geometry.box(minx, miny, maxx, maxy, ccw=True)
+
+        with cls.LOCK:
+            intersections = []
+            for idx in cls.SPATIAL_INDEX.intersection(geom.bounds):
+                prepared_tile = cls._get_prepared_tile(idx)
+                if prepared_tile.contains(geom):
+                    intersections.append((float("inf"), cls.TILES[idx][0]))
+                elif prepared_tile.intersects(geom):
+                    intersections.append((cls.TILES[idx][1].intersection(geom).area, cls.TILES[idx][0]))
+
+        if len(intersections) == 0:
             raise ValueError("No tile intersections")
 
+        intersections.sort(key=lambda x: x[0], reverse=True)
+        LOGGER.debug("Found %d intersecting tiles" % (len(intersections)))
+        return [fn for _, fn in intersections]
+
+
+class NAIPTileIndex(TileIndex):
+    INDEX_DIR = "data/tile_index/naip/"
+    LOCK = threading.Lock()
+
 
 class DataLoaderUSALayer(DataLoader):
 
-    def __init__(self, padding, **kwargs):
+    def __init__(self, padding, handle_pool=None, **kwargs):
         self._padding = padding
+        self.handle_pool = handle_pool if handle_pool is not None else DatasetHandlePool()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) # used to read multiple tiles concurrently
         
         # we do this to prime the tile index -- loading the first time can take awhile
         try:
-            NAIPTileIndex.lookup(None)
+            NAIPTileIndex.load()
         except:
             pass
 
@@ -336,32 +825,20 @@ class DataLoaderUSALayer(DataLoader):
 
     def get_data_from_extent(self, extent):
         query_geom = extent_to_transformed_geom(extent, "epsg:4326")
-        naip_fn = NAIPTileIndex.lookup(query_geom)
-
-        with rasterio.open(NAIP_BLOB_ROOT + "/" + naip_fn) as f:
-            src_crs = f.crs.to_string()
-            transformed_geom = extent_to_transformed_geom(extent, src_crs)
-            transformed_geom = shapely.geometry.shape(transformed_geom)
+        tile_fns = [NAIP_BLOB_ROOT + "/" + fn for fn in NAIPTileIndex.lookup_all(query_geom)]
 
-            buffed_geom = transformed_geom.buffer(self.padding)
-            buffed_geojson = shapely.geometry.mapping(buffed_geom)
-
-            src_image, src_transform = rasterio.mask.mask(f, [buffed_geojson], crop=True, all_touched=True, pad=False)
-
-        src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, buffed_geom.bounds)
+        extent_geom = extent_to_transformed_geom(extent, extent["crs"])
+        return read_data_from_tiles(self.handle_pool, self.executor, tile_fns, extent_geom, extent["crs"], padding=self.padding)
 
     def get_data_from_geometry(self, geometry):
-        naip_fn = NAIPTileIndex.lookup(geometry)
+        tile_fns = [NAIP_BLOB_ROOT + "/" + fn for fn in NAIPTileIndex.lookup_all(geometry)]
 
-        with rasterio.open(NAIP_BLOB_ROOT + "/" + naip_fn) as f:
-            src_profile = f.profile
-            src_crs = f.crs.to_string()
-            transformed_mask_geom = fiona.transform.transform_geom("epsg:4326", src_crs, geometry)
-            src_image, src_transform = rasterio.mask.mask(f, [transformed_mask_geom], crop=True, all_touched=True, pad=False)
+        return read_data_from_tiles(self.handle_pool, self.executor, tile_fns, geometry, "epsg:4326")
 
-        src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, shapely.geometry.shape(transformed_mask_geom).bounds)
+    def get_windowed_data_from_geometry(self, geometry):
+        tile_fns = [NAIP_BLOB_ROOT + "/" + fn for fn in NAIPTileIndex.lookup_all(geometry)]
+
+        return read_windowed_data_from_tiles(self.handle_pool, self.executor, tile_fns, geometry, "epsg:4326")
 
 
 # ------------------------------------------------------
@@ -370,9 +847,24 @@ class DataLoaderUSALayer(DataLoader):
 class DataLoaderBasemap(DataLoader):
 
     def __init__(self, padding, **kwargs):
+        """A `DataLoader` for RGB imagery served as XYZ tiles. Tiles are fetched concurrently, cached on disk and stitched together in EPSG:3857,
+        the coordinate system they are rendered in.
+
+        Args:
+            padding (float): Amount of padding in degrees (extents are buffered in EPSG:4326).
+            **kwargs: Should contain a "url" key with "{x}", "{y}" and "{z}" placeholders. Can optionally contain "maxCacheMB" (size of the on-disk
+                tile cache), "fetchThreads" (number of tiles to download at once) and "maxPixels" (the largest image, in pixels, that
+                `get_data_from_geometry` will assemble).
+        """
         self._padding = padding
         self.data_url = kwargs["url"]
         self.zoom_level = 17
+        self.max_pixels = kwargs.get("maxPixels", 10000*10000)
+        self.tile_fetcher = TileFetcher(
+            self.data_url,
+            max_cache_bytes=kwargs.get("maxCacheMB", 1024) * 2**20,
+            max_workers=kwargs.get("fetchThreads", 16)
+        )
 
     @property
     def padding(self):
@@ -381,129 +873,94 @@ class DataLoaderBasemap(DataLoader):
     def padding(self, value):
         self._padding = value
 
-    def get_image_by_xyz_from_url(self, tile):
-        '''NOTE: Here "tile" refers to a mercantile "Tile" object.'''
-        req = urlopen(self.data_url.format(
-            z=tile.z, y=tile.y, x=tile.x
-        ))
-        arr = np.asarray(bytearray(req.read()), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        return img
-
-    def get_tile_as_virtual_raster(self, tile):
-        '''NOTE: Here "tile" refers to a mercantile "Tile" object.'''
-        img = self.get_image_by_xyz_from_url(tile)
-        geom = shapely.geometry.shape(mercantile.feature(tile)["geometry"])
-        minx, miny, maxx, maxy = geom.bounds
-        dst_transform = rasterio.transform.from_bounds(minx, miny, maxx, maxy, 256, 256)
-        dst_profile = {
-            "driver": "GTiff",
-            "width": 256,
-            "height": 256,
-            "transform": dst_transform,
-            "crs": "epsg:4326",
-            "count": 3,
-            "dtype": "uint8"
-        }    
-        test_f = rasterio.io.MemoryFile()
-        with test_f.open(**dst_profile) as test_d:
-            test_d.write(img[:,:,0], 1)
-            test_d.write(img[:,:,1], 2)
-            test_d.write(img[:,:,2], 3)
-        test_f.seek(0)
-        
-        return test_f
-
     def get_data_from_extent(self, extent):
         transformed_geom = extent_to_transformed_geom(extent, "epsg:4326")
         transformed_geom = shapely.geometry.shape(transformed_geom)
         buffed_geom = transformed_geom.buffer(self.padding)
-        
-        minx, miny, maxx, maxy = buffed_geom.bounds
-        
-        virtual_files = [] # this is nutty
-        virtual_datasets = []
-        for i, tile in enumerate(mercantile.tiles(minx, miny, maxx, maxy, self.zoom_level)):
-            f = self.get_tile_as_virtual_raster(tile)
-            virtual_files.append(f)
-            virtual_datasets.append(f.open())
-        out_image, out_transform = rasterio.merge.merge(virtual_datasets, bounds=(minx, miny, maxx, maxy))
-
-        for ds in virtual_datasets:
-            ds.close()
-        for f in virtual_files:
-            f.close()
-        
-        dst_crs = "epsg:4326"
-        dst_profile = {
-            "driver": "GTiff",
-            "width": out_image.shape[1],
-            "height": out_image.shape[0],
-            "transform": out_transform,
-            "crs": dst_crs,
-            "count": 3,
-            "dtype": "uint8"
-        }
-        test_f = rasterio.io.MemoryFile()
-        with test_f.open(**dst_profile) as test_d:
-            test_d.write(out_image[:,:,0], 1)
-            test_d.write(out_image[:,:,1], 2)
-            test_d.write(out_image[:,:,2], 3)
-        test_f.seek(0)
-        test_f.close()
-
-        out_image = np.rollaxis(out_image, 0, 3)
-        return InMemoryRaster(out_image, dst_crs, out_transform, buffed_geom.bounds)
 
-    def get_data_from_geometry(self, geometry):
-        raise NotImplementedError()
+        dst_crs = "epsg:3857"
+        dst_bounds = rasterio.warp.transform_bounds("epsg:4326", dst_crs, *buffed_geom.bounds)
 
+        col_start, row_start, col_stop, row_stop = self.tile_fetcher.get_window(self.zoom_level, dst_bounds)
+        out_image = self.tile_fetcher.fetch_window(self.zoom_level, col_start, row_start, col_stop, row_stop)
+        out_transform = self.tile_fetcher.get_transform(self.zoom_level, col_start, row_start)
 
+        height, width, _ = out_image.shape
+        left, top = out_transform * (0, 0)
+        right, bottom = out_transform * (width, height)
+        return InMemoryRaster(out_image, dst_crs, out_transform, (left, bottom, right, top))
 
-class LCTileIndex(object):
-    TILES = None
-    
-    @staticmethod
-    def lookup(geom):
-        if LCTileIndex.TILES is None:
-            assert all([os.path.exists(fn) for fn in [
-                "data/tile_index/lc2019/tile_index.dat",
-                "data/tile_index/lc2019/tile_index.idx",
-                "data/tile_index/lc2019/tiles.p"
-            ]]), "You do not have the correct files, did you setup the project correctly"
-            LCTileIndex.TILES = pickle.load(open("data/tile_index/lc2019/tiles.p", "rb"))
-        return LCTileIndex.lookup_naip_tile_by_geom(geom)
-
-    @staticmethod
-    def lookup_naip_tile_by_geom(geom):
+    def get_data_from_geometry(self, geometry):
+        windowed_raster = self.get_windowed_data_from_geometry(geometry)
+        out_image = windowed_raster.read(rasterio.windows.Window(0, 0, windowed_raster.width, windowed_raster.height))
+        return InMemoryRaster(out_image, windowed_raster.crs, windowed_raster.transform, windowed_raster.bounds)
+
+    def get_windowed_data_from_geometry(self, geometry):
+        dst_crs = "epsg:3857"
+        dst_geom = shapely.geometry.shape(fiona.transform.transform_geom("epsg:4326", dst_crs, geometry))
+
+        col_start, row_start, col_stop, row_stop = self.tile_fetcher.get_window(self.zoom_level, dst_geom.bounds)
+        height, width = row_stop - row_start, col_stop - col_start
+        if height * width > self.max_pixels:
+            raise ValueError("The selected shape is too large, it covers %d pixels at zoom level %d while the limit is %d pixels" % (height * width, self.zoom_level, self.max_pixels))
+
+        out_transform = self.tile_fetcher.get_transform(self.zoom_level, col_start, row_start)
+        left, top = out_transform * (0, 0)
+        right, bottom = out_transform * (width, height)
+
+        # We only fetch the tiles that intersect the shape
+        prepared_geom = shapely.prepared.prep(dst_geom)
+        tile_filter = lambda tile: prepared_geom.intersects(shapely.geometry.box(*mercantile.xy_bounds(tile)))
+
+        def read_window(window):
+            window_col_start, window_row_start = col_start + int(window.col_off), row_start + int(window.row_off)
+            window_col_stop, window_row_stop = window_col_start + int(window.width), window_row_start + int(window.height)
+            out_image = np.zeros((int(window.height), int(window.width), 3), dtype=np.uint8)
+
+            # We fetch one row of tiles at a time so that we never have more than one row of decoded tiles in memory on top of `out_image`
+            chunk_start = window_row_start
+            while chunk_start < window_row_stop:
+                chunk_stop = min((chunk_start // TILE_SIZE + 1) * TILE_SIZE, window_row_stop)
+                self.tile_fetcher.fetch_window(
+                    self.zoom_level, window_col_start, chunk_start, window_col_stop, chunk_stop,
+                    out=out_image[chunk_start-window_row_start:chunk_stop-window_row_start],
+                    tile_filter=tile_filter
+                )
+                chunk_start = chunk_stop
+
+            outside_mask = rasterio.features.geometry_mask(
+                [shapely.geometry.mapping(dst_geom)],
+                out_shape=(int(window.height), int(window.width)),
+                transform=rasterio.windows.transform(window, out_transform),
+                all_touched=True
+            )
+            out_image[outside_mask] = 0
+            return out_image
+
+        return WindowedRaster(dst_crs, out_transform, (left, bottom, right, top), width, height, read_window)
+
+
+
+class LCTileIndex(TileIndex):
+    INDEX_DIR = "data/tile_index/lc2019/"
+    LOCK = threading.Lock()
+
+    @classmethod
+    def _get_query_bounds(cls, geom):
+        # The land cover tile index was created with (lat, lon) ordered coordinates
         miny, minx, maxy, maxx = shapely.geometry.shape(geom).bounds
-        geom = shapely.geometry.mapping(shapely.geometry.box(minx, miny, maxx, maxy, ccw=True))
-        geom = shapely.geometry.shape(geom)
-
-        tile_index = rtree.index.Index("data/tile_index/lc2019/tile_index")
-        intersected_indices = list(tile_index.intersection(geom.bounds))
-        for idx in intersected_indices:
-            intersected_fn = LCTileIndex.TILES[idx][0]
-            intersected_geom = LCTileIndex.TILES[idx][1]
-            if intersected_geom.contains(geom):
-                print("Found %d intersections, returning at %s" % (len(intersected_indices), intersected_fn))
-                tile_index.close()
-                return intersected_fn
-        tile_index.close()
-        if len(intersected_indices) > 0:
-            raise ValueError("Error, there are overlaps with tile index, but no tile completely contains selection")
-        else:
-            raise ValueError("No tile intersections")
+        return minx, miny, maxx, maxy
 
 class DataLoaderLCLayer(DataLoader):
 
-    def __init__(self, padding, **kwargs):
+    def __init__(self, padding, handle_pool=None, **kwargs):
         self._padding = padding
+        self.handle_pool = handle_pool if handle_pool is not None else DatasetHandlePool()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) # used to read multiple tiles concurrently
         
         # we do this to prime the tile index -- loading the first time can take awhile
         try:
-            LCTileIndex.lookup(None)
+            LCTileIndex.load()
         except:
             pass
 
@@ -517,29 +974,17 @@ class DataLoaderLCLayer(DataLoader):
 
     def get_data_from_extent(self, extent):
         query_geom = extent_to_transformed_geom(extent, "epsg:4326")
-        naip_fn = LCTileIndex.lookup(query_geom)
+        tile_fns = [LC_BLOB_ROOT + "/" + fn for fn in LCTileIndex.lookup_all(query_geom)]
 
-        with rasterio.open(LC_BLOB_ROOT + "/" + naip_fn) as f:
-            src_crs = f.crs.to_string()
-            transformed_geom = extent_to_transformed_geom(extent, src_crs)
-            transformed_geom = shapely.geometry.shape(transformed_geom)
-
-            buffed_geom = transformed_geom.buffer(self.padding)
-            buffed_geojson = shapely.geometry.mapping(buffed_geom)
-
-            src_image, src_transform = rasterio.mask.mask(f, [buffed_geojson], crop=True, all_touched=True, pad=False)
-
-        src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, buffed_geom.bounds)
+        extent_geom = extent_to_transformed_geom(extent, extent["crs"])
+        return read_data_from_tiles(self.handle_pool, self.executor, tile_fns, extent_geom, extent["crs"], padding=self.padding)
 
     def get_data_from_geometry(self, geometry):
-        naip_fn = LCTileIndex.lookup(geometry)
+        tile_fns = [LC_BLOB_ROOT + "/" + fn for fn in LCTileIndex.lookup_all(geometry)]
 
-        with rasterio.open(LC_BLOB_ROOT + "/" + naip_fn) as f:
-            src_profile = f.profile
-            src_crs = f.crs.to_string()
-            transformed_mask_geom = fiona.transform.transform_geom("epsg:4326", src_crs, geometry)
-            src_image, src_transform = rasterio.mask.mask(f, [transformed_mask_geom], crop=True, all_touched=True, pad=False)
+        return read_data_from_tiles(self.handle_pool, self.executor, tile_fns, geometry, "epsg:4326")
 
-        src_image = np.rollaxis(src_image, 0, 3)
-        return InMemoryRaster(src_image, src_crs, src_transform, shapely.geometry.shape(transformed_mask_geom).bounds)
\ No newline at end of file
+    def get_windowed_data_from_geometry(self, geometry):
+        tile_fns = [LC_BLOB_ROOT + "/" + fn for fn in LCTileIndex.lookup_all(geometry)]
+
+        return read_windowed_data_from_tiles(self.handle_pool, self.executor, tile_fns, geometry, "epsg:4326")
\ No newline at end of file
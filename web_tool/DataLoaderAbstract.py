@@ -45,4 +45,18 @@ class DataLoader(abc.ABC):
         Returns:
             output_raster (InMemoryRaster): A raster cropped to the outline of `geometry`
         """
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    def get_windowed_data_from_geometry(self, geometry):
+        """Same as `get_data_from_geometry`, but returns a `WindowedRaster` that is read one window at a time, so that callers that work through large
+        geometries (e.g. `/predTile`) never need the whole raster in memory. This default implementation reads all of the data up front, `DataLoader`s
+        that can read windows directly should override it.
+
+        Args:
+            geometry (dict): A polygon in GeoJSON format describing the boundary to crop the input raster to
+
+        Returns:
+            output_raster (WindowedRaster): A raster cropped to the outline of `geometry`
+        """
+        from .DataLoader import WindowedRaster # DataLoader.py imports this module
+        return WindowedRaster.from_in_memory_raster(self.get_data_from_geometry(geometry))
\ No newline at end of file
@@ -0,0 +1,144 @@
+import time
+import threading
+import collections
+import contextlib
+
+import rasterio
+
+import logging
+LOGGER = logging.getLogger("server")
+
+
+class _ThreadHandles():
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.handles = collections.OrderedDict() # path -> (open dataset, time it was last used), in LRU order
+        self.in_use = collections.Counter() # path -> number of `open()` blocks that are using the handle
+        self.lock = threading.Lock() # the owning thread and the sweeper both change `handles`
+
+
+class DatasetHandlePool():
+
+    def __init__(self, max_handles_per_thread=16, max_idle_seconds=300, sweep_interval_seconds=60):
+        """A pool of open `rasterio` dataset handles keyed by path. Opening a dataset means parsing GDAL headers, VRT XML and, for remote
+        datasources, making HTTP requests, so we keep recently used handles open between requests.
+
+        GDAL dataset handles must not be shared between threads, so each thread gets its own LRU of handles. The size of each LRU is limited
+        by `max_handles_per_thread`. A background thread closes the handles that haven't been used for `max_idle_seconds` and all of the
+        handles of threads that have exited (the server's request threads and the job threads come and go).
+
+        Args:
+            max_handles_per_thread (int, optional): The maximum number of handles that a single thread can hold open. Defaults to 16.
+            max_idle_seconds (int, optional): Handles that haven't been used in this many seconds are closed. Defaults to 300.
+            sweep_interval_seconds (int, optional): How often the background thread looks for handles to close. Defaults to 60.
+        """
+        self.max_handles_per_thread = max_handles_per_thread
+        self.max_idle_seconds = max_idle_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+
+        self._local = threading.local()
+        self._all_handles = [] # the `_ThreadHandles` of every thread that has used the pool, for `sweep()` and `close_all()`
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def _get_thread_handles(self):
+        thread_handles = getattr(self._local, "thread_handles", None)
+        if thread_handles is None:
+            thread_handles = _ThreadHandles(threading.current_thread())
+            self._local.thread_handles = thread_handles
+            with self._lock:
+                self._all_handles.append(thread_handles)
+                if self._sweeper is None: # started lazily so that pools that are never used don't cost a thread
+                    self._sweeper = threading.Thread(target=self._sweep_periodically, name="DatasetHandlePool-sweeper", daemon=True)
+                    self._sweeper.start()
+        return thread_handles
+
+    def _close_handle(self, thread_handles, path):
+        f, _ = thread_handles.handles.pop(path)
+        try:
+            f.close()
+        except Exception as e:
+            LOGGER.warning("Error closing dataset handle for %s: %s" % (path, e))
+
+    def _evict(self, thread_handles):
+        """Closes the least recently used handles of a thread beyond `max_handles_per_thread`. Must be called with `thread_handles.lock` held.
+        """
+        for path in list(thread_handles.handles.keys()):
+            if len(thread_handles.handles) <= self.max_handles_per_thread:
+                break
+            if thread_handles.in_use[path] == 0:
+                self._close_handle(thread_handles, path)
+
+    def get(self, path):
+        """Returns an open `rasterio.io.DatasetReader` for `path`, opening one if this thread doesn't already have it open. The caller must
+        not close the returned handle, and should use `open()` instead if it uses the handle for long enough that it could be swept as idle.
+        """
+        thread_handles = self._get_thread_handles()
+        with thread_handles.lock:
+            if path in thread_handles.handles:
+                f, _ = thread_handles.handles.pop(path)
+                if f.closed:
+                    f = rasterio.open(path, "r")
+            else:
+                f = rasterio.open(path, "r")
+            thread_handles.handles[path] = (f, time.time())
+            self._evict(thread_handles)
+        return f
+
+    @contextlib.contextmanager
+    def open(self, path):
+        """Drop-in replacement for `with rasterio.open(path) as f:` that takes the handle from the pool. The handle isn't closed by the sweeper
+        while the block runs. If the body raises an exception then the handle is discarded as it may have been left in a bad state.
+        """
+        thread_handles = self._get_thread_handles()
+        with thread_handles.lock:
+            thread_handles.in_use[path] += 1
+        try:
+            f = self.get(path)
+            yield f
+        except Exception:
+            with thread_handles.lock:
+                if thread_handles.in_use[path] == 1 and path in thread_handles.handles:
+                    self._close_handle(thread_handles, path)
+            raise
+        finally:
+            with thread_handles.lock:
+                thread_handles.in_use[path] -= 1
+                if thread_handles.in_use[path] == 0:
+                    del thread_handles.in_use[path]
+
+    def sweep(self):
+        """Closes the handles that haven't been used for `max_idle_seconds`, and all of the handles of threads that have exited.
+        """
+        current_time = time.time()
+        with self._lock:
+            all_handles = list(self._all_handles)
+
+        for thread_handles in all_handles:
+            thread_alive = thread_handles.thread.is_alive()
+            with thread_handles.lock:
+                for path, (_, last_used_time) in list(thread_handles.handles.items()):
+                    if not thread_alive or (current_time - last_used_time > self.max_idle_seconds and thread_handles.in_use[path] == 0):
+                        self._close_handle(thread_handles, path)
+            if not thread_alive:
+                with self._lock:
+                    self._all_handles.remove(thread_handles)
+
+    def _sweep_periodically(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds)
+            try:
+                self.sweep()
+            except Exception as e:
+                LOGGER.warning("Error sweeping dataset handles: %s" % (e))
+
+    def close_all(self):
+        """Closes every handle in the pool. This should only be called when no other threads are using the pool (e.g. at shutdown).
+        """
+        with self._lock:
+            all_handles = list(self._all_handles)
+        for thread_handles in all_handles:
+            with thread_handles.lock:
+                for path in list(thread_handles.handles.keys()):
+                    self._close_handle(thread_handles, path)
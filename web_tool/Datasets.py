@@ -12,8 +12,9 @@ LOGGER = logging.getLogger("server")
 
 from . import ROOT_DIR
 from .DataLoader import DataLoaderCustom, DataLoaderUSALayer, DataLoaderLCLayer, DataLoaderBasemap
+from .DatasetPool import DatasetHandlePool
 
-def _load_dataset(dataset):
+def _load_dataset(dataset, handle_pool):
     # Step 1: make sure the dataLayer exists
     if dataset["dataLayer"]["type"] == "CUSTOM":
         fn = dataset["dataLayer"]["path"]
@@ -23,11 +24,11 @@ def _load_dataset(dataset):
 
     # Step 2: setup the appropriate DatasetLoader
     if dataset["dataLayer"]["type"] == "CUSTOM":
-        data_loader = DataLoaderCustom(**dataset["dataLayer"])
+        data_loader = DataLoaderCustom(handle_pool=handle_pool, **dataset["dataLayer"])
     elif dataset["dataLayer"]["type"] == "USA_LAYER":
-        data_loader = DataLoaderUSALayer(**dataset["dataLayer"])
+        data_loader = DataLoaderUSALayer(handle_pool=handle_pool, **dataset["dataLayer"])
     elif dataset["dataLayer"]["type"] == "LC_LAYER":
-        data_loader = DataLoaderLCLayer(**dataset["dataLayer"])
+        data_loader = DataLoaderLCLayer(handle_pool=handle_pool, **dataset["dataLayer"])
     elif dataset["dataLayer"]["type"] == "BASEMAP":
         data_loader = DataLoaderBasemap(**dataset["dataLayer"])
     else:
@@ -40,10 +41,11 @@ def load_datasets():
     """Returns a dictionary of key:value where keys are dataset names (from "datasets.json" / "datasets.mine.json") and values are instances of classes that extend DataLoaderAbstract
     """
     datasets = dict()
+    handle_pool = DatasetHandlePool() # all of the DataLoaders share one pool of open rasterio dataset handles
 
     dataset_json = json.load(open(os.path.join(ROOT_DIR, "datasets.json"),"r"))
     for key, dataset in dataset_json.items():
-        data_loader = _load_dataset(dataset)
+        data_loader = _load_dataset(dataset, handle_pool)
 
         if data_loader is False:
             LOGGER.warning("Files are missing, we will not be able to serve the following dataset: '%s'" % (key)) 
@@ -55,7 +57,7 @@ def load_datasets():
         for key, dataset in dataset_json.items():
 
             if key not in datasets:
-                data_loader = _load_dataset(dataset)
+                data_loader = _load_dataset(dataset, handle_pool)
 
                 if data_loader is False:
                     LOGGER.warning("Files are missing, we will not be able to serve the following dataset: '%s'" % (key)) 
@@ -71,4 +73,17 @@ def is_valid_dataset(dataset_key):
     if os.path.exists(os.path.join(ROOT_DIR, "datasets.mine.json")):
         dataset_mine_json = json.load(open(os.path.join(ROOT_DIR, "datasets.mine.json"), "r"))
 
-    return (dataset_key in dataset_json) or (dataset_key in dataset_mine_json)
\ No newline at end of file
+    return (dataset_key in dataset_json) or (dataset_key in dataset_mine_json)
+
+def get_dataset_resolutions():
+    """Returns a dictionary mapping each dataset key (from "datasets.json" / "datasets.mine.json") to the "resolution" of its "dataLayer", i.e. the
+    grid (in EPSG:3857 units) that the front-end snaps the centers of its requests to. Datasets that don't set a resolution map to None.
+    """
+    resolutions = dict()
+    for fn in ["datasets.json", "datasets.mine.json"]:
+        if os.path.exists(os.path.join(ROOT_DIR, fn)):
+            with open(os.path.join(ROOT_DIR, fn), "r") as f:
+                for key, dataset in json.load(f).items():
+                    if key not in resolutions:
+                        resolutions[key] = dataset["dataLayer"].get("resolution", None)
+    return resolutions
@@ -0,0 +1,181 @@
+import time
+import uuid
+import threading
+import collections
+import traceback
+
+from queue import Queue
+
+import logging
+LOGGER = logging.getLogger("server")
+
+
+class Job():
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, fn, args, kwargs):
+        """A unit of work that is run in the background by a `JobRunner`. `fn` is called as `fn(job, *args, **kwargs)` so that it can report its
+        progress with `job.set_progress()`. Whatever `fn` returns is stored in `job.result`, if it raises then the message of the exception is
+        stored in `job.error`.
+
+        Jobs can be cancelled with `cancel()`. A job that hasn't started yet is never run, a running job is only stopped if `fn` checks
+        `job.cancel_event` (e.g. between chunks) and raises.
+        """
+        self.job_id = uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+        self.status = Job.QUEUED
+        self.progress = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+
+        self.creation_time = time.time()
+        self.start_time = None
+        self.finish_time = None
+
+        self.done_event = threading.Event()
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock() # makes starting and cancelling a queued job mutually exclusive
+
+    def set_progress(self, progress, total):
+        self.progress = progress
+        self.total = total
+
+    def is_done(self):
+        return self.status in [Job.FINISHED, Job.FAILED, Job.CANCELLED]
+
+    def cancel(self):
+        """Asks the job to stop. If the job hasn't started yet then it is marked as cancelled straight away and will not run.
+        """
+        with self._lock:
+            self.cancel_event.set()
+            if self.status == Job.QUEUED:
+                self._finish(Job.CANCELLED, error="The job was cancelled before it could run")
+
+    def run(self):
+        """Runs the job unless it has been cancelled. Returns whether the job was run.
+        """
+        with self._lock:
+            if self.cancel_event.is_set():
+                return False
+            self.status = Job.RUNNING
+            self.start_time = time.time()
+        try:
+            result = self.fn(self, *self.args, **self.kwargs)
+            self._finish(Job.FINISHED, result=result)
+        except Exception as e:
+            if self.cancel_event.is_set():
+                LOGGER.info("Job %s was cancelled while running: %s" % (self.job_id, e))
+                self._finish(Job.CANCELLED, error="The job was cancelled while it was running")
+            else:
+                LOGGER.error("Job %s failed:\n%s" % (self.job_id, traceback.format_exc()))
+                self._finish(Job.FAILED, error=str(e))
+        return True
+
+    def _finish(self, status, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = status
+        self.finish_time = time.time()
+        self.fn = self.args = self.kwargs = None # don't hold on to the inputs once we are done
+        self.done_event.set()
+
+    def to_dict(self):
+        return {
+            "jobId": self.job_id,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "error": self.error,
+            "elapsedSeconds": (self.finish_time or time.time()) - (self.start_time or time.time())
+        }
+
+
+class JobRunner():
+
+    def __init__(self, name, max_finished_jobs=16):
+        """Runs the jobs submitted to it one at a time, in order, on a background thread. Each `Session` has one of these so that long running
+        requests (e.g. `/predTile`) don't block a server thread while they run.
+
+        Args:
+            name (str): A name for the runner thread, used in the logs
+            max_finished_jobs (int, optional): How many finished jobs to keep around for `get_job()`, the oldest are forgotten first. Defaults to 16.
+        """
+        self.name = name
+        self.max_finished_jobs = max_finished_jobs
+
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name="JobRunner-%s" % (name), daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues `fn(job, *args, **kwargs)` to be run and returns the new `Job`.
+        """
+        job = Job(fn, args, kwargs)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._forget_old_jobs()
+            if self._stopped:
+                job.cancel()
+                return job
+        self._queue.put(job)
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def queue_position(self, job):
+        """Returns the number of jobs that will run before `job`.
+        """
+        with self._lock:
+            return sum([1 for other_job in self._jobs.values() if other_job.status == Job.QUEUED and other_job.creation_time < job.creation_time])
+
+    def stop(self):
+        """Cancels every job that hasn't finished yet (see `Job.cancel()`) and stops the runner thread once the running job, if any, returns.
+        """
+        with self._lock:
+            self._stopped = True
+            for job in self._jobs.values():
+                if not job.is_done():
+                    job.cancel()
+        self._queue.put(None)
+
+    def join(self, timeout=None):
+        """Waits for the runner thread to stop after `stop()`, i.e. for the running job to notice that it was cancelled and return.
+
+        Returns:
+            stopped (bool): False if the thread is still running after `timeout` seconds
+        """
+        if threading.current_thread() is not self._thread: # a job can't wait for itself
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _forget_old_jobs(self):
+        finished_job_ids = [job_id for job_id, job in self._jobs.items() if job.is_done()]
+        for job_id in finished_job_ids[:max(len(finished_job_ids) - self.max_finished_jobs, 0)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            LOGGER.info("JobRunner %s - starting job %s" % (self.name, job.job_id))
+            if not job.run():
+                LOGGER.info("JobRunner %s - job %s was cancelled before it started" % (self.name, job.job_id))
+                continue
+            LOGGER.info("JobRunner %s - job %s %s after %0.2f seconds" % (self.name, job.job_id, job.status, job.finish_time - job.start_time))
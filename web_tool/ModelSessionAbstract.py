@@ -125,4 +125,32 @@ class ModelSession(abc.ABC):
             directory: The directory to re-hydrate from. This directory should have the output
             from `save_state_to()` in it.
         """
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+    def create_head(self):
+        """Optional. Responsible for creating a new, independent, fine-tuning "head" for a session in a worker that is shared by many
+        sessions (see `worker.py --shared`). The returned object should share the expensive, frozen parts of this model (e.g. the weights
+        of the backbone network) and have its own copy of everything that `add_sample_point()`, `retrain()`, `undo()`, `reset()` and
+        `load_state_from()` change, starting in the state that `reset()` leaves it in.
+
+        Implementations that share a backbone between heads must make sure that `run()` is safe to call from several threads at once.
+
+        Returns:
+            A `ModelSession` object.
+        """
+        raise NotImplementedError("This model doesn't support shared workers")
+
+    def enable_batching(self, max_batch_size, max_wait_ms):
+        """Optional. Responsible for making `run()` send its forward passes through a `BatchScheduler`, so that the windows of the sessions
+        that share a worker (see `create_head()`) are run through the backbone together. Heads created before or after this call should
+        all use the same scheduler.
+
+        Args:
+            max_batch_size: The most windows to run through the backbone at once.
+            max_wait_ms: How long a forward pass can wait for windows from other sessions to fill its batch.
+        """
+        raise NotImplementedError("This model doesn't support batching requests across sessions")
+
+    def get_batch_stats(self):
+        """Optional. Returns the stats of the scheduler set up by `enable_batching()` (see `BatchScheduler.get_stats()`), or None.
+        """
+        return None
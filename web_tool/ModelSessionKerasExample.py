@@ -1,4 +1,6 @@
 import os
+import copy
+import threading
 
 import pickle
 import joblib
@@ -15,6 +17,7 @@ LOGGER = logging.getLogger("server")
 
 from . import ROOT_DIR
 from .ModelSessionAbstract import ModelSession
+from .BatchScheduler import BatchScheduler
 
 class KerasDenseFineTune(ModelSession):
 
@@ -34,6 +37,9 @@ class KerasDenseFineTune(ModelSession):
         self.output_features = self.model.output_shape[1][3]
         self.input_size = self.model.input_shape[1]
 
+        self.backbone_lock = threading.Lock() # shared by all of the heads created with `create_head()`
+        self.batch_scheduler = None # also shared by all of the heads, see `enable_batching()`
+
         self.down_weight_padding = 10
         self.stride_x = self.input_size - self.down_weight_padding*2
         self.stride_y = self.input_size - self.down_weight_padding*2
@@ -138,6 +144,23 @@ class KerasDenseFineTune(ModelSession):
             "success": True
         }
 
+    def create_head(self):
+        head = copy.copy(self) # shares `self.model` and `self.backbone_lock`
+        head.reset() # replaces the fine-tuning state with new objects
+        return head
+
+    def enable_batching(self, max_batch_size, max_wait_ms):
+        self.batch_scheduler = BatchScheduler(
+            lambda batch: self.model.predict(batch, batch_size=max_batch_size, verbose=0),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms
+        )
+
+    def get_batch_stats(self):
+        if self.batch_scheduler is None:
+            return None
+        return self.batch_scheduler.get_stats()
+
     def run_model_on_tile(self, tile, batch_size=32):
         height = tile.shape[0]
         width = tile.shape[1]
@@ -163,7 +186,11 @@ class KerasDenseFineTune(ModelSession):
                 batch_indices.append((y_index, x_index))
                 batch_count+=1
 
-        model_output = self.model.predict(np.array(batch), batch_size=batch_size, verbose=0)
+        if self.batch_scheduler is not None: # our windows are run together with the windows of the other sessions in this worker
+            model_output = self.batch_scheduler.predict(np.array(batch))
+        else:
+            with self.backbone_lock:
+                model_output = self.model.predict(np.array(batch), batch_size=batch_size, verbose=0)
         
         for i, (y, x) in enumerate(batch_indices):
             output[y:y+self.input_size, x:x+self.input_size] += model_output[0][i] * kernel[..., np.newaxis]
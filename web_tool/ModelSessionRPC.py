@@ -1,11 +1,11 @@
-import sys, os, time
+import sys, os
 import rpyc
 
 import logging
 LOGGER = logging.getLogger("server")
 
 from .ModelSessionAbstract import ModelSession
-from .Utils import serialize, deserialize
+from .Utils import serialize, deserialize, write_shared_array, read_shared_array, delete_shared_array
 
 def clean_output_dict(data):
     return {
@@ -21,41 +21,50 @@ class ModelSessionRPC(ModelSession):
         port = kwargs["port"]
 
         self.session_id = session_id
+        self.use_shared_memory = kwargs.get("use_shared_memory", True)
 
-        self.max_retries = 30
-        self.rety_timeout = 2
-        self.connection = None
+        # The worker is ready to accept connections by the time we are created, see `SessionHandler._spawn_local_worker()`
+        self.connection = rpyc.connect("localhost", port, config={
+            'allow_public_attrs': False
+        })
+        LOGGER.info("Made a connection")
+
+        if "load_dir" in kwargs:
+            self.load_state_from(kwargs["load_dir"])
 
-        i=0
-        while self.connection is None and i<self.max_retries:
-            try:
-                self.connection = rpyc.connect("localhost", port, config={
-                    'allow_public_attrs': False
-                })
-                LOGGER.info("Made a connection")
-
-                if "load_dir" in kwargs:
-                    self.load_state_from(kwargs["load_dir"])
-
-                break
-            except ConnectionRefusedError:
-                i+=1
-                time.sleep(self.rety_timeout)
-                LOGGER.warning("Haven't connected, attempt %d" % (i))
     @property
     def last_tile(self):
-        return deserialize(self.connection.root.exposed_last_tile)
+        if self.use_shared_memory:
+            return read_shared_array(tuple(self.connection.root.exposed_last_tile_shared(self.session_id)))
+        return deserialize(self.connection.root.exposed_last_tile(self.session_id))
     def run(self, tile, inference_mode):
-        return deserialize(self.connection.root.exposed_run(serialize(tile), inference_mode))
+        if self.use_shared_memory: # the worker runs on the same machine, so we only send handles to memory-mapped copies of the arrays
+            tile_handle = write_shared_array(tile)
+            try:
+                output_handle = self.connection.root.exposed_run_shared(self.session_id, tile_handle, inference_mode)
+            finally:
+                delete_shared_array(tile_handle)
+            return read_shared_array(tuple(output_handle))
+        return deserialize(self.connection.root.exposed_run(self.session_id, serialize(tile), inference_mode))
     def retrain(self):
-        return clean_output_dict(self.connection.root.exposed_retrain())
+        return clean_output_dict(self.connection.root.exposed_retrain(self.session_id))
     def add_sample_point(self, row, col, class_idx):
-        return clean_output_dict(self.connection.root.exposed_add_sample_point(row, col, class_idx))
+        return clean_output_dict(self.connection.root.exposed_add_sample_point(self.session_id, row, col, class_idx))
     def undo(self):
-        return clean_output_dict(self.connection.root.exposed_undo())
+        return clean_output_dict(self.connection.root.exposed_undo(self.session_id))
     def reset(self):
-        return clean_output_dict(self.connection.root.exposed_reset())
+        return clean_output_dict(self.connection.root.exposed_reset(self.session_id))
     def save_state_to(self, directory):
-        return clean_output_dict(self.connection.root.exposed_save_state_to(directory))
+        return clean_output_dict(self.connection.root.exposed_save_state_to(self.session_id, directory))
     def load_state_from(self, directory):
-        return clean_output_dict(self.connection.root.exposed_load_state_from(directory))
\ No newline at end of file
+        return clean_output_dict(self.connection.root.exposed_load_state_from(self.session_id, directory))
+    def get_batch_stats(self):
+        stats = self.connection.root.exposed_get_batch_stats()
+        return None if stats is None else {key: stats[key] for key in stats} # `dict(stats)` would need the netref's `keys()`, which rpyc doesn't expose
+    def close(self):
+        """Closes our connection to the worker. In a shared worker this also drops our session's head.
+        """
+        try:
+            self.connection.root.exposed_remove_session(self.session_id)
+        finally:
+            self.connection.close()
\ No newline at end of file
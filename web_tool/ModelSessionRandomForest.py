@@ -1,4 +1,5 @@
 import os
+import copy
 
 import pickle
 import joblib
@@ -117,6 +118,11 @@ class ModelSessionRandomForest(ModelSession):
             "success": True
         }
 
+    def create_head(self):
+        head = copy.copy(self)
+        head.reset() # replaces the fine-tuning state with new objects
+        return head
+
     def save_state_to(self, directory):
         
         np.save(os.path.join(directory, "augment_x_train.npy"), np.array(self.augment_x_train))
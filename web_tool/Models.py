@@ -6,6 +6,8 @@ LOGGER = logging.getLogger("server")
 
 from . import ROOT_DIR
 
+SHARED_WORKER_MODEL_TYPES = ["keras_example", "random_forest"] # the model types whose ModelSession implements `create_head()`
+
 
 def _load_model(model):
     if "fn" in model["model"]:
@@ -40,4 +42,11 @@ def load_models():
             else:
                 LOGGER.warning("There is a conflicting dataset key in models.mine.json, skipping.")
 
-    return models
\ No newline at end of file
+    return models
+
+def supports_shared_worker(model_config):
+    """Returns whether sessions of the model described by `model_config` (an entry of `load_models()`) can be served by a shared worker (see
+    `worker.py --shared`). This depends on the model type (see `SHARED_WORKER_MODEL_TYPES`), and can be overridden per model by setting
+    "supportsSharedWorker" in models.json.
+    """
+    return model_config.get("supportsSharedWorker", model_config["type"] in SHARED_WORKER_MODEL_TYPES)
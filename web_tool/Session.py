@@ -5,6 +5,7 @@ import datetime
 import collections
 import subprocess
 import shutil
+import threading
 
 import base64
 import json
@@ -14,16 +15,21 @@ import pickle
 import numpy as np
 
 import joblib
+import rasterio.windows
 
-from .Utils import get_random_string, AtomicCounter
+from .Utils import get_random_string, AtomicCounter, LRUCache
 from .Checkpoints import Checkpoints
 from .DataLoader import InMemoryRaster
+from .Jobs import JobRunner
 
 import logging
 LOGGER = logging.getLogger("server")
 
 SESSION_BASE_PATH = './tmp/session'
 SESSION_FOLDER = SESSION_BASE_PATH + "/" + datetime.datetime.now().strftime('%Y-%m-%d')
+RESULT_CACHE_MAX_BYTES = 64 * 2**20
+PRED_TILE_CHUNK_SIZE = 2048 # `pred_tile_chunks` runs the model over chunks of at most this many pixels on a side...
+PRED_TILE_CHUNK_PADDING = 64 # ...with this much context around each chunk so that there aren't seams between chunks
 
 
 def manage_session_folders():
@@ -40,10 +46,16 @@ class Session():
         LOGGER.info("Instantiating a new session object with id: %s" % (session_id))
 
         self.model = model
+        self.lock = threading.RLock() # serializes the calls into `model`, e.g. a `/predPatch` and a `/addSample` that arrive on different server threads
         self.data_loader = None
         self.latest_input_raster = None # InMemoryRaster object from the most recent prediction
+        self.latest_input_is_stale = False # True if `latest_input_raster` was served from `result_cache`, i.e. the model's `last_tile` doesn't correspond to it
         self.tile_map = None # A map recording the most recent prediction per pixel
 
+        self.model_version = AtomicCounter() # incremented whenever the model's predictions may have changed
+        self.result_cache = LRUCache(RESULT_CACHE_MAX_BYTES, lambda result: sum([len(v) for v in result.values()])) # rendered `pred_patch` results for the current `model_version`
+        self._result_cache_lock = threading.Lock() # makes bumping `model_version` and storing a result for a version mutually exclusive
+
         self.current_snapshot_string = get_random_string(8)
         self.current_snapshot_idx = 0
         self.current_request_counter = AtomicCounter()
@@ -53,12 +65,68 @@ class Session():
         self.creation_time = time.time()
         self.last_interaction_time = self.creation_time
 
+        self.job_runner = JobRunner(session_id) # runs long requests, e.g. /predTile, in the background
+
+    def _increment_model_version(self):
+        with self._result_cache_lock:
+            self.model_version.increment()
+            self.result_cache.clear() # the cached results are all for older versions of the model
+
+    def get_cached_result(self, key):
+        """Returns the cached `pred_patch` result for `key` with the current version of the model, or None.
+        """
+        return self.result_cache.get((self.model_version.value, key))
+
+    def set_cached_result(self, key, version, result):
+        """Caches a `pred_patch` result for `key` that was computed by version `version` of the model (as returned by `pred_patch()`). If the
+        model has changed since then, e.g. it was retrained while the result was being rendered, the result is stale and isn't cached.
+        """
+        with self._result_cache_lock:
+            if version == self.model_version.value:
+                self.result_cache.put((version, key), result)
+
+    def set_latest_input_from_cache(self, input_raster):
+        """Called instead of `pred_patch()` when the result for `input_raster` is served from the result cache. The model's `last_tile` is then
+        for a different input, so we recompute it the next time a sample point is added.
+        """
+        with self.lock:
+            self.latest_input_raster = input_raster
+            self.latest_input_is_stale = True
+
     def reset(self):
         self.current_snapshot_string = get_random_string(8)
         self.current_snapshot_idx = 0
         self.current_request_counter = AtomicCounter()
         self.request_list = []
-        return self.model.reset()
+        with self.lock:
+            result = self.model.reset()
+            self._increment_model_version()
+        return result
+
+    def retrain(self, **kwargs):
+        with self.lock:
+            result = self.model.retrain(**kwargs)
+            self._increment_model_version()
+        return result
+
+    def undo(self):
+        with self.lock:
+            result = self.model.undo()
+            self._increment_model_version()
+        return result
+
+    def load_state_from(self, directory):
+        with self.lock:
+            result = self.model.load_state_from(directory)
+            self._increment_model_version()
+        return result
+
+    def add_sample_point(self, row, col, class_idx):
+        with self.lock:
+            if self.latest_input_is_stale:
+                self.model.run(self.latest_input_raster.data, False) # updates the model's `last_tile`
+                self.latest_input_is_stale = False
+            return self.model.add_sample_point(row, col, class_idx)
 
     def load(self, encoded_model_fn):
         model_fn = base64.b64decode(encoded_model_fn).decode('utf-8')
@@ -119,7 +187,8 @@ class Session():
         with open(os.path.join(directory, "classes.json"), "w") as f:
             f.write(json.dumps(classes))
 
-        return self.model.save_state_to(directory)
+        with self.lock:
+            return self.model.save_state_to(directory)
 
     def add_entry(self, data):
         # data = data.copy()
@@ -152,16 +221,66 @@ class Session():
         pass
 
     def pred_patch(self, input_raster):
-        output = self.model.run(input_raster.data, False)
-        assert input_raster.shape[0] == output.shape[0] and input_raster.shape[1] == output.shape[1], "ModelSession must return an np.ndarray with the same height and width as the input"
-
-        return InMemoryRaster(output, input_raster.crs, input_raster.transform, input_raster.bounds)
-
-    def pred_tile(self, input_raster):
-        output = self.model.run(input_raster.data, True)
+        """Runs the model on `input_raster`.
+
+        Returns:
+            output_raster (InMemoryRaster): The model output
+            model_version (int): The version of the model that computed the output, to pass to `set_cached_result()`
+        """
+        with self.lock:
+            output = self.model.run(input_raster.data, False)
+            model_version = self.model_version.value
+            self.latest_input_raster = input_raster
+            self.latest_input_is_stale = False
         assert input_raster.shape[0] == output.shape[0] and input_raster.shape[1] == output.shape[1], "ModelSession must return an np.ndarray with the same height and width as the input"
 
-        return InMemoryRaster(output, input_raster.crs, input_raster.transform, input_raster.bounds)
+        return InMemoryRaster(output, input_raster.crs, input_raster.transform, input_raster.bounds), model_version
+
+    def pred_tile_chunks(self, input_raster, progress_callback=None, cancel_event=None):
+        """Runs the model over `input_raster`, which can be much larger than the patches that `pred_patch` is used with, one chunk at a time. The
+        raster is split into chunks of `PRED_TILE_CHUNK_SIZE` x `PRED_TILE_CHUNK_SIZE` pixels that are read and run separately (each with `PRED_TILE_CHUNK_PADDING`
+        pixels of context so that there aren't seams between chunks). This is a generator so that callers can reduce / write out the output of
+        each chunk before the next one is computed, i.e. neither the full input nor the full model output ever has to be in memory.
+
+        Args:
+            input_raster (WindowedRaster): The input, see `DataLoader.get_windowed_data_from_geometry()`
+            progress_callback (function, optional): Called as `progress_callback(num_chunks_done, num_chunks)` after each chunk. Defaults to None.
+            cancel_event (threading.Event, optional): Checked before each chunk, a ValueError is raised once it is set. Defaults to None.
+
+        Yields:
+            window (rasterio.windows.Window): The window of `input_raster` that the chunk covers, in row-major order
+            chunk_output (np.ndarray): The model output for `window` with shape (window.height, window.width, number of classes)
+            chunk_input (np.ndarray): The input for `window` with shape (window.height, window.width, number of channels)
+        """
+        height, width = input_raster.height, input_raster.width
+        row_starts = list(range(0, height, PRED_TILE_CHUNK_SIZE))
+        col_starts = list(range(0, width, PRED_TILE_CHUNK_SIZE))
+        num_chunks = len(row_starts) * len(col_starts)
+
+        num_chunks_done = 0
+        for row_start in row_starts:
+            for col_start in col_starts:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ValueError("Cancelled after %d of %d chunks" % (num_chunks_done, num_chunks))
+                row_stop, col_stop = min(row_start + PRED_TILE_CHUNK_SIZE, height), min(col_start + PRED_TILE_CHUNK_SIZE, width)
+                padded_row_start, padded_row_stop = max(row_start - PRED_TILE_CHUNK_PADDING, 0), min(row_stop + PRED_TILE_CHUNK_PADDING, height)
+                padded_col_start, padded_col_stop = max(col_start - PRED_TILE_CHUNK_PADDING, 0), min(col_stop + PRED_TILE_CHUNK_PADDING, width)
+
+                chunk = input_raster.read(rasterio.windows.Window(padded_col_start, padded_row_start, padded_col_stop - padded_col_start, padded_row_stop - padded_row_start))
+                with self.lock: # only held for one chunk at a time, so that interactive requests can run in between
+                    chunk_output = self.model.run(chunk, True)
+                assert chunk.shape[0] == chunk_output.shape[0] and chunk.shape[1] == chunk_output.shape[1], "ModelSession must return an np.ndarray with the same height and width as the input"
+
+                num_chunks_done += 1
+                if progress_callback is not None:
+                    progress_callback(num_chunks_done, num_chunks)
+
+                window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+                unpadded_slices = (
+                    slice(row_start - padded_row_start, row_stop - padded_row_start),
+                    slice(col_start - padded_col_start, col_stop - padded_col_start)
+                )
+                yield window, chunk_output[unpadded_slices], chunk[unpadded_slices]
 
     def download_all(self):
         pass
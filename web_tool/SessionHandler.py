@@ -1,4 +1,7 @@
-import socket
+import os
+import json
+import select
+import collections
 import subprocess
 import threading
 import time
@@ -10,21 +13,26 @@ from queue import Queue, Empty
 
 from .Session import Session
 from .ModelSessionRPC import ModelSessionRPC
-from .Models import load_models
+from .Models import load_models, supports_shared_worker
 from .Datasets import is_valid_dataset
 from .Checkpoints import Checkpoints
 
+ADMISSION_POLICIES = ["queue", "reject", "preempt"]
+QUEUED_SESSION_TIMEOUT_SECONDS = 60 # queued sessions whose client hasn't asked for their status in this long are dropped from the queue
+JOB_RUNNER_STOP_TIMEOUT_SECONDS = 60 # how long `kill_session()` waits for a running job to be cancelled before killing its worker from under it
+
 
 def session_monitor(session_handler, session_timeout_seconds):
     ''' This is a `Thread()` that is starting when the program is run. It is responsible for finding which of the `Session()` objects
     in `SESSION_MAP` haven't been used recently and killing them.
 
-    TODO: SESSION_HANDLER needs to be thread safe because we call it from here and the main sever threads
+    We look at a snapshot of the sessions (see `SessionHandler.get_sessions()`) because the server threads add and remove sessions while we run,
+    a session that is killed by its user in the meantime is skipped by `kill_session()`.
     '''
     LOGGER.info("Starting session monitor thread")
     while True:
         session_ids_to_kill = []
-        for session_id, session in session_handler._SESSION_MAP.items():
+        for session_id, session in session_handler.get_sessions():
             time_inactive = time.time() - session.last_interaction_time
             LOGGER.debug("SESSION MONITOR - Checking session (%s) for activity, inactive for %d seconds" % (session_id, time_inactive))
             if time_inactive > session_timeout_seconds:
@@ -32,44 +40,192 @@ def session_monitor(session_handler, session_timeout_seconds):
 
         for session_id in session_ids_to_kill:
             LOGGER.info("SESSION MONITOR - Session (%s) has been inactive for over %d seconds, destroying" % (session_id, session_timeout_seconds))
-            session_handler.kill_session(session_id)
+            try:
+                session_handler.kill_session(session_id)
+            except ValueError:
+                LOGGER.info("SESSION MONITOR - Session (%s) was already killed" % (session_id))
         
         time.sleep(5)
 
 
-def get_free_tcp_port():
-    '''From: https://gist.github.com/gabrielfalcao/20e567e188f588b65ba2
-    
-    We use the OS to select a free port for us.
+def load_worker_inventory(fn):
+    '''Loads the list of worker slots that sessions are given before we fall back to starting unpinned CPU workers. `fn` is a JSON file with
+    a list of slots, e.g.:
+
+        [
+            {"type": "local", "gpu_id": 0},
+            {"type": "local", "gpu_id": 1},
+            {"type": "local", "gpu_id": -1, "cpus": [0, 1, 2, 3], "num_threads": 4},
+            {"type": "local", "gpu_id": -1, "cpus": [4, 5, 6, 7]}
+        ]
+
+    A GPU id of -1 means a CPU slot. Workers started for a slot with "cpus" are pinned to those cores, and their torch / TensorFlow / OpenMP
+    thread pools are limited to "num_threads" threads (which defaults to the number of cores in "cpus").
+
+    Returns:
+        A list of worker dicts with a unique "slot_id" each, that can be put in `SessionHandler._WORKER_POOL`
     '''
-    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp.bind(('', 0))
-    addr, port = tcp.getsockname()
-    tcp.close()
-    return port
+    if fn is None:
+        return []
+    with open(fn, "r") as f:
+        inventory = json.load(f)
+    if not isinstance(inventory, list):
+        raise ValueError("The worker inventory in %s must be a list of worker slots" % (fn))
+
+    workers = []
+    for slot_id, slot in enumerate(inventory):
+        worker = dict(slot)
+        worker.setdefault("type", "local")
+        worker.setdefault("gpu_id", -1)
+        if worker["type"] != "local":
+            raise ValueError("Worker type %s isn't recognized, only local workers are implemented" % (worker["type"]))
+        if "cpus" in worker:
+            if not isinstance(worker["cpus"], list) or len(worker["cpus"]) == 0 or not all([isinstance(cpu, int) for cpu in worker["cpus"]]):
+                raise ValueError("'cpus' of worker slot %d must be a non-empty list of core ids" % (slot_id))
+            worker.setdefault("num_threads", len(worker["cpus"]))
+        if worker.get("num_threads", 1) < 1:
+            raise ValueError("'num_threads' of worker slot %d must be at least 1" % (slot_id))
+        worker["slot_id"] = slot_id
+        workers.append(worker)
+    return workers
+
+
+def admission_monitor(session_handler):
+    ''' This is a `Thread()` that starts the sessions waiting in `SessionHandler`'s admission queue once there is capacity for them. It wakes up
+    whenever a session is killed (and every few seconds to drop queued sessions that have been abandoned).
+    '''
+    LOGGER.info("Starting admission monitor thread")
+    while True:
+        session_handler._admit_queued_sessions()
+        session_handler._admission_changed.wait(timeout=5)
+        session_handler._admission_changed.clear()
+
+
+def worker_pool_monitor(session_handler):
+    ''' This is a `Thread()` that keeps the pools of pre-warmed workers in `SessionHandler` topped up. It wakes up whenever a worker is taken
+    from a pool (and every few seconds to replace workers that have died).
+    '''
+    LOGGER.info("Starting worker pool monitor thread")
+    while True:
+        session_handler._top_up_warm_workers()
+        session_handler._warm_workers_changed.wait(timeout=5)
+        session_handler._warm_workers_changed.clear()
+
+
+def wait_for_worker(process, ready_fd, timeout_seconds):
+    '''Waits for a worker started by `SessionHandler._spawn_local_worker()` to say that it is ready to accept connections. The worker writes the
+    port that it is listening on to the pipe `ready_fd` once it has loaded its model and bound its socket.
+
+    Returns:
+        port (int): The port that the worker is listening on
+    '''
+    deadline = time.time() + timeout_seconds
+    message = b""
+    try:
+        while not message.endswith(b"\n"):
+            remaining_seconds = deadline - time.time()
+            if remaining_seconds <= 0:
+                process.kill()
+                raise ValueError("Worker didn't start within %d seconds" % (timeout_seconds))
+
+            readable, _, _ = select.select([ready_fd], [], [], min(remaining_seconds, 0.5))
+            if readable:
+                data = os.read(ready_fd, 64)
+                if data == b"": # the worker closed the pipe without saying it was ready, i.e. it has exited
+                    process.wait()
+                    raise ValueError("Worker exited during startup with code %s" % (str(process.returncode)))
+                message += data
+            elif process.poll() is not None:
+                raise ValueError("Worker exited during startup with code %s" % (str(process.returncode)))
+    finally:
+        os.close(ready_fd)
+
+    return int(message.strip())
 
 
 class SessionHandler():
 
     def __init__(self, args):
-        self._GPU_WORKERS = [
-            #{"type": "local", "gpu_id": 0},
-        ]
+        # The GPUs / CPU core sets that sessions can have to themselves, see `load_worker_inventory()`. Once these are all in use new sessions
+        # get an unpinned CPU worker (subject to admission control, see `create_session()`)
+        self._WORKERS = load_worker_inventory(getattr(args, "worker_inventory", None))
+        self.worker_num_threads = getattr(args, "worker_num_threads", 0) # thread limit for workers that aren't started for a slot, 0 for no limit
 
         self._WORKER_POOL = Queue()
-        for worker in self._GPU_WORKERS:
+        for worker in self._WORKERS:
             self._WORKER_POOL.put(worker)
 
         self._expired_sessions = set()
         self._SESSION_MAP = dict()
         self._SESSION_INFO = dict()
+        self._creating_sessions = set() # session ids that `create_session()` is starting a worker for
+        # Guards `_SESSION_MAP`, `_SESSION_INFO`, `_creating_sessions` and `_expired_sessions`. It is only held while these are read or changed,
+        # never while we wait on a worker, calls into a session's model are serialized by that session's own lock (see `Session.lock`)
+        self._lock = threading.RLock()
         
         self.args = args
 
         self.model_configs = load_models()
+        self.worker_startup_timeout = getattr(args, "worker_startup_timeout", 120)
+
+        # In shared mode all of the CPU sessions for a model are served by one worker, see `_get_shared_worker()`. Models that don't support
+        # this (see `supports_shared_worker()`) still get a worker per session
+        self.shared_workers = getattr(args, "shared_workers", False)
+        self._shared_workers = dict()
+        self._shared_workers_lock = threading.Lock()
+        self.max_batch_size = getattr(args, "max_batch_size", 0)
+        self.max_batch_wait_ms = getattr(args, "max_batch_wait_ms", 10)
+
+        # Pools of CPU workers that have already started and loaded their model, keyed by model key, see `start_worker_pool()`. Models that
+        # are served by a shared worker don't need these
+        self.num_warm_workers = getattr(args, "num_warm_workers", 0)
+        self.warm_worker_model_keys = getattr(args, "warm_worker_model_keys", None) or list(self.model_configs.keys())
+        for model_key in self.warm_worker_model_keys:
+            if model_key not in self.model_configs:
+                raise ValueError("%s is not a valid model, check the keys in models.json and models.mine.json" % (model_key))
+        self.warm_worker_model_keys = [model_key for model_key in self.warm_worker_model_keys if not self._uses_shared_worker(model_key)]
+        self._warm_workers = {model_key: [] for model_key in self.warm_worker_model_keys}
+        self._warm_workers_lock = threading.Lock() # when both are needed `_lock` is taken first
+        self._warm_workers_changed = threading.Event()
+        self._reserved_warm_workers = dict() # session id -> the warm worker that `_try_reserve_worker()` took for it
+        self._num_warm_workers_started = 0
+
+        # Admission control for sessions that need their own CPU worker (i.e. when there are no free GPU workers and we aren't using shared
+        # workers), a limit of 0 means unlimited. Sessions that don't fit are handled according to `admission_policy`, see `create_session()`
+        self.max_cpu_workers = getattr(args, "max_cpu_workers", 0)
+        self.max_worker_memory_mb = getattr(args, "max_worker_memory_mb", 0)
+        self.worker_memory_mb = getattr(args, "worker_memory_mb", 2048) # estimate for models that don't set "workerMemoryMB" in models.json
+        self.admission_policy = getattr(args, "admission_policy", "queue")
+        if self.admission_policy not in ADMISSION_POLICIES:
+            raise ValueError("%s is not a valid admission policy, must be one of %s" % (self.admission_policy, ", ".join(ADMISSION_POLICIES)))
+        # Session id (or the "reservation_id" of a pre-warmed worker) -> estimated memory (in MB) of the CPU worker that we have started (or
+        # are starting) for it. Pre-warmed workers count against the limits too, but they make way for sessions, see `_evict_warm_workers()`
+        self._cpu_worker_memory = dict()
+        self._admission_queue = collections.OrderedDict() # session id -> the arguments of `create_session()`, in the order they arrived
+        self._admission_changed = threading.Event()
 
     def is_active(self, session_id):
-        return session_id in self._SESSION_MAP
+        with self._lock:
+            return session_id in self._SESSION_MAP
+
+
+    def get_queue_position(self, session_id):
+        '''Returns the number of sessions ahead of `session_id` in the admission queue, or None if it isn't queued. Clients poll this (through
+        /getSessionStatus) while they wait, which also tells us that they haven't given up.
+        '''
+        with self._lock:
+            if session_id not in self._admission_queue:
+                return None
+            self._admission_queue[session_id]["last_poll_time"] = time.time()
+            return list(self._admission_queue.keys()).index(session_id)
+
+
+    def get_sessions(self):
+        '''Returns a snapshot of the active sessions as a list of `(session_id, Session)` pairs that is safe to iterate while sessions are created
+        and killed.
+        '''
+        with self._lock:
+            return list(self._SESSION_MAP.items())
 
 
     def is_expired(self, session_id):
@@ -81,72 +237,467 @@ class SessionHandler():
 
         A session_id is ONLY marked as expired by `kill_session`.
         '''
-        return session_id in self._expired_sessions
+        with self._lock:
+            return session_id in self._expired_sessions
 
 
     def _set_expired(self, session_id):
-        self._expired_sessions.add(session_id)
+        with self._lock:
+            self._expired_sessions.add(session_id)
 
 
     def cleanup_expired_session(self, session_id):
         '''After `manage_sessions` cleans up the session on the client side, then
         the session_id can be removed from the expired session set.
         ''' 
-        self._expired_sessions.remove(session_id)
+        with self._lock:
+            self._expired_sessions.discard(session_id) # two requests from the same client can both try to clean up
 
 
-    def _spawn_local_worker(self, port, gpu_id, model_key):
+    def _spawn_local_worker(self, gpu_id, model_key, shared=False, cpus=None, num_threads=None):
+        '''Starts a worker process and waits until it is ready to accept connections.
+
+        Args:
+            gpu_id (int): The GPU to use, -1 for the CPU
+            model_key (str): The model to load
+            shared (bool, optional): Start a worker that is shared by many sessions (see `_get_shared_worker()`). Defaults to False.
+            cpus (list of int, optional): The cores to pin the worker to. Defaults to None, i.e. any core.
+            num_threads (int, optional): How many threads the worker's numerical libraries can use. Defaults to `worker_num_threads`.
+
+        Returns:
+            process (subprocess.Popen): The worker process
+            port (int): The port that the worker is listening on
+        '''
+        ready_read_fd, ready_write_fd = os.pipe()
         command = [
             "/usr/bin/env", "python3", "worker.py",
-            "--port", str(port),
+            "--port", "0", # the worker binds to any free port and tells us which through the pipe
             "--model_key", model_key,
+            "--ready_fd", str(ready_write_fd)
         ]
         if gpu_id != -1:
             command.append("--gpu_id")
             command.append(str(gpu_id))
-        process = subprocess.Popen(command, shell=False)
-        return process
+        if shared:
+            command.append("--shared")
+            if self.max_batch_size > 0:
+                command += ["--max_batch_size", str(self.max_batch_size), "--max_batch_wait_ms", str(self.max_batch_wait_ms)]
+
+        env = None
+        num_threads = num_threads or self.worker_num_threads
+        if num_threads:
+            command += ["--num_threads", str(num_threads)]
+            # The OpenMP / BLAS pools are sized when the libraries are loaded, so these have to be set before the worker imports anything
+            env = dict(os.environ)
+            for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"]:
+                env[name] = str(num_threads)
+            env["TF_NUM_INTEROP_THREADS"] = "1"
+
+        if cpus is not None:
+            if hasattr(os, "sched_setaffinity"):
+                # The worker pins itself before it imports its libraries, so that it (and every thread that it starts) only ever runs on `cpus`
+                command += ["--cpus", ",".join([str(cpu) for cpu in cpus])]
+            else: # `sched_setaffinity` is only available on Linux
+                LOGGER.warning("Couldn't pin worker to cores %s, this platform doesn't support it" % (str(cpus)))
 
+        try:
+            process = subprocess.Popen(command, shell=False, pass_fds=(ready_write_fd,), env=env)
+        finally:
+            os.close(ready_write_fd) # only the worker should hold the write end, so that we see EOF if it exits
+        port = wait_for_worker(process, ready_read_fd, self.worker_startup_timeout)
+        return process, port
 
-    def create_session(self, session_id, dataset_key, model_key, checkpoint_idx):
-        if session_id in self._SESSION_MAP:
-            raise ValueError("session_id %s has already been created" % (session_id))
 
+    def _start_warm_worker(self, model_key):
+        '''Starts a CPU worker for `model_key` and waits for it to be ready. Returns None if the worker didn't start.
+        '''
+        try:
+            process, port = self._spawn_local_worker(-1, model_key)
+        except ValueError as e:
+            LOGGER.error("Pre-warmed worker for '%s' didn't start: %s" % (model_key, str(e)))
+            return None
+        try:
+            model = ModelSessionRPC(-1, session_id=None, port=port)
+        except Exception as e:
+            process.kill()
+            process.wait()
+            LOGGER.error("Couldn't connect to the pre-warmed worker for '%s': %s" % (model_key, str(e)))
+            return None
+        return {
+            "process": process,
+            "model": model
+        }
+
+
+    def _top_up_warm_workers(self):
+        '''Starts pre-warmed workers until each pool has `num_warm_workers`, as long as they fit in the CPU worker limits and no sessions are
+        waiting for room in the admission queue.
+        '''
+        for model_key in self.warm_worker_model_keys:
+            with self._warm_workers_lock:
+                dead_workers = [warm_worker for warm_worker in self._warm_workers[model_key] if warm_worker["process"].poll() is not None]
+                self._warm_workers[model_key] = [warm_worker for warm_worker in self._warm_workers[model_key] if warm_worker not in dead_workers]
+                num_needed = self.num_warm_workers - len(self._warm_workers[model_key])
+            for warm_worker in dead_workers:
+                self._release_cpu_capacity(warm_worker["reservation_id"])
+
+            memory_mb = self._get_worker_memory_mb(model_key)
+            for _ in range(num_needed):
+                with self._lock:
+                    if len(self._admission_queue) > 0 or not self._has_cpu_capacity(memory_mb):
+                        break
+                    self._num_warm_workers_started += 1
+                    reservation_id = ("warm", self._num_warm_workers_started)
+                    self._cpu_worker_memory[reservation_id] = memory_mb
+
+                warm_worker = self._start_warm_worker(model_key)
+                if warm_worker is None:
+                    self._release_cpu_capacity(reservation_id)
+                    break
+                warm_worker["reservation_id"] = reservation_id
+                with self._warm_workers_lock:
+                    self._warm_workers[model_key].append(warm_worker)
+                LOGGER.info("Added a pre-warmed worker for '%s' to the pool" % (model_key))
+
+
+    def _get_warm_worker(self, model_key):
+        '''Takes a ready worker for `model_key` out of its pool, or returns None if there isn't one. Must be called with `_lock` held.
+        '''
+        warm_worker = None
+        with self._warm_workers_lock:
+            workers = self._warm_workers.get(model_key, [])
+            while len(workers) > 0 and warm_worker is None:
+                warm_worker = workers.pop(0)
+                if warm_worker["process"].poll() is not None:
+                    self._cpu_worker_memory.pop(warm_worker["reservation_id"], None)
+                    warm_worker = None
+        if warm_worker is not None:
+            self._warm_workers_changed.set() # start replacing it
+        return warm_worker
+
+
+    def _evict_warm_workers(self, memory_mb):
+        '''Kills pre-warmed workers (of any model) until a new CPU worker that needs `memory_mb` fits in the limits, sessions take precedence
+        over the pools. Nothing is killed if killing all of them still wouldn't make enough room. Must be called with `_lock` held.
+
+        Returns:
+            Whether the new worker fits now
+        '''
+        with self._warm_workers_lock:
+            candidates = [warm_worker for workers in self._warm_workers.values() for warm_worker in workers]
+            evicted_workers = []
+            for warm_worker in candidates:
+                if self._has_cpu_capacity(memory_mb, [evicted_worker["reservation_id"] for evicted_worker in evicted_workers]):
+                    break
+                evicted_workers.append(warm_worker)
+            if not self._has_cpu_capacity(memory_mb, [evicted_worker["reservation_id"] for evicted_worker in evicted_workers]):
+                return False
+            for model_key in self._warm_workers:
+                self._warm_workers[model_key] = [warm_worker for warm_worker in self._warm_workers[model_key] if warm_worker not in evicted_workers]
+
+        for warm_worker in evicted_workers:
+            LOGGER.info("Killing a pre-warmed worker to make room for a session")
+            self._cpu_worker_memory.pop(warm_worker["reservation_id"], None)
+            try:
+                warm_worker["process"].kill()
+            except:
+                pass
+        return True
+
+
+    def _uses_shared_worker(self, model_key):
+        return self.shared_workers and supports_shared_worker(self.model_configs[model_key])
+
+
+    def _get_shared_worker(self, model_key):
+        '''Returns the `(process, port)` of the worker that serves every session for `model_key` (see `worker.py --shared`), starting it if it
+        isn't running.
+        '''
+        with self._shared_workers_lock:
+            shared_worker = self._shared_workers.get(model_key, None)
+            if shared_worker is None or shared_worker["process"].poll() is not None:
+                process, port = self._spawn_local_worker(-1, model_key, shared=True)
+                shared_worker = {
+                    "process": process,
+                    "port": port
+                }
+                self._shared_workers[model_key] = shared_worker
+                LOGGER.info("Started a shared worker for '%s'" % (model_key))
+            return shared_worker["process"], shared_worker["port"]
+
+
+    def get_batch_stats(self):
+        '''Returns a dict from model key to the batching stats (see `BatchScheduler.get_stats()`) of the shared worker for that model, or None
+        for the shared workers that don't batch requests or couldn't be reached.
+        '''
+        with self._shared_workers_lock:
+            shared_workers = [(model_key, shared_worker["port"]) for model_key, shared_worker in self._shared_workers.items() if shared_worker["process"].poll() is None]
+
+        batch_stats = dict()
+        for model_key, port in shared_workers:
+            try:
+                model = ModelSessionRPC(-1, session_id=None, port=port)
+                try:
+                    batch_stats[model_key] = model.get_batch_stats()
+                finally:
+                    model.connection.close()
+            except Exception as e:
+                LOGGER.warning("Couldn't get the batching stats of the shared worker for '%s': %s" % (model_key, str(e)))
+                batch_stats[model_key] = None
+        return batch_stats
+
+
+    def start_worker_pool(self):
+        '''Starts the thread that keeps `num_warm_workers` CPU workers per model key started and waiting for sessions, so that creating a
+        session doesn't have to wait for a worker to import its libraries and load its model.
+        '''
+        if self.num_warm_workers > 0 and len(self.warm_worker_model_keys) > 0:
+            worker_pool_thread = threading.Thread(target=worker_pool_monitor, args=(self,), daemon=True)
+            worker_pool_thread.start()
+
+
+    def _get_worker_memory_mb(self, model_key):
+        return self.model_configs[model_key].get("workerMemoryMB", self.worker_memory_mb)
+
+
+    def _has_cpu_capacity(self, memory_mb, freed_ids=()):
+        '''Returns whether a new CPU worker that needs `memory_mb` fits, after the workers of `freed_ids` (keys of `_cpu_worker_memory`) are
+        gone. Must be called with `_lock` held.
+        '''
+        cpu_worker_memory = [memory for reservation_id, memory in self._cpu_worker_memory.items() if reservation_id not in freed_ids]
+        if self.max_cpu_workers > 0 and len(cpu_worker_memory) + 1 > self.max_cpu_workers:
+            return False
+        if self.max_worker_memory_mb > 0 and sum(cpu_worker_memory) + memory_mb > self.max_worker_memory_mb:
+            return False
+        return True
+
+
+    def _try_reserve_worker(self, session_id, model_key):
+        '''Takes a free worker slot from the inventory, or reserves capacity for a new CPU worker, for `session_id`. Must be called with `_lock` held.
+
+        Returns:
+            The worker to pass to `_create_session()`, or None if there isn't capacity for the session right now
+        '''
+        try:
+            return self._WORKER_POOL.get_nowait()
+        except Empty:
+            pass
+        worker = {"type": "local", "gpu_id": -1} # by convention, a GPU id of -1 means that we should use the CPU. We do this if there are no resources in the worker pool
+        if self._uses_shared_worker(model_key): # CPU sessions only add a head to a worker that is already running
+            return worker
+        warm_worker = self._get_warm_worker(model_key)
+        if warm_worker is not None: # the session takes over the capacity that the pre-warmed worker was holding
+            self._cpu_worker_memory[session_id] = self._cpu_worker_memory.pop(warm_worker["reservation_id"])
+            self._reserved_warm_workers[session_id] = warm_worker
+            return worker
+        memory_mb = self._get_worker_memory_mb(model_key)
+        if not self._has_cpu_capacity(memory_mb) and not self._evict_warm_workers(memory_mb):
+            return None
+        self._cpu_worker_memory[session_id] = memory_mb
+        return worker
+
+
+    def _release_cpu_capacity(self, reservation_id):
+        with self._lock:
+            self._cpu_worker_memory.pop(reservation_id, None)
+        self._admission_changed.set()
+
+
+    def _release_worker(self, session_id, worker):
+        with self._lock:
+            if "slot_id" in worker:
+                self._WORKER_POOL.put(worker) # add the worker slot back into the worker pool
+            warm_worker = self._reserved_warm_workers.pop(session_id, None) # in case `_create_session()` didn't get to use it
+        if warm_worker is not None:
+            warm_worker["process"].kill()
+        self._release_cpu_capacity(session_id)
+
+
+    def _get_preemptible_session_ids(self, model_key):
+        '''Returns the ids of the sessions with their own CPU worker that have to be killed to make room for a new session of `model_key`, idlest
+        first, or an empty list if killing all of them still wouldn't make enough room. Must be called with `_lock` held.
+        '''
+        memory_mb = self._get_worker_memory_mb(model_key)
+        candidates = sorted([(self._SESSION_MAP[session_id].last_interaction_time, session_id) for session_id in self._cpu_worker_memory if session_id in self._SESSION_MAP])
+        with self._warm_workers_lock: # these are killed before any session is, see `_evict_warm_workers()`
+            warm_reservation_ids = [warm_worker["reservation_id"] for workers in self._warm_workers.values() for warm_worker in workers]
+        session_ids = []
+        for _, session_id in candidates:
+            session_ids.append(session_id)
+            if self._has_cpu_capacity(memory_mb, warm_reservation_ids + session_ids):
+                return session_ids
+        return []
+
+
+    def create_session(self, session_id, dataset_key, model_key, checkpoint_idx):
+        '''Creates a session with its own model (a worker process, or a head in a shared worker). If the session would need a new CPU worker and
+        starting one would go over `max_cpu_workers` or `max_worker_memory_mb`, then what happens depends on `admission_policy`:
+        - "queue": the session waits in a FIFO queue and is started by the `admission_monitor` thread once other sessions have been killed
+        - "reject": the session isn't created
+        - "preempt": the sessions that have been idle for the longest are killed to make room, if killing all of them wouldn't be enough then
+          nothing is killed and the session is queued
+
+        Returns:
+            A dict with "status" set to "active", "queued" (with the "queuePosition", see `get_queue_position()`) or "rejected" (with a "message")
+        '''
         if not is_valid_dataset(dataset_key):
             raise ValueError("%s is not a valid dataset, check the keys in datasets.json and datasets.mine.json" % (model_key))
 
         if model_key not in self.model_configs:
             raise ValueError("%s is not a valid model, check the keys in models.json and models.mine.json" % (model_key))
 
+        with self._lock: # reserve the session id, starting the worker can take a while and we don't want to hold the lock while it does
+            if session_id in self._SESSION_MAP or session_id in self._creating_sessions or session_id in self._admission_queue:
+                raise ValueError("session_id %s has already been created" % (session_id))
+
+            worker = None
+            preempted_session_ids = []
+            if len(self._admission_queue) == 0: # otherwise we would be jumping the queue
+                worker = self._try_reserve_worker(session_id, model_key)
+                if worker is None and self.admission_policy == "preempt":
+                    preempted_session_ids = self._get_preemptible_session_ids(model_key)
+
+            if worker is None and len(preempted_session_ids) == 0:
+                return self._queue_or_reject_session(session_id, model_key, checkpoint_idx)
+            self._creating_sessions.add(session_id)
+
+        if worker is None:
+            # Killing a session waits on its worker, so we do it without holding the lock. Another session can take the room that we make in
+            # the meantime, in which case we are queued.
+            for preempted_session_id in preempted_session_ids:
+                LOGGER.info("Preempting session (%s) to make room for (%s)" % (preempted_session_id, session_id))
+                try:
+                    self.kill_session(preempted_session_id)
+                except ValueError:
+                    pass # it was killed by someone else in the meantime
+
+            with self._lock:
+                worker = self._try_reserve_worker(session_id, model_key)
+                if worker is None:
+                    self._creating_sessions.discard(session_id)
+                    return self._queue_or_reject_session(session_id, model_key, checkpoint_idx)
+
+        self._start_session(session_id, worker, model_key, checkpoint_idx)
+        return {
+            "status": "active"
+        }
+
+
+    def _queue_or_reject_session(self, session_id, model_key, checkpoint_idx):
+        '''Handles a session that there isn't room for according to `admission_policy`, returns the result for `create_session()`. Must be called
+        with `_lock` held.
+        '''
+        if self.admission_policy == "reject":
+            LOGGER.info("Rejected session (%s), the server is at capacity" % (session_id))
+            return {
+                "status": "rejected",
+                "message": "The server is at capacity, try again later"
+            }
+        self._admission_queue[session_id] = {
+            "model_key": model_key,
+            "checkpoint_idx": checkpoint_idx,
+            "last_poll_time": time.time()
+        }
+        LOGGER.info("Queued session (%s), there are %d sessions waiting" % (session_id, len(self._admission_queue)))
+        return {
+            "status": "queued",
+            "queuePosition": len(self._admission_queue) - 1
+        }
+
+
+    def _start_session(self, session_id, worker, model_key, checkpoint_idx):
         try:
-            worker = self._WORKER_POOL.get_nowait()
-        except Empty:
-            worker = {"type": "local", "gpu_id": -1} # by convention, a GPU id of -1 means that we should use the CPU. We do this if there are no resources in the worker pool
-        
+            self._create_session(session_id, worker, model_key, checkpoint_idx)
+        except:
+            self._release_worker(session_id, worker)
+            raise
+        finally:
+            with self._lock:
+                self._creating_sessions.discard(session_id)
+
+
+    def _admit_queued_sessions(self):
+        '''Starts the sessions at the front of the admission queue for as long as there is capacity for them, drops the queued sessions whose
+        clients have stopped polling for their status.
+        '''
+        while True:
+            with self._lock:
+                for session_id, request in list(self._admission_queue.items()):
+                    if time.time() - request["last_poll_time"] > QUEUED_SESSION_TIMEOUT_SECONDS:
+                        LOGGER.info("Dropping queued session (%s), its client has stopped waiting" % (session_id))
+                        del self._admission_queue[session_id]
+
+                if len(self._admission_queue) == 0:
+                    return
+                session_id, request = next(iter(self._admission_queue.items()))
+                worker = self._try_reserve_worker(session_id, request["model_key"])
+                if worker is None:
+                    return
+                del self._admission_queue[session_id]
+                self._creating_sessions.add(session_id)
+
+            LOGGER.info("Admitting queued session (%s)" % (session_id))
+            try:
+                self._start_session(session_id, worker, request["model_key"], request["checkpoint_idx"])
+            except Exception as e:
+                LOGGER.error("Couldn't start queued session (%s): %s" % (session_id, str(e)))
+
+
+    def _create_session(self, session_id, worker, model_key, checkpoint_idx):
         if worker["type"] == "local":
             gpu_id = worker["gpu_id"]
+            has_slot = "slot_id" in worker # sessions with a slot from the inventory get a worker of their own, started for that slot
             
-            # Create local worker and ModelSession object to pass to the Session()
-            random_port = get_free_tcp_port()
-            process = self._spawn_local_worker(random_port, gpu_id, model_key)
-            
-
-            if checkpoint_idx > -1:
-                checkpoints = Checkpoints.list_checkpoints()
-                model = ModelSessionRPC(gpu_id, session_id=session_id, port=random_port, load_dir=checkpoints[checkpoint_idx]["directory"])
+            shared = self._uses_shared_worker(model_key) and gpu_id == -1 and not has_slot
+            with self._lock:
+                warm_worker = self._reserved_warm_workers.pop(session_id, None)
+            if shared:
+                # Connect to the worker that is shared by all of the sessions for this model, it gives us our own fine-tuning head
+                process, port = self._get_shared_worker(model_key)
+                model = ModelSessionRPC(gpu_id, session_id=session_id, port=port)
+            elif warm_worker is not None:
+                # Attach to a worker that has already loaded the model
+                process = warm_worker["process"]
+                model = warm_worker["model"]
+                model.session_id = session_id
+                LOGGER.info("Using a pre-warmed worker for (%s)" % (session_id))
             else:
-                model = ModelSessionRPC(gpu_id, session_id=session_id, port=random_port)
-
-            # Create Session object
+                # Create local worker and ModelSession object to pass to the Session()
+                process, port = self._spawn_local_worker(gpu_id, model_key, cpus=worker.get("cpus", None), num_threads=worker.get("num_threads", None))
+                try:
+                    model = ModelSessionRPC(gpu_id, session_id=session_id, port=port)
+                except:
+                    process.kill()
+                    process.wait()
+                    raise
+
+            # Create Session object, restoring the checkpoint through the session so that its model version / result cache are updated
             session = Session(session_id, model)
+            if checkpoint_idx > -1:
+                checkpoints = Checkpoints.list_checkpoints()
+                try:
+                    session.load_state_from(checkpoints[checkpoint_idx]["directory"])
+                except:
+                    session.job_runner.stop()
+                    if shared:
+                        model.close()
+                    else:
+                        process.kill()
+                    raise
             
             # Assosciate the front-end session with the Session and Worker
-            self._SESSION_MAP[session_id] = session
-            self._SESSION_INFO[session_id] = {
-                "worker": worker,
-                "process": process
-            }
-            if gpu_id == -1:
+            with self._lock:
+                self._SESSION_MAP[session_id] = session
+                self._SESSION_INFO[session_id] = {
+                    "worker": worker,
+                    "process": process,
+                    "shared": shared
+                }
+            if shared:
+                LOGGER.info("Attached (%s) to the shared worker for '%s'" % (session_id, model_key))
+            elif gpu_id == -1 and "cpus" in worker:
+                LOGGER.info("Created a local worker for (%s) on CPU cores %s" % (session_id, str(worker["cpus"])))
+            elif gpu_id == -1:
                 LOGGER.info("Created a local worker for (%s) on CPU" % (session_id))
             else:
                 LOGGER.info("Created a local worker for (%s) on GPU %s" % (session_id, str(gpu_id)))
@@ -161,41 +712,64 @@ class SessionHandler():
         ''' Two code paths should be able to kill a session:
         - The user kills the session on purpose through /killSession
         - The `session_monitor` thread sees that the session hasn't had any activity for some time 
+
+        Both can happen at once, only the first one removes the session, the second gets a ValueError.
         '''
-        if self.is_active(session_id):
+        with self._lock:
+            if session_id in self._admission_queue: # it hasn't started yet, so there is nothing to clean up
+                del self._admission_queue[session_id]
+                return
+            if session_id not in self._SESSION_MAP:
+                raise ValueError("Tried to kill a non-existing Session")
+            session = self._SESSION_MAP.pop(session_id)
+            session_info = self._SESSION_INFO.pop(session_id)
+            self._set_expired(session_id) # we set this to expired so that it can be cleaned up on the client side
+
+        # The session is no longer reachable, so we can clean up without holding the lock. We stop its jobs first, while the worker is still
+        # there, so that a running job is cancelled cleanly between chunks instead of failing on a dead connection.
+        session.job_runner.stop()
+        if not session.job_runner.join(JOB_RUNNER_STOP_TIMEOUT_SECONDS):
+            LOGGER.info("The jobs of (%s) didn't stop in time, killing its worker anyway" % (session_id))
+
+        if session_info["shared"]:
+            # other sessions are using the worker, so we only remove our head from it
+            try:
+                with session.lock: # let a call that is using the connection finish first
+                    session.model.close()
+            except:
+                LOGGER.info("Couldn't remove (%s) from its shared worker, ignoring..." % (session_id))
+        else:
             # kill the remote process
             try:
-                self._SESSION_INFO[session_id]["process"].kill()
+                session_info["process"].kill()
             except:
                 LOGGER.info("Worker process didn't need to be killed, ignoring...")
-            # add the worker back into the worker pool
-            self._WORKER_POOL.put(self._SESSION_INFO[session_id]["worker"])
-            del self._SESSION_INFO[session_id]
+        # add the worker back into the worker pool, and let queued sessions have the capacity that we were using
+        self._release_worker(session_id, session_info["worker"])
 
-            # TODO: is there anything that needs to be cleaned up at the session level (e.g. saving data)?
-            del self._SESSION_MAP[session_id]
-            
-            self._set_expired(session_id) # we set this to expired so that it can be cleaned up on the client side
-        else:
-            raise ValueError("Tried to kill a non-existing Session")
+        # TODO: is there anything that needs to be cleaned up at the session level (e.g. saving data)?
 
 
     def get_session(self, session_id):
-        if self.is_active(session_id):
-            return self._SESSION_MAP[session_id]
-        else:
+        with self._lock:
+            session = self._SESSION_MAP.get(session_id, None)
+        if session is None:
             raise ValueError("Tried to get a non-existing Session")
+        return session
 
 
     def touch_session(self, session_id):
-        if self.is_active(session_id):
-            LOGGER.debug("Touching session (%s)" % (session_id))
-            self._SESSION_MAP[session_id].last_interaction_time = time.time()
-        else:
+        with self._lock:
+            session = self._SESSION_MAP.get(session_id, None)
+        if session is None:
             raise ValueError("Tried to update time on a non-existing Session")
+        LOGGER.debug("Touching session (%s)" % (session_id))
+        session.last_interaction_time = time.time()
 
 
     def start_monitor(self, session_timeout_seconds):
-        session_monitor_thread = threading.Thread(target=session_monitor, args=(self, session_timeout_seconds))
-        session_monitor_thread.setDaemon(True)
+        session_monitor_thread = threading.Thread(target=session_monitor, args=(self, session_timeout_seconds), daemon=True)
         session_monitor_thread.start()
+
+        admission_monitor_thread = threading.Thread(target=admission_monitor, args=(self,), daemon=True)
+        admission_monitor_thread.start()
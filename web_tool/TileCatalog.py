@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+
+import shapely.wkb
+
+
+class TileCatalog(object):
+    BOUNDS_FN = "catalog_bounds.npy"
+    GEOM_OFFSETS_FN = "catalog_geom_offsets.npy"
+    GEOMS_FN = "catalog_geoms.bin"
+    FN_OFFSETS_FN = "catalog_fn_offsets.npy"
+    FNS_FN = "catalog_fns.bin"
+
+    def __init__(self, directory):
+        """A read-only, memory-mapped catalog of the tiles in a tiled raster layer. This replaces the pickled `{idx: (fn, shapely_geom)}`
+        dictionaries ("tiles.p"), which are slow to load and have to be fully unpickled in every process. Here nothing is parsed at load
+        time and, because the files are mapped read-only, the pages are shared between every process that opens the same catalog.
+
+        The catalog is stored in column format:
+        - "catalog_bounds.npy": a float64 array with shape (number of tiles, 4) holding the (minx, miny, maxx, maxy) bounds of each tile
+        - "catalog_geoms.bin" / "catalog_geom_offsets.npy": the WKB encoded footprints of the tiles concatenated together, and an int64 array
+          of length (number of tiles + 1) where tile `i` is stored in bytes `offsets[i]:offsets[i+1]`
+        - "catalog_fns.bin" / "catalog_fn_offsets.npy": the UTF-8 encoded filenames of the tiles, stored the same way as the geometries
+
+        Args:
+            directory (str): The directory that `TileCatalog.write()` was called with
+        """
+        self.directory = directory
+
+        self.bounds = np.load(os.path.join(directory, TileCatalog.BOUNDS_FN), mmap_mode="r")
+        self.geom_offsets = np.load(os.path.join(directory, TileCatalog.GEOM_OFFSETS_FN), mmap_mode="r")
+        self.fn_offsets = np.load(os.path.join(directory, TileCatalog.FN_OFFSETS_FN), mmap_mode="r")
+        self.geoms = TileCatalog._map_blob(os.path.join(directory, TileCatalog.GEOMS_FN))
+        self.fns = TileCatalog._map_blob(os.path.join(directory, TileCatalog.FNS_FN))
+
+        assert self.bounds.shape[0] + 1 == self.geom_offsets.shape[0] == self.fn_offsets.shape[0], "The tile catalog in %s is corrupt" % (directory)
+
+    @staticmethod
+    def _map_blob(fn):
+        if os.path.getsize(fn) == 0: # np.memmap can't map empty files
+            return np.zeros((0,), dtype=np.uint8)
+        return np.memmap(fn, dtype=np.uint8, mode="r")
+
+    @staticmethod
+    def exists(directory):
+        return all([os.path.exists(os.path.join(directory, fn)) for fn in [
+            TileCatalog.BOUNDS_FN,
+            TileCatalog.GEOM_OFFSETS_FN,
+            TileCatalog.GEOMS_FN,
+            TileCatalog.FN_OFFSETS_FN,
+            TileCatalog.FNS_FN
+        ]])
+
+    @staticmethod
+    def write(directory, tiles):
+        """Writes a catalog to `directory`.
+
+        Args:
+            directory (str): The directory to write the catalog files to, this will be created if it doesn't exist
+            tiles (iterable): An iterable of `(filename, shapely geometry)` tuples. The position of a tile in this iterable is its index in the catalog.
+
+        Returns:
+            num_tiles (int): The number of tiles written
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        bounds = []
+        geom_offsets = [0]
+        fn_offsets = [0]
+        with open(os.path.join(directory, TileCatalog.GEOMS_FN), "wb") as geoms_f, open(os.path.join(directory, TileCatalog.FNS_FN), "wb") as fns_f:
+            for fn, geom in tiles:
+                geom_bytes = geom.wkb
+                fn_bytes = fn.encode("utf-8")
+                geoms_f.write(geom_bytes)
+                fns_f.write(fn_bytes)
+
+                bounds.append(geom.bounds)
+                geom_offsets.append(geom_offsets[-1] + len(geom_bytes))
+                fn_offsets.append(fn_offsets[-1] + len(fn_bytes))
+
+        np.save(os.path.join(directory, TileCatalog.BOUNDS_FN), np.array(bounds, dtype=np.float64).reshape(-1, 4))
+        np.save(os.path.join(directory, TileCatalog.GEOM_OFFSETS_FN), np.array(geom_offsets, dtype=np.int64))
+        np.save(os.path.join(directory, TileCatalog.FN_OFFSETS_FN), np.array(fn_offsets, dtype=np.int64))
+
+        return len(bounds)
+
+    def __len__(self):
+        return self.bounds.shape[0]
+
+    def get_filename(self, idx):
+        start, end = self.fn_offsets[idx], self.fn_offsets[idx+1]
+        return self.fns[start:end].tobytes().decode("utf-8")
+
+    def get_geometry(self, idx):
+        start, end = self.geom_offsets[idx], self.geom_offsets[idx+1]
+        return shapely.wkb.loads(self.geoms[start:end].tobytes())
+
+    def __getitem__(self, idx):
+        """Returns the `(filename, shapely geometry)` tuple for tile `idx`, this mirrors the format of the old pickled tile dictionaries.
+        """
+        if idx < 0 or idx >= len(self):
+            raise KeyError(idx)
+        return self.get_filename(idx), self.get_geometry(idx)
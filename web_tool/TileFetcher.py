@@ -0,0 +1,260 @@
+import os
+import math
+import hashlib
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+
+import numpy as np
+
+import cv2
+import mercantile
+import rasterio.transform
+
+import logging
+LOGGER = logging.getLogger("server")
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE = 2 * math.pi * 6378137.0 # in EPSG:3857 units
+ORIGIN_SHIFT = EARTH_CIRCUMFERENCE / 2.0
+
+
+def get_resolution_at_zoom(zoom):
+    """Returns the size of a pixel, in EPSG:3857 units, of a XYZ tile at the given zoom level.
+    """
+    return EARTH_CIRCUMFERENCE / (TILE_SIZE * 2**zoom)
+
+
+class TileCache():
+
+    def __init__(self, cache_dir, max_bytes):
+        """An on-disk LRU cache of decoded tiles. Each tile is stored as a ".npy" file named after the SHA1 hash of the tile's URL. The
+        modification time of a file is used as its last access time.
+
+        Args:
+            cache_dir (str): Directory to store cached tiles in
+            max_bytes (int): When the size of the cache goes over this many bytes we delete the least recently used tiles
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for fn in self._list_files():
+            self._current_bytes += os.path.getsize(fn)
+
+    def _list_files(self):
+        for root, _, fns in os.walk(self.cache_dir):
+            for fn in fns:
+                if fn.endswith(".npy"):
+                    yield os.path.join(root, fn)
+
+    def _get_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".npy")
+
+    def get(self, key):
+        fn = self._get_path(key)
+        try:
+            img = np.load(fn)
+            os.utime(fn) # mark as recently used
+            return img
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, key, img):
+        fn = self._get_path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+        tmp_fn = "%s.%d.%d.tmp" % (fn, os.getpid(), threading.get_ident())
+        with open(tmp_fn, "wb") as f:
+            np.save(f, img)
+
+        with self._lock: # held across the replace so that concurrent puts of the same tile don't both count it as new
+            try:
+                old_size = os.path.getsize(fn) # another thread may have cached the same tile already
+            except OSError:
+                old_size = 0
+            os.replace(tmp_fn, fn) # atomic, so concurrent readers never see a partial file
+            self._current_bytes += os.path.getsize(fn) - old_size
+            if self._current_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used tiles until the cache is at 90% of `max_bytes`. Must be called while holding `_lock`.
+        """
+        files = []
+        for fn in self._list_files():
+            try:
+                stat = os.stat(fn)
+                files.append((stat.st_mtime, stat.st_size, fn))
+            except OSError:
+                pass
+        files.sort()
+
+        self._current_bytes = sum([size for _, size, _ in files])
+        target_bytes = int(self.max_bytes * 0.9)
+        for _, size, fn in files:
+            if self._current_bytes <= target_bytes:
+                break
+            try:
+                os.remove(fn)
+                self._current_bytes -= size
+            except OSError:
+                pass
+
+
+class TileFetcher():
+
+    def __init__(self, url_template, cache_dir="tmp/tile_cache/", max_cache_bytes=2**30, max_workers=16, timeout=30):
+        """Fetches XYZ tiles from `url_template` concurrently, reusing keep-alive HTTP connections and caching decoded tiles on disk.
+
+        Args:
+            url_template (str): A URL (or local path) with "{x}", "{y}" and "{z}" placeholders
+            cache_dir (str, optional): Directory for the on-disk tile cache. If None then tiles are not cached. Defaults to "tmp/tile_cache/".
+            max_cache_bytes (int, optional): Size limit for the on-disk tile cache. Defaults to 1GB.
+            max_workers (int, optional): Maximum number of tiles to fetch at the same time. Defaults to 16.
+            timeout (int, optional): Timeout in seconds for each HTTP request. Defaults to 30.
+        """
+        self.url_template = url_template
+        self.timeout = timeout
+
+        self.cache = TileCache(cache_dir, max_cache_bytes) if cache_dir is not None else None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local() # each thread keeps its own keep-alive connections
+
+    def _get_connection(self, scheme, netloc):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = dict()
+            self._local.connections = connections
+
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == "https":
+                connections[key] = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connections[key] = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def _close_connection(self, scheme, netloc):
+        connections = getattr(self._local, "connections", {})
+        connection = connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _download(self, url):
+        """Returns the bytes at `url`, or None if the server doesn't have the tile.
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme not in ["http", "https"]: # local tiles
+            path = parsed_url.path if parsed_url.scheme == "file" else url
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+
+        path = parsed_url.path + ("?" + parsed_url.query if parsed_url.query else "")
+        for attempt in range(2): # the server may have closed an idle keep-alive connection, in which case we reconnect once
+            connection = self._get_connection(parsed_url.scheme, parsed_url.netloc)
+            try:
+                connection.request("GET", path, headers={"Connection": "keep-alive"})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError, OSError):
+                self._close_connection(parsed_url.scheme, parsed_url.netloc)
+                if attempt == 1:
+                    raise
+                continue
+
+            if response.status == 404:
+                return None
+            elif response.status != 200:
+                raise ValueError("Error fetching tile %s, the server returned status %d" % (url, response.status))
+            return data
+
+    def fetch(self, tile):
+        """Returns the RGB image of `tile` (a mercantile `Tile`) as a uint8 array with shape (256, 256, 3). Missing tiles are returned as zeros.
+        """
+        url = self.url_template.format(z=tile.z, y=tile.y, x=tile.x)
+
+        if self.cache is not None:
+            img = self.cache.get(url)
+            if img is not None:
+                return img
+
+        data = self._download(url)
+        if data is None:
+            LOGGER.warning("Tile %s doesn't exist, filling with zeros" % (url))
+            return np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Couldn't decode tile %s" % (url))
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        if self.cache is not None:
+            self.cache.put(url, img)
+        return img
+
+    def get_window(self, zoom, bounds):
+        """Returns the pixel window, in global pixel coordinates at `zoom`, that covers `bounds`.
+
+        Args:
+            zoom (int): The zoom level
+            bounds (tuple): A tuple in the format (left, bottom, right, top) in EPSG:3857
+
+        Returns:
+            window (tuple): A tuple in the format (col_start, row_start, col_stop, row_stop)
+        """
+        resolution = get_resolution_at_zoom(zoom)
+        num_pixels = TILE_SIZE * 2**zoom
+        left, bottom, right, top = bounds
+
+        col_start = max(int(math.floor(round((left + ORIGIN_SHIFT) / resolution, 6))), 0)
+        row_start = max(int(math.floor(round((ORIGIN_SHIFT - top) / resolution, 6))), 0)
+        col_stop = min(int(math.ceil(round((right + ORIGIN_SHIFT) / resolution, 6))), num_pixels)
+        row_stop = min(int(math.ceil(round((ORIGIN_SHIFT - bottom) / resolution, 6))), num_pixels)
+        return col_start, row_start, max(col_stop, col_start+1), max(row_stop, row_start+1)
+
+    def get_transform(self, zoom, col_start, row_start):
+        """Returns the affine transform (in EPSG:3857) of an image whose top left pixel is at global pixel (`col_start`, `row_start`) at `zoom`.
+        """
+        resolution = get_resolution_at_zoom(zoom)
+        return rasterio.transform.from_origin(-ORIGIN_SHIFT + col_start * resolution, ORIGIN_SHIFT - row_start * resolution, resolution, resolution)
+
+    def fetch_window(self, zoom, col_start, row_start, col_stop, row_stop, out=None, tile_filter=None):
+        """Fetches all of the tiles that cover a window of global pixel coordinates (see `get_window()`) concurrently and stitches them into one image.
+
+        Args:
+            zoom (int): The zoom level
+            col_start, row_start, col_stop, row_stop (int): The window to fetch
+            out (np.ndarray, optional): A uint8 array with shape (row_stop-row_start, col_stop-col_start, 3) to write into. Defaults to None.
+            tile_filter (function, optional): If given, only tiles for which `tile_filter(tile)` is True are fetched, the rest are left as zeros.
+
+        Returns:
+            img (np.ndarray): The stitched image
+        """
+        height, width = row_stop - row_start, col_stop - col_start
+        if out is None:
+            out = np.zeros((height, width, 3), dtype=np.uint8)
+        else:
+            assert out.shape == (height, width, 3)
+
+        tiles = []
+        for y in range(row_start // TILE_SIZE, (row_stop - 1) // TILE_SIZE + 1):
+            for x in range(col_start // TILE_SIZE, (col_stop - 1) // TILE_SIZE + 1):
+                tile = mercantile.Tile(x, y, zoom)
+                if tile_filter is None or tile_filter(tile):
+                    tiles.append(tile)
+
+        for tile, img in zip(tiles, self.executor.map(self.fetch, tiles)):
+            # intersection of the tile with the window in global pixel coordinates
+            tile_col, tile_row = tile.x * TILE_SIZE, tile.y * TILE_SIZE
+            c0, c1 = max(col_start, tile_col), min(col_stop, tile_col + TILE_SIZE)
+            r0, r1 = max(row_start, tile_row), min(row_stop, tile_row + TILE_SIZE)
+            out[r0-row_start:r1-row_start, c0-col_start:c1-col_start] = img[r0-tile_row:r1-tile_row, c0-tile_col:c1-tile_col]
+
+        return out
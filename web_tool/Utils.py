@@ -1,6 +1,11 @@
 import os
 import io
+import json
+import uuid
+import zlib
+import struct
 import threading
+import collections
 
 import numpy as np
 
@@ -39,6 +44,106 @@ def deserialize(data):
     with io.BytesIO(data) as f:
         return np.load(f)
 
+SHARED_ARRAY_RAM_DIR = "/dev/shm/landcover/"
+SHARED_ARRAY_DISK_DIR = "tmp/shared_arrays/"
+SHARED_ARRAY_RAM_HEADROOM_BYTES = 16 * 2**20 # other processes (and our concurrent writes) also use /dev/shm
+
+def _get_shared_array_dir(num_bytes):
+    """Returns `SHARED_ARRAY_RAM_DIR` if "/dev/shm" has room for `num_bytes` more, else `SHARED_ARRAY_DISK_DIR`. Writing past the end of
+    "/dev/shm" through a memory map doesn't fail with an error, it kills the process with SIGBUS, and e.g. Docker only gives containers 64MB
+    of it by default.
+    """
+    try:
+        stats = os.statvfs("/dev/shm")
+    except OSError:
+        return SHARED_ARRAY_DISK_DIR
+    if stats.f_bavail * stats.f_frsize < num_bytes + SHARED_ARRAY_RAM_HEADROOM_BYTES:
+        return SHARED_ARRAY_DISK_DIR
+    return SHARED_ARRAY_RAM_DIR
+
+def write_shared_array(array, directory=None):
+    """Copies `array` into a new memory-mapped file so that another process on the same machine can map it without any serialization. By
+    default the file is created under "/dev/shm" (i.e. it lives in RAM) when that has enough free space, and under "tmp/shared_arrays/" otherwise.
+
+    Args:
+        array (np.ndarray): The array to share
+        directory (str, optional): Directory to create the file in. Defaults to picking one with `_get_shared_array_dir()`.
+
+    Returns:
+        handle (tuple): A `(path, shape, dtype)` tuple of builtin types that is cheap to send over RPC, see `read_shared_array()`
+    """
+    if directory is None:
+        directory = _get_shared_array_dir(array.nbytes)
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, "%d_%s.dat" % (os.getpid(), uuid.uuid4().hex))
+    shape = tuple(int(dim) for dim in array.shape)
+    dtype = np.dtype(array.dtype).str
+
+    try:
+        if array.size == 0: # np.memmap can't map empty files
+            open(path, "wb").close()
+        else:
+            shared_array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+            shared_array[...] = array
+            shared_array.flush()
+            del shared_array
+    except BaseException:
+        delete_shared_array((path, shape, dtype))
+        raise
+    return (path, shape, dtype)
+
+def read_shared_array(handle, delete=True):
+    """Maps an array that was written with `write_shared_array()`. The mapping is copy-on-write, so the returned array can be modified without
+    affecting the file.
+
+    Args:
+        handle (tuple): The `(path, shape, dtype)` tuple returned by `write_shared_array()`
+        delete (bool, optional): Whether to unlink the file after mapping it (even if mapping it fails), the mapping stays valid until the array is garbage collected. Defaults to True.
+
+    Returns:
+        array (np.ndarray): The shared array
+    """
+    path, shape, dtype = handle
+    shape = tuple(shape)
+    try:
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="c", shape=shape)
+    finally:
+        if delete:
+            delete_shared_array(handle)
+
+def delete_shared_array(handle):
+    try:
+        os.remove(handle[0])
+    except FileNotFoundError:
+        pass
+
+def _is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # the process exists but belongs to another user
+        return True
+    return True
+
+def clear_shared_arrays():
+    """Deletes the shared array files left behind by processes that are no longer running, e.g. by a server or worker that crashed between
+    writing an array and the other side deleting it. Files are named after the PID of the process that wrote them, see `write_shared_array()`.
+    """
+    for directory in [SHARED_ARRAY_RAM_DIR, SHARED_ARRAY_DISK_DIR]:
+        if not os.path.isdir(directory):
+            continue
+        for fn in os.listdir(directory):
+            try:
+                pid = int(fn.split("_")[0])
+            except ValueError: # not one of our files
+                continue
+            if not _is_process_running(pid):
+                delete_shared_array((os.path.join(directory, fn), None, None))
+
 class AtomicCounter:
     ''' From https://gist.github.com/benhoyt/8c8a8d62debe8e5aa5340373f9c509c7 '''
     def __init__(self, initial=0):
@@ -54,6 +159,64 @@ class AtomicCounter:
             self.value += num
             return self.value
 
+class LRUCache:
+    def __init__(self, max_bytes, size_fn):
+        """A thread safe least-recently-used cache that is limited by the total size (in bytes) of the values it holds.
+
+        Args:
+            max_bytes (int): The maximum total size of the cached values, the least recently used values are evicted to stay under this
+            size_fn (function): A function that returns the size, in bytes, of a value
+        """
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value for `key` or None if `key` isn't in the cache.
+        """
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return self._values[key][0]
+            else:
+                self.misses += 1
+                return None
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        with self._lock:
+            if key in self._values:
+                self.current_bytes -= self._values.pop(key)[1]
+            if size > self.max_bytes: # this would evict everything else and still not fit
+                return
+            self._values[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._values.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._values),
+                "bytes": self.current_bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
 NLCD_CLASSES = [
     0, 11, 12, 21, 22, 23, 24, 31, 41, 42, 43, 51, 52, 71, 72, 73, 74, 81, 82, 90, 95, 255
 ]
@@ -140,34 +303,131 @@ def to_one_hot_batch(batch, class_num):
         one_hot[:, class_id, :, :] = (batch == class_id).astype(np.float32)
     return one_hot
 
-def class_prediction_to_img(y_pred, hard=True, color_list=None):
+def get_class_idxs(y_pred, out=None, rows_per_chunk=256):
+    """Computes the argmax over the last axis of `y_pred` as uint8 class indices. The argmax is done in chunks of rows so that the int64
+    temporary that numpy creates never has the size of the full image.
+
+    Args:
+        y_pred (np.ndarray): An array with shape (height, width, num_classes), with at most 256 classes
+        out (np.ndarray, optional): A uint8 array with shape (height, width) to write into. Defaults to None.
+        rows_per_chunk (int, optional): Number of rows to process at a time. Defaults to 256.
+
+    Returns:
+        class_idxs (np.ndarray): A uint8 array with shape (height, width)
+    """
+    height, width, num_classes = y_pred.shape
+    assert num_classes <= 256, "Can't represent more than 256 classes with uint8 indices"
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    for i in range(0, height, rows_per_chunk):
+        out[i:i+rows_per_chunk] = y_pred[i:i+rows_per_chunk].argmax(axis=2)
+    return out
+
+def class_prediction_to_img(y_pred, hard=True, color_list=None, out=None):
+    """Renders per-class predictions as an RGB image.
+
+    The hard rendering takes the argmax of each pixel and looks its color up in a (num_classes, 3) uint8 palette. The soft rendering
+    blends the class colors by their predicted probabilities with a single matrix multiply against the palette.
+
+    Args:
+        y_pred (np.ndarray): An array with shape (height, width, num_classes)
+        hard (bool, optional): Whether to render the argmax (uint8 output) or the probability weighted blend of colors (float32 output in [0,1]). Defaults to True.
+        color_list (list, optional): A list of hex colors, one per class. Defaults to `COLOR_MAP_LC4`.
+        out (np.ndarray, optional): An array with shape (height, width, 3) to write into, uint8 if `hard` else float32. Defaults to None.
+
+    Returns:
+        img (np.ndarray): The rendered image, this is `out` if it was given
+    """
     assert len(y_pred.shape) == 3, "Input must have shape (height, width, num_classes)"
     height, width, num_classes = y_pred.shape
 
     if color_list is None:
-        colour_map = COLOR_MAP_LC4
+        palette = (255 * COLOR_MAP_LC4).astype(np.uint8)
     else:
-        new_color_list = []
-        for color in color_list:
-            color = color.lstrip("#")
-            color = tuple(int(color[i:i+2], 16) / 255.0 for i in (0, 2, 4))
-            new_color_list.append(color)
-        colour_map = np.array(new_color_list)
+        palette = get_palette(color_list)
+    assert palette.shape[0] >= num_classes, "Need at least one color per class"
 
     if hard:
-        img = np.zeros((height, width, 3), dtype=np.uint8)
-        y_pred_temp = y_pred.argmax(axis=2)
-        for c in range(num_classes):
-            mask = (y_pred_temp==c)
-            for ch in range(3):
-                img[:,:, ch][mask] = int(255*colour_map[c, ch])
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.uint8)
+        rows_per_chunk = 256
+        class_idxs = np.empty((min(rows_per_chunk, height), width), dtype=np.uint8)
+        for i in range(0, height, rows_per_chunk):
+            chunk_idxs = get_class_idxs(y_pred[i:i+rows_per_chunk], out=class_idxs[:min(rows_per_chunk, height-i)])
+            np.take(palette, chunk_idxs, axis=0, out=out[i:i+rows_per_chunk])
     else:
-        img = np.zeros((height, width, 3), dtype=np.float32)
-        for c in range(num_classes):
-            for ch in range(3):
-                img[:, :, ch] += y_pred[:, :, c] * colour_map[c, ch]
-    return img
-    
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.float32)
+        colour_map = COLOR_MAP_LC4 if color_list is None else palette.astype(np.float32) / 255.0
+        colour_map = colour_map[:num_classes]
+        np.matmul(y_pred, colour_map, out=out)
+    return out
+
+def get_palette(color_list):
+    """Converts a list of hex colors (e.g. ["#0000FF", "#008000"]) into a uint8 array with shape (number of colors, 3).
+    """
+    palette = np.zeros((len(color_list), 3), dtype=np.uint8)
+    for i, color in enumerate(color_list):
+        color = color.lstrip("#")
+        palette[i] = [int(color[j:j+2], 16) for j in (0, 2, 4)]
+    return palette
+
+def _png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+def encode_paletted_png(class_idxs, palette, compress_level=1):
+    """Encodes a 2D array of class indices as a single band, 8-bit paletted PNG. This is much smaller, and much faster to create, than
+    rendering the classes to an RGB image and encoding that.
+
+    Args:
+        class_idxs (np.ndarray): A uint8 array with shape (height, width) where every value is a valid index into `palette`
+        palette (np.ndarray): A uint8 array with shape (number of colors, 3), see `get_palette()`. At most 256 colors.
+        compress_level (int, optional): The zlib compression level to use (0-9). Defaults to 1.
+
+    Returns:
+        png (bytes): The encoded PNG
+    """
+    assert len(class_idxs.shape) == 2, "Input must have shape (height, width)"
+    assert palette.shape[0] <= 256, "Paletted PNGs can have at most 256 colors"
+    height, width = class_idxs.shape
+
+    # Every row of the image data is prefixed with a filter type byte, we use filter type 0 (none)
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = class_idxs
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)), # 8-bit depth, color type 3 (paletted)
+        _png_chunk(b"PLTE", palette.astype(np.uint8).tobytes()),
+        _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), compress_level)),
+        _png_chunk(b"IEND", b"")
+    ])
+
+BINARY_RESPONSE_CONTENT_TYPE = "application/x-landcover-binary"
+
+def encode_binary_response(header, parts):
+    """Encodes a JSON serializable header and a list of binary parts (e.g. encoded images) as one length-prefixed body. This lets us
+    send images to the client as raw bytes instead of base64 strings inside of a JSON document.
+
+    The format is a 4 byte big-endian unsigned integer giving the length of the header, the UTF-8 encoded JSON header, then the bytes of
+    each part one after the other. The header is sent with an extra "parts" key that lists the name, content type and length of each part
+    in order, see `parseBinaryResponse()` in "js/globals.js" for the client side.
+
+    Args:
+        header (dict): A JSON serializable dictionary
+        parts (list): A list of `(name, content_type, data)` tuples where `data` is a bytes-like object
+
+    Returns:
+        body (bytes): The encoded response
+    """
+    header = dict(header)
+    header["parts"] = [
+        {"name": name, "contentType": content_type, "length": len(data)}
+        for name, content_type, data in parts
+    ]
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([struct.pack(">I", len(header_bytes)), header_bytes] + [bytes(data) for _, _, data in parts])
+
 def nlcd_to_img(img):
     return np.vectorize(NLCD_COLOR_MAP.__getitem__, signature='()->(n)')(img).astype(np.uint8)
 
@@ -145,4 +145,78 @@ var gZonemaps = {};
 var gLoadedLayers = [];
 
 var gSessionCheckFrequency = 10000; // in milliseconds
-var gIsSessionActive = false;
\ No newline at end of file
+var gJobPollFrequency = 2000; // in milliseconds, how often we check on the status of a /predTile job
+var gIsSessionActive = false;
+// Binary response protocol, see `encode_binary_response()` in "web_tool/Utils.py". When this is enabled we ask the server for images as
+// raw bytes in a length-prefixed body instead of base64 strings inside of JSON. The server falls back to JSON if it doesn't support it.
+var BINARY_RESPONSE_CONTENT_TYPE = "application/x-landcover-binary";
+var gUseBinaryProtocol = (typeof TextDecoder !== "undefined") && (typeof Blob !== "undefined") && (typeof URL.createObjectURL !== "undefined");
+
+var parseBinaryResponse = function(buffer){
+    // Returns the JSON header of the response, with each binary part added as `resp[name + "_url"]` (an object URL for the part's bytes)
+    var view = new DataView(buffer);
+    var headerLength = view.getUint32(0, false);
+    var resp = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(buffer, 4, headerLength)));
+
+    var offset = 4 + headerLength;
+    for(var i=0; i<resp.parts.length; i++){
+        var part = resp.parts[i];
+        var blob = new Blob([new Uint8Array(buffer, offset, part.length)], {"type": part.contentType});
+        resp[part.name + "_url"] = URL.createObjectURL(blob);
+        offset += part.length;
+    }
+    return resp;
+};
+
+var revokeObjectUrls = function(urls){
+    // Frees the object URLs (created by `parseBinaryResponse`) in `urls`, other URLs (e.g. data URLs) are ignored. Call this when an image
+    // that came from a binary response is replaced or removed, otherwise its bytes are kept alive for as long as the page is open.
+    for(var i=0; i<urls.length; i++){
+        if(typeof urls[i] === "string" && urls[i].indexOf("blob:") == 0){
+            URL.revokeObjectURL(urls[i]);
+        }
+    }
+};
+
+var postWithNegotiatedProtocol = function(url, request, success, error){
+    // POSTs `request` as JSON and calls `success(resp)` with either the parsed JSON response, or the parsed binary response if the server
+    // sent one. `error` is called with an object that has the same `status` and `responseText` fields as a jqXHR.
+    if(!gUseBinaryProtocol){
+        $.ajax({
+            type: "POST",
+            url: url,
+            data: JSON.stringify(request),
+            success: function(data, textStatus, jqXHR){
+                success(data);
+            },
+            error: error,
+            dataType: "json",
+            contentType: "application/json"
+        });
+        return;
+    }
+
+    var xhr = new XMLHttpRequest();
+    xhr.open("POST", url, true);
+    xhr.setRequestHeader("Content-Type", "application/json");
+    xhr.setRequestHeader("Accept", BINARY_RESPONSE_CONTENT_TYPE + ", application/json");
+    xhr.responseType = "arraybuffer";
+
+    xhr.onload = function(){
+        var contentType = xhr.getResponseHeader("Content-Type") || "";
+        if(xhr.status == 200 && contentType.indexOf(BINARY_RESPONSE_CONTENT_TYPE) == 0){
+            success(parseBinaryResponse(xhr.response));
+        }else{
+            var text = new TextDecoder("utf-8").decode(new Uint8Array(xhr.response));
+            if(xhr.status == 200){
+                success(JSON.parse(text));
+            }else{
+                error({"status": xhr.status, "responseText": text}, "error", xhr.statusText);
+            }
+        }
+    };
+    xhr.onerror = function(){
+        error({"status": xhr.status, "responseText": "{}"}, "error", xhr.statusText);
+    };
+    xhr.send(JSON.stringify(request));
+};
@@ -99,7 +99,54 @@ var doDownloadTile = function(){
         type: "POST",
         url: gBackendURL + "predTile",
         data: JSON.stringify(request),
-        timeout: 0,
+        success: function(data, textStatus, jqXHR){
+            pollDownloadJob(data["jobId"], outputLayer);
+        },
+        error: notifyFail,
+        dataType: "json",
+        contentType: "application/json"
+    });
+
+    new Noty({
+        type: "success",
+        text: "Sent tile download request. The progress, and then the download links when the request is complete, will appear underneath the 'Download' button.",
+        layout: 'topCenter',
+        timeout: 10000,
+        theme: 'metroui'
+    }).show();
+};
+
+//-----------------------------------------------------------------
+// Poll a /predTile job until it is done, then show the download links
+//-----------------------------------------------------------------
+var pollDownloadJob = function(jobId, outputLayer){
+    $.ajax({
+        type: "POST",
+        url: gBackendURL + "jobStatus",
+        data: JSON.stringify({"jobId": jobId}),
+        success: function(data, textStatus, jqXHR){
+            if(data["status"] == "finished" || data["status"] == "failed" || data["status"] == "cancelled"){
+                getDownloadJobResult(jobId, outputLayer);
+            }else{
+                if(data["status"] == "queued"){
+                    $("#lblPNG").html("Waiting to start...");
+                }else if(data["total"] > 0){
+                    $("#lblPNG").html("Processing, " + data["progress"] + "/" + data["total"] + " chunks done");
+                }
+                setTimeout(function(){ pollDownloadJob(jobId, outputLayer); }, gJobPollFrequency);
+            }
+        },
+        error: notifyFail,
+        dataType: "json",
+        contentType: "application/json"
+    });
+};
+
+var getDownloadJobResult = function(jobId, outputLayer){
+    $.ajax({
+        type: "POST",
+        url: gBackendURL + "jobResult",
+        data: JSON.stringify({"jobId": jobId}),
         success: function(data, textStatus, jqXHR){
             new Noty({
                 type: "success",
@@ -116,20 +163,14 @@ var doDownloadTile = function(){
             $("#lblStatistics").html("<a href='"+statisticsURL+"' target='_blank'>Download Class Statistics</a>");
 
             outputLayer.setUrl(pngURL);
-
         },
-        error: notifyFail,
+        error: function(jqXHR, textStatus, errorThrown){
+            $("#lblPNG").html("");
+            notifyFail(jqXHR, textStatus, errorThrown);
+        },
         dataType: "json",
         contentType: "application/json"
     });
-
-    new Noty({
-        type: "success",
-        text: "Sent tile download request, please wait for 2-3 minutes. When the request is complete the download links will appear underneath the 'Download' button.",
-        layout: 'topCenter',
-        timeout: 10000,
-        theme: 'metroui'
-    }).show();
 };
 
 //-----------------------------------------------------------------
@@ -268,16 +309,10 @@ var requestPatch = function(idx, polygon, currentImgIdx, serviceURL){
         "classes": CLASSES,
     };
     
-    $.ajax({
-        type: "POST",
-        url: serviceURL + "predPatch",
-        data: JSON.stringify(request),
-        success: function(data, textStatus, jqXHR){
-            let resp = data;
-
+    postWithNegotiatedProtocol(serviceURL + "predPatch", request, function(resp){
             var srcs = [{
-                "soft": "data:image/png;base64," + resp.output_soft,
-                "hard": "data:image/png;base64," + resp.output_hard,
+                "soft": resp.output_soft_url || "data:image/png;base64," + resp.output_soft,
+                "hard": resp.output_hard_url || "data:image/png;base64," + resp.output_hard,
             }];
             
             for(var i=0; i<1; i++){
@@ -287,7 +322,12 @@ var requestPatch = function(idx, polygon, currentImgIdx, serviceURL){
                     gCurrentPatches[idx]["imageLayer"].setUrl(srcs[i][tSelection]);
                 }
     
-                // Save the resulting data in all cases
+                // Save the resulting data in all cases, freeing the images that this replaces (the images of a patch are kept for as long
+                // as the patch is shown, the sharpness slider switches between them)
+                var oldSrcs = gCurrentPatches[idx]["patches"][i]["srcs"];
+                if(oldSrcs !== null){
+                    revokeObjectUrls([oldSrcs["soft"], oldSrcs["hard"]]);
+                }
                 gCurrentPatches[idx]["patches"][i]["srcs"] = srcs[i];
     
                 // Update the right panel if we are the current "last item", we need to check for this because the order we send out requests to the API isn't necessarily the order they will come back
@@ -303,10 +343,8 @@ var requestPatch = function(idx, polygon, currentImgIdx, serviceURL){
             }
 
         },
-        error: notifyFail,
-        dataType: "json",
-        contentType: "application/json"
-    });
+        notifyFail
+    );
 };
 
 //-----------------------------------------------------------------
@@ -330,25 +368,21 @@ var requestInputPatch = function(idx, polygon, serviceURL){
         },
     };
 
-    $.ajax({
-        type: "POST",
-        url: serviceURL + "getInput",
-        data: JSON.stringify(request),
-        success: function(data, textStatus, jqXHR){
-            var resp = data;
-            var inputImage = "data:image/png;base64," + resp.input_img;
+    postWithNegotiatedProtocol(serviceURL + "getInput", request, function(resp){
+            var inputImage = resp.input_img_url || "data:image/png;base64," + resp.input_img;
 
             //gCurrentPatches[idx]["naipImg"] = naipImg
             
             // Update the right panel if we are the current "last item", we need to check for this because the order we send out requests to the API isn't necessarily the order they will come back
             if(idx == gCurrentPatches.length-1){
+                revokeObjectUrls([$("#inputImage").attr("src")]); // the input image is only shown in the side panel, so the old one can go
                 $("#inputImage").attr("src", inputImage);
+            }else{
+                revokeObjectUrls([inputImage]); // a newer patch has already been requested, so this image will never be shown
             }
         },
-        error: notifyFail,
-        dataType: "json",
-        contentType: "application/json"
-    });
+        notifyFail
+    );
 };
 
 //-----------------------------------------------------------------
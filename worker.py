@@ -8,8 +8,25 @@ import time
 import datetime
 import collections
 import argparse
+import threading
+
+
+def pin_to_cpus(argv):
+    '''Pins this process to the cores given with `--cpus`, e.g. "--cpus 0,1,2,3". This runs before we import numpy / torch / TensorFlow
+    below, so that every thread that they start only ever runs on those cores. The server passes this flag instead of pinning us between
+    fork and exec, which isn't safe to do from its threads.
+    '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--cpus", action="store", type=str, default=None)
+    args, _ = parser.parse_known_args(argv)
+    if args.cpus is not None:
+        os.sched_setaffinity(0, [int(cpu) for cpu in args.cpus.split(",")])
+
+pin_to_cpus(sys.argv[1:])
 
 import numpy as np
+import torch
+import tensorflow as tf
 
 import logging
 LOGGER = logging.getLogger("server")
@@ -21,14 +38,26 @@ from web_tool.ModelSessionKerasExample import KerasDenseFineTune
 from web_tool.ModelSessionPytorchSolar import SolarFineTuning
 from web_tool.ModelSessionPyTorchExample import TorchFineTuning
 from web_tool.ModelSessionRandomForest import ModelSessionRandomForest
-from web_tool.Utils import setup_logging, serialize, deserialize
+from web_tool.Utils import setup_logging, serialize, deserialize, write_shared_array, read_shared_array
 
 from web_tool.Models import load_models
 
 class MyService(rpyc.Service):
 
-    def __init__(self, model):
+    def __init__(self, model, shared=False):
+        """Exposes a `ModelSession` over RPC. Every call takes the id of the session that it is for.
+
+        Args:
+            model (ModelSession): The model to serve
+            shared (bool, optional): If False then every call goes to `model` (the worker belongs to a single session). If True then the worker
+                is shared by many sessions, each of which gets its own fine-tuning head, created with `model.create_head()` the first time we see
+                its session id. Defaults to False.
+        """
         self.model = model
+        self.shared = shared
+
+        self.heads = dict()
+        self.heads_lock = threading.Lock()
         
     def on_connect(self, conn):
         pass
@@ -36,31 +65,68 @@ class MyService(rpyc.Service):
     def on_disconnect(self, conn):
         pass
 
-    def exposed_last_tile(self):
-        return serialize(self.model.last_tile)
+    def _get_model(self, session_id):
+        if not self.shared:
+            return self.model
+        with self.heads_lock:
+            if session_id not in self.heads:
+                LOGGER.info("Creating a head for session (%s)" % (session_id))
+                self.heads[session_id] = self.model.create_head()
+            return self.heads[session_id]
 
-    def exposed_run(self, tile, inference_mode=False):
+    def exposed_remove_session(self, session_id):
+        with self.heads_lock:
+            self.heads.pop(session_id, None)
+
+    def exposed_last_tile(self, session_id):
+        return serialize(self._get_model(session_id).last_tile)
+
+    def exposed_run(self, session_id, tile, inference_mode=False):
         tile = deserialize(tile) # need to serialize/deserialize numpy arrays
-        output = self.model.run(tile, inference_mode)
+        output = self._get_model(session_id).run(tile, inference_mode)
         return serialize(output) # need to serialize/deserialize numpy arrays
 
-    def exposed_retrain(self):
-        return self.model.retrain()
+    def exposed_last_tile_shared(self, session_id):
+        return write_shared_array(self._get_model(session_id).last_tile)
+
+    def exposed_run_shared(self, session_id, tile_handle, inference_mode=False):
+        """Same as `exposed_run()` but the input and output arrays are passed through memory-mapped files (see `Utils.write_shared_array()`),
+        only their `(path, shape, dtype)` handles go over RPC. The caller owns the input file and must delete the output file.
+        """
+        tile = read_shared_array(tuple(tile_handle), delete=False)
+        output = self._get_model(session_id).run(tile, inference_mode)
+        return write_shared_array(output) # deletes the file itself if writing it fails
+
+    def exposed_get_batch_stats(self):
+        return self.model.get_batch_stats()
 
-    def exposed_add_sample_point(self, row, col, class_idx):
-        return self.model.add_sample_point(row, col, class_idx)
+    def exposed_retrain(self, session_id):
+        return self._get_model(session_id).retrain()
 
-    def exposed_undo(self):
-        return self.model.undo()
+    def exposed_add_sample_point(self, session_id, row, col, class_idx):
+        return self._get_model(session_id).add_sample_point(row, col, class_idx)
 
-    def exposed_reset(self):
-        return self.model.reset()
+    def exposed_undo(self, session_id):
+        return self._get_model(session_id).undo()
 
-    def exposed_save_state_to(self, directory):
-        return self.model.save_state_to(directory)
+    def exposed_reset(self, session_id):
+        return self._get_model(session_id).reset()
+
+    def exposed_save_state_to(self, session_id, directory):
+        return self._get_model(session_id).save_state_to(directory)
+
+    def exposed_load_state_from(self, session_id, directory):
+        return self._get_model(session_id).load_state_from(directory)
+
+def set_num_threads(num_threads):
+    '''Limits the thread pools of the libraries that our models run on, so that workers that share a machine don't oversubscribe its cores.
+    `SessionHandler._spawn_local_worker()` also sets the matching OpenMP / BLAS environment variables, which only work if they are set before
+    the libraries are loaded.
+    '''
+    torch.set_num_threads(num_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
 
-    def exposed_load_state_from(self, directory):
-        return self.model.load_state_from(directory)
 
 def main():
     parser = argparse.ArgumentParser(description="AI for Earth Land Cover Worker")
@@ -68,6 +134,12 @@ def main():
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose debugging", default=False)
     parser.add_argument("--port", action="store", type=int, help="Port we are listenning on", default=0)
     parser.add_argument("--gpu_id", action="store", dest="gpu_id", type=int, help="GPU to use", required=False)
+    parser.add_argument("--ready_fd", action="store", type=int, help="File descriptor to write our port number to once we are ready to accept connections", required=False)
+    parser.add_argument("--shared", action="store_true", help="Serve many sessions, each with its own fine-tuning head on top of one copy of the model", default=False)
+    parser.add_argument("--max_batch_size", action="store", type=int, help="With --shared, run the windows from concurrent requests through the model together in batches of up to this many windows (0 disables this)", default=0)
+    parser.add_argument("--max_batch_wait_ms", action="store", type=int, help="How long a batch waits for more windows before it is run", default=10)
+    parser.add_argument("--num_threads", action="store", type=int, help="Number of threads that torch / TensorFlow can use", required=False)
+    parser.add_argument("--cpus", action="store", type=str, help="Comma separated list of the cores to run on, see `pin_to_cpus()`", required=False)
     parser.add_argument("--model_key", action="store", dest="model_key", type=str, help="Model key from models.json to use")
     args = parser.parse_args(sys.argv[1:])
 
@@ -79,6 +151,10 @@ def main():
     os.environ["CUDA_VISIBLE_DEVICES"] = "" if args.gpu_id is None else str(args.gpu_id)
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
 
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+        LOGGER.info("Limited to %d threads, running on cores %s" % (args.num_threads, str(sorted(os.sched_getaffinity(0))) if hasattr(os, "sched_getaffinity") else "unknown"))
+
     model_configs = load_models()
     if not args.model_key in model_configs:
         LOGGER.error("'%s' is not recognized as a valid model, exiting..." % (args.model_key))
@@ -96,7 +172,22 @@ def main():
     else:
         raise NotImplementedError("The given model type is not implemented yet.")
 
-    t = OneShotServer(MyService(model), port=args.port)
+    if args.shared and args.max_batch_size > 0:
+        try:
+            model.enable_batching(args.max_batch_size, args.max_batch_wait_ms)
+            LOGGER.info("Batching requests in batches of up to %d windows, waiting at most %d ms" % (args.max_batch_size, args.max_batch_wait_ms))
+        except NotImplementedError as e:
+            LOGGER.warning("%s, running each request on its own" % (e))
+
+    if args.shared: # many sessions connect to us, each with their own connection
+        t = ThreadedServer(MyService(model, shared=True), port=args.port) # this binds the listening socket
+    else:
+        t = OneShotServer(MyService(model), port=args.port) # this binds the listening socket
+
+    if args.ready_fd is not None: # tell the server which port we are listening on, we are ready for connections from here on
+        os.write(args.ready_fd, ("%d\n" % (t.port)).encode("utf-8"))
+        os.close(args.ready_fd)
+
     t.start()
    
 if __name__ == "__main__":